@@ -0,0 +1,77 @@
+""" Offset alignment: dict of dicts vs tramscore.align.
+
+Usage: python benchmarks/bench_align.py
+
+Builds synthetic (sid, diff) match lists like a segment returns: one
+advert aligned at a single offset, buried in chance collisions spread over
+the catalog. Times the old per-tuple dict scorer against
+align.match_arrays + align.top_alignments, and checks both pick the same
+(advert, offset, count).
+"""
+from __future__ import print_function
+
+import random
+
+from common import best_of, print_table
+
+from tramscore import align
+
+# (label, matches, adverts, diff spread in frames, aligned matches)
+CASES = [
+    ("short segment", 2000, 50, 3000, 60),
+    ("10s segment", 20000, 200, 3000, 300),
+    ("popular jingle", 60000, 200, 3000, 900),
+    ("jingle, big catalog", 60000, 5000, 20000, 900),
+]
+
+
+def dict_scorer(matches):
+    diff_counter = {}
+    largest = 0
+    largest_count = 0
+    advert_id = -1
+    for sid, diff in matches:
+        if diff not in diff_counter:
+            diff_counter[diff] = {}
+        if sid not in diff_counter[diff]:
+            diff_counter[diff][sid] = 0
+        diff_counter[diff][sid] += 1
+
+        if diff_counter[diff][sid] > largest_count:
+            largest = diff
+            largest_count = diff_counter[diff][sid]
+            advert_id = sid
+    return advert_id, largest, largest_count
+
+
+def numpy_scorer(matches):
+    sids, codes, diffs = align.match_arrays(matches)
+    codes, diffs, counts = align.top_alignments(codes, diffs, 1)
+    return sids[codes[0]], int(diffs[0]), int(counts[0])
+
+
+def make_matches(count, adverts, spread, aligned, seed=0):
+    rng = random.Random(seed)
+    matches = [(rng.randint(1, adverts), rng.randint(-spread, spread))
+               for _ in range(count - aligned)]
+    matches.extend([(adverts // 2, 1234)] * aligned)
+    rng.shuffle(matches)
+    return matches
+
+
+def main():
+    rows = []
+    for label, count, adverts, spread, aligned in CASES:
+        matches = make_matches(count, adverts, spread, aligned)
+        dict_time, expected = best_of(lambda: dict_scorer(matches))
+        numpy_time, result = best_of(lambda: numpy_scorer(matches))
+        rows.append((label, count, adverts, "%.2f ms" % (dict_time * 1000),
+                     "%.2f ms" % (numpy_time * 1000),
+                     "%.1fx" % (dict_time / numpy_time),
+                     "yes" if tuple(result) == tuple(expected) else "NO"))
+
+    print_table(("case", "matches", "adverts", "dict", "numpy", "speedup", "same winner"), rows)
+
+
+if __name__ == "__main__":
+    main()
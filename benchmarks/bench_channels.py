@@ -0,0 +1,90 @@
+""" Recognition latency and accuracy of the channel modes.
+
+Usage: python benchmarks/bench_channels.py [ads_dir]
+
+The adverts in `ads_dir` are fingerprinted like fingerprint_directory does,
+every channel. 10 second excerpts of each advert, every 5 seconds, clean and
+with white noise added to every channel, are then recognized in each
+tramscore.CHANNEL_MODES mode:
+  - "separate": a fingerprint and a lookup per channel,
+  - "mono": the channels downmixed, one fingerprint and one lookup,
+  - "dedup": a fingerprint per channel, one lookup of the distinct hashes.
+
+A dictionary index stands in for the database. Reports milliseconds per
+excerpt (fingerprinting and lookup), hashes looked up, the share of excerpts
+whose best match is their advert with at least MIN_ALIGNED aligned hashes,
+and the mean aligned count and relative confidence of those matches. Mono
+adverts give the same result in every mode.
+"""
+from __future__ import print_function
+
+import time
+
+from common import ads_dir_from_argv, add_noise, best_match, build_index, excerpts, load_ads, print_table
+
+from tramscore import CHANNEL_MODES, CHANNELS_SEPARATE, channel_hashes
+
+# aligned hashes needed to call an excerpt recognized
+MIN_ALIGNED = 20
+# signal to noise ratio of the noisy excerpts
+NOISE_SNR_DB = 0
+
+
+def recording_excerpts(ads):
+    """
+    Yields (advert, [channel samples]) 10 second excerpts of every advert,
+    clean and noisy.
+    """
+    for name, channels, Fs in ads:
+        windows = [list(excerpts(samples, Fs, seconds=10, step=5)) for samples in channels]
+        for pieces in zip(*windows):
+            clean = [samples for _, samples in pieces]
+            yield name, Fs, clean
+            yield name, Fs, [add_noise(samples, NOISE_SNR_DB, seed=i)
+                             for i, samples in enumerate(clean)]
+
+
+def main():
+    ads = load_ads(ads_dir_from_argv())
+    index = build_index(dict(
+        (name, set(hash for hashes in channel_hashes(channels, Fs=Fs) for hash in hashes))
+        for name, channels, Fs in ads))
+    recordings = list(recording_excerpts(ads))
+    stereo = sum(1 for _, channels, _ in ads if len(channels) > 1)
+
+    rows = []
+    for channel_mode in CHANNEL_MODES:
+        elapsed = 0.0
+        looked_up = 0
+        recognized = 0
+        counts = []
+        relative = []
+        for name, Fs, channels in recordings:
+            t = time.time()
+            lookups = channel_hashes(channels, Fs=Fs, channel_mode=channel_mode)
+            # the matches of every lookup are aligned together
+            hashes = [hash for lookup in lookups for hash in lookup]
+            advert, count = best_match(index, hashes)
+            elapsed += time.time() - t
+
+            looked_up += len(hashes)
+            if advert == name and count >= MIN_ALIGNED:
+                recognized += 1
+                counts.append(count)
+                relative.append(count * 100.0 / len(hashes))
+
+        rows.append((channel_mode + (" (baseline)" if channel_mode == CHANNELS_SEPARATE else ""),
+                     "%.1f ms" % (elapsed * 1000 / len(recordings)),
+                     looked_up // len(recordings),
+                     "%.1f%%" % (recognized * 100.0 / len(recordings)),
+                     "%.0f" % (sum(counts) / float(len(counts))) if counts else "-",
+                     "%.1f%%" % (sum(relative) / len(relative)) if relative else "-"))
+
+    print("%d adverts (%d stereo), %d excerpts, half with noise at %d dB SNR"
+          % (len(ads), stereo, len(recordings), NOISE_SNR_DB))
+    print()
+    print_table(("mode", "per excerpt", "hashes", "recognized", "aligned", "relative"), rows)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+""" MySQL queries per second: a connection per query vs the pool.
+
+Usage: python benchmarks/bench_db_pool.py [config] [seconds]
+
+Runs against the "database" settings of a tramscore config (default
+tramscore.conf in the repository root), e.g. a local MySQL. For 1 and 8
+threads it times:
+  - "connect": mysql.connect + query + close per query, what every
+    `with self.cursor()` cost before the pool,
+  - "pool": the same query through SQLDatabase.cursor.
+"""
+from __future__ import print_function
+
+import json
+import os
+import sys
+import threading
+import time
+
+from common import ROOT_DIR, print_table
+
+import MySQLdb as mysql
+
+from tramscore.database_sql import SQLDatabase
+
+QUERY = "SELECT COUNT(*) FROM %s;" % SQLDatabase.ADVERTS_TABLENAME
+THREADS = (1, 8)
+
+
+def connect_per_query(options):
+    conn = mysql.connect(**options)
+    try:
+        cur = conn.cursor()
+        cur.execute(QUERY)
+        cur.fetchall()
+        cur.close()
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def pooled(db):
+    with db.cursor(charset="utf8") as cur:
+        cur.execute(QUERY)
+        cur.fetchall()
+
+
+def queries_per_second(func, threads, seconds):
+    counts = [0] * threads
+    deadline = time.time() + seconds
+
+    def run(i):
+        while time.time() < deadline:
+            func()
+            counts[i] += 1
+
+    workers = [threading.Thread(target=run, args=(i,)) for i in range(threads)]
+    t = time.time()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return sum(counts) / (time.time() - t)
+
+
+def main():
+    config_path = sys.argv[1] if len(sys.argv) > 1 else os.path.join(ROOT_DIR, "tramscore.conf")
+    seconds = float(sys.argv[2]) if len(sys.argv) > 2 else 5
+    with open(config_path) as f:
+        options = json.load(f).get("database", {})
+    # settings of the memory database in front of mysql
+    options = dict((key, value) for key, value in options.items()
+                   if key not in ("backend", "index_file"))
+
+    db = SQLDatabase(**options)
+    connect_options = dict((key, value) for key, value in options.items()
+                           if not key.startswith("pool_"))
+    connect_options["charset"] = "utf8"
+
+    rows = []
+    for threads in THREADS:
+        before = queries_per_second(lambda: connect_per_query(connect_options), threads, seconds)
+        after = queries_per_second(lambda: pooled(db), threads, seconds)
+        rows.append((threads, "%.0f" % before, "%.0f" % after, "%.1fx" % (after / before)))
+
+    print_table(("threads", "connect q/s", "pool q/s", "speedup"), rows)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,40 @@
+""" Decoding time of the pydub and ffmpeg pipe decoders.
+
+Usage: python benchmarks/bench_decode.py [ads_dir]
+
+For every advert in `ads_dir` (default ads/ in the repository root) it
+times decoder.read with:
+  - "pydub": AudioSegment.from_file, every channel at the file's rate,
+  - "ffmpeg": one ffmpeg process piping mono s16le at fingerprint.DEFAULT_FS
+    into a preallocated buffer,
+and reports the samples each hands to the fingerprinter.
+"""
+from __future__ import print_function
+
+from common import ads_dir_from_argv, best_of, print_table
+
+from tramscore import decoder
+
+
+def samples(channels):
+    return sum(len(channel) for channel in channels)
+
+
+def main():
+    ads_dir = ads_dir_from_argv()
+
+    rows = []
+    for filename, _ in sorted(decoder.find_files(ads_dir, (".mp3", ".wav"))):
+        before, (channels, _, _, _) = best_of(lambda: decoder.read(filename), repeat=3)
+        after, (mono, _, _, _) = best_of(
+            lambda: decoder.read(filename, decoder=decoder.DECODER_FFMPEG), repeat=3)
+        rows.append((decoder.path_to_advertname(filename),
+                     "%.1f ms" % (before * 1000), samples(channels),
+                     "%.1f ms" % (after * 1000), samples(mono),
+                     "%.1fx" % (before / after)))
+
+    print_table(("advert", "pydub", "samples", "ffmpeg", "samples", "speedup"), rows)
+
+
+if __name__ == "__main__":
+    main()
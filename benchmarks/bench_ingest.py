@@ -0,0 +1,109 @@
+""" Pipe ingest vs 10 second segment files.
+
+Usage: python benchmarks/bench_ingest.py [ads_dir]
+
+For every advert:
+  - "segments" is the old path: the audio is cut into 10 second pieces
+    and each piece is fingerprinted from scratch (decoding not counted),
+  - "pipe" streams the file through ffmpeg as s16le PCM into a
+    PCMStream and an IncrementalFingerprinter, decoding included.
+
+Reports time per audio second, hashes produced (segments lose the pairs
+crossing a cut) and the stream second at which a sliding 10 second window
+first recognizes the advert against whole-file fingerprints.
+"""
+from __future__ import print_function
+
+import time
+
+import numpy as np
+
+from common import (ads_dir_from_argv, load_ads, print_table, build_index,
+                    best_match, excerpts)
+
+from tramscore import decoder, fingerprint, ingest
+from tramscore.streaming import IncrementalFingerprinter
+
+# aligned hashes needed to call a window a detection
+MIN_ALIGNED = 20
+
+
+def segments(samples, Fs):
+    t = time.time()
+    hashes = []
+    for start, piece in excerpts(samples, Fs, seconds=10, step=10):
+        hashes.append((start, fingerprint.fingerprint(piece, Fs=Fs)))
+    return time.time() - t, hashes
+
+
+def pipe(path, Fs, index, name):
+    stream = ingest.PCMStream(path, Fs=Fs).start()
+    fingerprinter = IncrementalFingerprinter(Fs=Fs)
+    window = int(10 * Fs / fingerprinter.plan.hop)
+    step = int(ingest.DEFAULT_STEP_SECONDS * Fs)
+
+    t = time.time()
+    hashes = []
+    detected = None
+    while not stream.finished:
+        samples, _ = stream.read(step)
+        hashes.extend(fingerprinter.feed(samples))
+        if stream.finished:
+            hashes.extend(fingerprinter.flush())
+        if detected is None:
+            start = fingerprinter.frames - window
+            advert, count = best_match(index, [h for h in hashes if h[1] >= start])
+            if advert == name and count >= MIN_ALIGNED:
+                detected = fingerprinter.seconds
+    t = time.time() - t
+    stream.close()
+    return t, hashes, detected
+
+
+def main():
+    ads_dir = ads_dir_from_argv()
+    ads = load_ads(ads_dir)
+    paths = dict((decoder.path_to_advertname(filename), filename)
+                 for filename, _ in decoder.find_files(ads_dir, [".mp3", ".wav"]))
+
+    # ffmpeg downmixes to mono, do the same for the segments
+    ads = [(name, np.mean(channels, axis=0).astype(np.int16), Fs)
+           for name, channels, Fs in ads]
+    index = build_index(dict((name, fingerprint.fingerprint(samples, Fs=Fs))
+                             for name, samples, Fs in ads))
+
+    rows = []
+    totals = [0.0, 0.0, 0.0]
+    for name, samples, Fs in ads:
+        seconds = len(samples) / float(Fs)
+
+        seg_time, seg_hashes = segments(samples, Fs)
+        seg_detected = None
+        for start, piece_hashes in seg_hashes:
+            advert, count = best_match(index, piece_hashes)
+            if advert == name and count >= MIN_ALIGNED:
+                # a segment is only seen once it is complete
+                seg_detected = min(start + 10, seconds)
+                break
+
+        pipe_time, pipe_hashes, pipe_detected = pipe(paths[name], Fs, index, name)
+
+        totals[0] += seconds
+        totals[1] += seg_time
+        totals[2] += pipe_time
+        rows.append((name[:24], "%.1f" % seconds,
+                     "%.1f ms" % (seg_time * 1000 / seconds),
+                     "%.1f ms" % (pipe_time * 1000 / seconds),
+                     sum(len(h) for _, h in seg_hashes), len(pipe_hashes),
+                     "-" if seg_detected is None else "%.1f s" % seg_detected,
+                     "-" if pipe_detected is None else "%.1f s" % pipe_detected))
+
+    print_table(("advert", "seconds", "segments/s", "pipe/s", "segment hashes",
+                 "pipe hashes", "segment detected", "pipe detected"), rows)
+    print()
+    print("total %.1f s of audio: segments %.2f s, pipe %.2f s (decoding included)"
+          % tuple(totals))
+
+
+if __name__ == "__main__":
+    main()
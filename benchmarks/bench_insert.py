@@ -0,0 +1,86 @@
+""" Fingerprint insert throughput of the database backends.
+
+Usage: python benchmarks/bench_insert.py [ads_dir] [config] [copies]
+
+Fingerprints every advert in `ads_dir` (sha1) and inserts the hashes
+`copies` times (default 20) as new adverts, a library of copies * adverts,
+into the database of a tramscore config (default tramscore.conf in the
+repository root). Reports fingerprints/second of:
+  - "row by row": executemany of the single row INSERT_FINGERPRINT,
+  - "insert_hashes": the backend's bulk path, multi-row INSERT chunks for
+    mysql, binary COPY for postgresql,
+  - "load data" (mysql only): insert_hashes with load_data, the server
+    must allow local_infile.
+
+The benchmark adverts are never marked fingerprinted and are removed with
+their fingerprints by delete_unfingerprinted_adverts afterwards.
+"""
+from __future__ import print_function
+
+import json
+import os
+import sys
+import time
+
+from common import ROOT_DIR, ads_dir_from_argv, load_ads, print_table
+
+from tramscore import fingerprint, get_database
+
+
+def row_by_row(db, sid, hashes):
+    with db.cursor() as cur:
+        cur.executemany(db.INSERT_FINGERPRINT, [(hash, sid, offset) for hash, offset in hashes])
+
+
+def bulk(db, sid, hashes):
+    db.insert_hashes(sid, hashes)
+
+
+def fingerprints_per_second(db, insert, library, copies):
+    total = 0
+    elapsed = 0.0
+    try:
+        for copy in range(copies):
+            for name, hashes in library:
+                sid = db.insert_advert("bench_insert %s %d" % (name, copy), "bench_insert", 0)
+                t = time.time()
+                insert(db, sid, hashes)
+                elapsed += time.time() - t
+                total += len(hashes)
+    finally:
+        db.delete_unfingerprinted_adverts()
+    return total, total / elapsed
+
+
+def main():
+    ads_dir = ads_dir_from_argv()
+    config_path = sys.argv[2] if len(sys.argv) > 2 else os.path.join(ROOT_DIR, "tramscore.conf")
+    copies = int(sys.argv[3]) if len(sys.argv) > 3 else 20
+    with open(config_path) as f:
+        config = json.load(f)
+    database_type = config.get("database_type", "mysql")
+    options = config.get("database", {})
+
+    library = []
+    for name, channels, Fs in load_ads(ads_dir):
+        hashes = set()
+        for channel in channels:
+            hashes.update(fingerprint.fingerprint(channel, Fs=Fs))
+        library.append((name, sorted(hashes, key=lambda h: h[1])))
+
+    modes = [("row by row", {}, row_by_row), ("insert_hashes", {}, bulk)]
+    if database_type == "mysql":
+        modes.append(("load data", {"load_data": True}, bulk))
+
+    rows = []
+    for label, mode_options, insert in modes:
+        db = get_database(database_type)(**dict(options, **mode_options))
+        db.setup()
+        total, rate = fingerprints_per_second(db, insert, library, copies)
+        rows.append((label, total, "%.0f" % rate))
+
+    print_table(("mode", "fingerprints", "fingerprints/s"), rows)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+""" Peak picker speed and accuracy report.
+
+Usage: python benchmarks/bench_peaks.py [ads_dir]
+
+For every picker in fingerprint.PEAK_PICKERS:
+  - time get_2D_peaks on each advert,
+  - compare its peaks with the original "footprint" picker,
+  - fingerprint the adverts with it and recognize 10 second excerpts,
+    clean and with white noise, against those fingerprints.
+"""
+from __future__ import print_function
+
+import numpy as np
+
+from common import (ads_dir_from_argv, load_ads, best_of, print_table,
+                    build_index, best_match, excerpts, add_noise)
+
+from tramscore import fingerprint, stft
+
+SNR_DB = 5
+
+
+def log_spectrum(samples, Fs):
+    arr2D = stft.specgram(samples, fingerprint.DEFAULT_WINDOW_SIZE,
+                          int(fingerprint.DEFAULT_WINDOW_SIZE * fingerprint.DEFAULT_OVERLAP_RATIO), Fs)
+    with np.errstate(divide="ignore"):
+        np.log10(arr2D, out=arr2D)
+    arr2D *= 10
+    arr2D[arr2D == -np.inf] = 0
+    return arr2D
+
+
+def main():
+    ads = load_ads(ads_dir_from_argv())
+    spectra = [(name, log_spectrum(channels[0], Fs)) for name, channels, Fs in ads]
+
+    reference = {}
+    for name, arr2D in spectra:
+        peaks = fingerprint.get_2D_peaks(arr2D, peak_picker=fingerprint.PEAK_PICKER_FOOTPRINT)
+        reference[name] = set(zip(*peaks))
+
+    rows = []
+    for picker in fingerprint.PEAK_PICKERS:
+        seconds = 0.0
+        found = matched = 0
+        for name, arr2D in spectra:
+            t, peaks = best_of(lambda: fingerprint.get_2D_peaks(arr2D, peak_picker=picker), repeat=3)
+            seconds += t
+            peaks = set(zip(*peaks))
+            found += len(peaks)
+            matched += len(peaks & reference[name])
+
+        index = build_index(dict(
+            (name, fingerprint.fingerprint(channels[0], Fs=Fs, peak_picker=picker))
+            for name, channels, Fs in ads))
+
+        results = {"clean": [0, 0, []], "noisy": [0, 0, []]}
+        for name, channels, Fs in ads:
+            for start, clip in excerpts(channels[0], Fs):
+                for label, samples in (("clean", clip), ("noisy", add_noise(clip, SNR_DB, seed=start))):
+                    advert, count = best_match(index, fingerprint.fingerprint(samples, Fs=Fs, peak_picker=picker))
+                    result = results[label]
+                    result[0] += 1
+                    result[1] += advert == name
+                    result[2].append(count)
+
+        total = float(sum(len(peaks) for peaks in reference.values()))
+        rows.append((picker, "%.1f" % (seconds * 1000), found,
+                     "%.1f%%" % (matched / total * 100),
+                     "%.1f%%" % (matched / float(max(found, 1)) * 100),
+                     "%d/%d" % tuple(results["clean"][:2]),
+                     "%d" % np.median(results["clean"][2]),
+                     "%d/%d" % tuple(results["noisy"][:2]),
+                     "%d" % np.median(results["noisy"][2])))
+
+    print_table(("picker", "peaks ms", "peaks", "recall", "precision",
+                 "clean hits", "median aligned", "%ddB hits" % SNR_DB, "median aligned"), rows)
+    print("\nrecall/precision are against the footprint picker, hits count "
+          "10s excerpts whose best match is the right advert")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,92 @@
+""" Postgres match query latency: a fred_unhex_bytea placeholder per hash vs
+the prepared bytea array query.
+
+Usage: python benchmarks/bench_postgres_matches.py [config]
+
+Runs against the "database" settings of a tramscore config with
+"database_type": "postgresql" (default tramscore.conf in the repository
+root) holding sha1 fingerprints. For segments of 1k, 5k and 20k hashes, half
+of them sampled from the fingerprint table and half random, it times:
+  - "per value": the former `hash IN (fred_unhex_bytea(%s), ...)` query on a
+    new connection, as return_matches ran before the pool,
+  - "prepared": PostgresDatabase.return_matches, a pooled connection and the
+    prepared `hash = ANY($1)` statement.
+"""
+from __future__ import print_function
+
+import binascii
+import json
+import os
+import random
+import sys
+
+from common import ROOT_DIR, best_of, print_table
+
+import psycopg2
+
+from tramscore.database_postgres import PostgresDatabase
+
+SEGMENT_HASHES = (1000, 5000, 20000)
+
+SAMPLE_HASHES = "SELECT %s FROM %s ORDER BY random() LIMIT %%s;" % (
+    PostgresDatabase.FIELD_HASH, PostgresDatabase.FINGERPRINTS_TABLENAME)
+
+PER_VALUE_MATCHES = "SELECT %s, %s, %s FROM %s WHERE %s IN (%%s);" % (
+    PostgresDatabase.FIELD_HASH,
+    PostgresDatabase.FIELD_ADVERT_ID,
+    PostgresDatabase.FIELD_OFFSET,
+    PostgresDatabase.FINGERPRINTS_TABLENAME,
+    PostgresDatabase.FIELD_HASH)
+
+
+def per_value(options, mapper):
+    conn = psycopg2.connect(**options)
+    try:
+        cur = conn.cursor()
+        query = PER_VALUE_MATCHES % ", ".join(["fred_unhex_bytea(%s)"] * len(mapper))
+        cur.execute(query, list(mapper.keys()))
+        rows = cur.fetchall()
+        conn.commit()
+    finally:
+        conn.close()
+    return len(rows)
+
+
+def prepared(db, mapper):
+    return len(list(db.return_matches(mapper)))
+
+
+def make_mapper(stored, count, seed=0):
+    rng = random.Random(seed)
+    hashes = rng.sample(stored, min(len(stored), count // 2))
+    while len(hashes) < count:
+        hashes.append(binascii.hexlify(os.urandom(10)).decode().upper())
+    return dict((hash, rng.randint(0, 3000)) for hash in hashes)
+
+
+def main():
+    config_path = sys.argv[1] if len(sys.argv) > 1 else os.path.join(ROOT_DIR, "tramscore.conf")
+    with open(config_path) as f:
+        options = json.load(f).get("database", {})
+
+    db = PostgresDatabase(**options)
+    connect_options = dict((key, value) for key, value in options.items()
+                           if not key.startswith("pool_"))
+
+    with db.cursor(cursor_type=None) as cur:
+        cur.execute(SAMPLE_HASHES, (max(SEGMENT_HASHES) // 2,))
+        stored = [binascii.hexlify(bytes(row[0])).decode().upper() for row in cur]
+
+    rows = []
+    for count in SEGMENT_HASHES:
+        mapper = make_mapper(stored, count)
+        before, expected = best_of(lambda: per_value(connect_options, mapper))
+        after, result = best_of(lambda: prepared(db, mapper))
+        rows.append((count, "%.1f ms" % (before * 1000), "%.1f ms" % (after * 1000),
+                     "%.1fx" % (before / after), "yes" if result == expected else "NO"))
+
+    print_table(("hashes", "per value", "prepared", "speedup", "same rows"), rows)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,65 @@
+""" Spectrogram speed: matplotlib.mlab.specgram against tramscore.stft.
+
+Usage: python benchmarks/bench_stft.py [ads_dir]
+
+Times the spectrogram + log step of fingerprint.fingerprint for every
+channel of every advert and checks both paths give the same hashes.
+"""
+from __future__ import print_function
+
+import numpy as np
+
+from common import ads_dir_from_argv, load_ads, best_of, print_table
+
+from tramscore import fingerprint, stft
+
+WSIZE = fingerprint.DEFAULT_WINDOW_SIZE
+NOVERLAP = int(fingerprint.DEFAULT_WINDOW_SIZE * fingerprint.DEFAULT_OVERLAP_RATIO)
+
+
+def log_spectrum(arr2D):
+    with np.errstate(divide="ignore"):
+        arr2D = 10 * np.log10(arr2D)
+    arr2D[arr2D == -np.inf] = 0
+    return arr2D
+
+
+def mlab_path(samples, Fs):
+    import matplotlib.mlab as mlab
+
+    return log_spectrum(mlab.specgram(samples, NFFT=WSIZE, Fs=Fs,
+                                      window=mlab.window_hanning,
+                                      noverlap=NOVERLAP)[0])
+
+
+def stft_path(samples, Fs):
+    return log_spectrum(stft.specgram(samples, WSIZE, NOVERLAP, Fs))
+
+
+def hashes(arr2D):
+    return set(fingerprint.generate_hashes(fingerprint.get_2D_peaks(arr2D)))
+
+
+def main():
+    rows = []
+    total_mlab = total_stft = 0.0
+    for name, channels, Fs in load_ads(ads_dir_from_argv()):
+        for samples in channels:
+            t_mlab, spec_mlab = best_of(lambda: mlab_path(samples, Fs))
+            t_stft, spec_stft = best_of(lambda: stft_path(samples, Fs))
+            total_mlab += t_mlab
+            total_stft += t_stft
+
+            reference = hashes(spec_mlab)
+            same = len(reference & hashes(spec_stft)) / float(max(len(reference), 1))
+            rows.append((name[:32], "%.1f" % (len(samples) / float(Fs)),
+                         "%.1f" % (t_mlab * 1000), "%.1f" % (t_stft * 1000),
+                         "%.2fx" % (t_mlab / t_stft), "%.2f%%" % (same * 100)))
+
+    print_table(("advert", "secs", "mlab ms", "stft ms", "speedup", "same hashes"), rows)
+    print("\ntotal: mlab %.1f ms, stft %.1f ms, speedup %.2fx"
+          % (total_mlab * 1000, total_stft * 1000, total_mlab / total_stft))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,110 @@
+""" Helpers shared by the benchmark scripts.
+
+Benchmarks are run from the repository root, e.g.
+
+    python benchmarks/bench_stft.py [ads_dir]
+"""
+from __future__ import print_function
+import os
+import sys
+import time
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_ADS_DIR = os.path.join(ROOT_DIR, "ads")
+
+# make the tramscore package importable without installing it
+if ROOT_DIR not in sys.path:
+    sys.path.insert(0, ROOT_DIR)
+
+
+def ads_dir_from_argv(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    return argv[0] if argv else DEFAULT_ADS_DIR
+
+
+def load_ads(directory=DEFAULT_ADS_DIR, extensions=(".mp3", ".wav")):
+    """
+    Decodes every advert in `directory`.
+
+    returns: [(name, channels, Fs), ...] sorted by name
+    """
+    from tramscore import decoder
+
+    ads = []
+    for filename, _ in decoder.find_files(directory, extensions):
+        channels, Fs, _, _ = decoder.read(filename)
+        ads.append((decoder.path_to_advertname(filename), channels, Fs))
+    return sorted(ads, key=lambda ad: ad[0])
+
+
+def best_of(func, repeat=5):
+    """
+    Runs `func` `repeat` times and returns (best seconds, last result).
+    """
+    best = None
+    result = None
+    for _ in range(repeat):
+        t = time.time()
+        result = func()
+        t = time.time() - t
+        best = t if best is None else min(best, t)
+    return best, result
+
+
+def print_table(header, rows):
+    widths = [max(len(str(x)) for x in column) for column in zip(header, *rows)]
+    line = "  ".join("%%-%ds" % w for w in widths)
+    print(line % tuple(header))
+    print(line % tuple("-" * w for w in widths))
+    for row in rows:
+        print(line % tuple(row))
+
+
+def build_index(hashes_by_advert):
+    """
+    Dictionary index {hash: [(advert, offset), ...]} over
+    {advert: [(hash, offset), ...]}, a stand-in for the database.
+    """
+    index = {}
+    for advert, hashes in hashes_by_advert.items():
+        for hash, offset in hashes:
+            index.setdefault(hash, []).append((advert, offset))
+    return index
+
+
+def best_match(index, hashes):
+    """
+    Aligns `hashes` against `index` like Tramscore.align_matches.
+
+    returns: (advert, aligned hash count) of the strongest match
+    """
+    counts = {}
+    for hash, offset in hashes:
+        for advert, db_offset in index.get(hash, ()):
+            key = (advert, db_offset - offset)
+            counts[key] = counts.get(key, 0) + 1
+    if not counts:
+        return None, 0
+    (advert, _), count = max(counts.items(), key=lambda item: item[1])
+    return advert, count
+
+
+def excerpts(samples, Fs, seconds=10, step=10):
+    """
+    Yields (start second, samples) windows of `seconds` every `step` seconds.
+    """
+    length = int(seconds * Fs)
+    for start in range(0, max(len(samples) - length, 0) + 1, int(step * Fs)):
+        yield start // Fs, samples[start:start + length]
+
+
+def add_noise(samples, snr_db, seed=0):
+    """
+    Adds white noise at `snr_db` dB below the signal power.
+    """
+    import numpy as np
+
+    samples = np.asarray(samples, dtype=np.float64)
+    power = np.mean(samples ** 2) / (10 ** (snr_db / 10.0))
+    noise = np.random.RandomState(seed).normal(0, np.sqrt(power), len(samples))
+    return np.clip(samples + noise, -32768, 32767).astype(np.int16)
@@ -0,0 +1,40 @@
+#!/usr/local/bin/python3.7
+
+import json
+import logging
+import signal
+import sys
+import warnings
+import argparse
+
+from tramscore.monitor import Monitor
+
+warnings.filterwarnings("ignore")
+
+logging.basicConfig(level=logging.INFO,
+                    format='%(asctime)s - %(levelname)s - %(threadName)s - %(message)s',
+                    datefmt='%Y-%m-%d %H:%M:%S')
+logger = logging.getLogger(__name__)
+
+DEFAULT_CONFIG_FILE = "/home/blazoninnovation/testbed/tramstest/tramscore/tramscore.conf"
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Tramscore: monitor every station of the \"monitor\" config section")
+    parser.add_argument('-c', '--config', nargs='?', default=DEFAULT_CONFIG_FILE,
+                        help='Path to configuration file')
+    args = parser.parse_args()
+
+    try:
+        with open(args.config) as f:
+            config = json.load(f)
+    except IOError as err:
+        print(("Cannot open configuration: %s. Exiting" % (str(err))))
+        sys.exit(1)
+
+    monitor = Monitor(config)
+    # `kill -HUP <pid>` after fingerprinting new adverts reloads the catalog
+    signal.signal(signal.SIGHUP, lambda signum, frame: monitor.tramscore.invalidate_adverts())
+    logger.info("Monitoring %s" % ", ".join(station.name for station in monitor.stations))
+    monitor.run()
@@ -0,0 +1,109 @@
+import collections
+
+import pytest
+
+import tramscore
+from tramscore import fingerprint
+from tramscore.database import Database
+
+
+class FakeDatabase(object):
+    """
+    Adverts, media stations and fingerprints of a database in dicts. Counts
+    the per-advert queries in `calls`.
+    """
+
+    def __init__(self, **options):
+        self.options = options
+        self.fingerprint_format = fingerprint.DEFAULT_FINGERPRINT_FORMAT
+        self.peak_picker = fingerprint.DEFAULT_PEAK_PICKER
+        self.calls = collections.Counter()
+        # advert_id: advert row without the id
+        self.adverts = {}
+        # advert_id: [media station id, ...]
+        self.media_stations = {}
+        # advert_id: [(hash, offset), ...]
+        self.hashes = {}
+        # recorded fingerprint format
+        self.stored_fingerprint_format = None
+
+    def setup(self):
+        pass
+
+    def get_adverts(self):
+        return [dict(advert, **{Database.FIELD_ADVERT_ID: advert_id})
+                for advert_id, advert in sorted(self.adverts.items())]
+
+    def get_all_client_adverts(self):
+        return self.get_adverts()
+
+    def get_all_client_advert_media_stations(self):
+        return [{Database.FIELD_ADVERT_ID: advert_id, Database.MEDIA_STATION_ID: station}
+                for advert_id, stations in sorted(self.media_stations.items())
+                for station in stations]
+
+    def get_client_advert_by_id(self, advert_id):
+        self.calls["get_client_advert_by_id"] += 1
+        return self.adverts.get(advert_id)
+
+    def get_client_advert_media_stations_by_id(self, advert_id):
+        self.calls["get_client_advert_media_stations_by_id"] += 1
+        return [{Database.MEDIA_STATION_ID: station}
+                for station in self.media_stations.get(advert_id, [])]
+
+    def add_advert(self, advert_id, advert_name, media_stations=(), **fields):
+        self.adverts[advert_id] = dict(fields, **{
+            Database.FIELD_ADVERTNAME: advert_name,
+            Database.FIELD_FILE_SHA1: "%040d" % advert_id,
+        })
+        self.media_stations[advert_id] = list(media_stations)
+
+    def insert_advert(self, advert_name, file_hash, audio_length):
+        advert_id = len(self.adverts) + 1
+        self.adverts[advert_id] = {Database.FIELD_ADVERTNAME: advert_name,
+                                   Database.FIELD_FILE_SHA1: file_hash,
+                                   Database.AUDIO_LENGTH: audio_length}
+        return advert_id
+
+    def insert_hashes(self, advert_id, hashes):
+        self.hashes.setdefault(advert_id, []).extend(hashes)
+
+    def set_advert_fingerprinted(self, advert_id):
+        pass
+
+    def return_alignments(self, mappers, limit=None, min_count=None):
+        return []
+
+    def get_num_adverts(self):
+        return len(self.adverts)
+
+    def reset_fingerprints(self):
+        self.hashes = {}
+
+    def get_stored_fingerprint_format(self):
+        return self.stored_fingerprint_format
+
+    def store_fingerprint_format(self, fingerprint_format):
+        self.stored_fingerprint_format = fingerprint_format
+
+    def before_fork(self):
+        pass
+
+    def after_fork(self):
+        pass
+
+    def close(self):
+        pass
+
+
+@pytest.fixture
+def make_tramscore(monkeypatch):
+    """
+    Builds a Tramscore on a FakeDatabase, see Tramscore.db.
+    """
+    monkeypatch.setattr(tramscore, "get_database", lambda database_type=None: FakeDatabase)
+
+    def make(**config):
+        config.setdefault("check_fingerprint_format", False)
+        return tramscore.Tramscore(config)
+    return make
@@ -0,0 +1,86 @@
+import numpy as np
+import pytest
+
+from tramscore import align
+
+
+def reference_counts(matches):
+    """
+    {(sid, diff): (count, position of its last match)}, the way the dict
+    based scorer counted.
+    """
+    counts = {}
+    for position, (sid, diff) in enumerate(matches):
+        count, _ = counts.get((sid, diff), (0, None))
+        counts[(sid, diff)] = (count + 1, position)
+    return counts
+
+
+def reference_top(matches, top_n):
+    counts = reference_counts(matches)
+    ranked = sorted(counts, key=lambda pair: (-counts[pair][0], counts[pair][1]))
+    return [(sid, diff, counts[(sid, diff)][0]) for sid, diff in ranked[:top_n]]
+
+
+def random_matches(count, adverts, diffs, seed):
+    rng = np.random.RandomState(seed)
+    return list(zip(rng.randint(0, adverts, count).tolist(),
+                    rng.randint(-diffs, diffs, count).tolist()))
+
+
+def top(matches, top_n):
+    sids, codes, diffs = align.match_arrays(matches)
+    codes, diffs, counts = align.top_alignments(codes, diffs, top_n)
+    return list(zip(sids[codes].tolist(), diffs.tolist(), counts.tolist()))
+
+
+@pytest.fixture(params=["bincount", "unique"])
+def binning(request, monkeypatch):
+    # force either way of counting the (code, diff) pairs
+    monkeypatch.setattr(align, "BINCOUNT_RANGE_FACTOR", 10 ** 9 if request.param == "bincount" else 0)
+    return request.param
+
+
+@pytest.mark.parametrize("top_n", [1, 3, 10, None])
+def test_top_alignments_match_the_dict_scorer(binning, top_n):
+    # few distinct pairs, so many counts tie
+    matches = random_matches(500, 4, 10, seed=0)
+    assert top(matches, top_n) == reference_top(matches, top_n or len(matches))
+
+
+def test_count_alignments_match_the_dict_scorer(binning):
+    matches = random_matches(300, 6, 1000, seed=1)
+    sids, codes, diffs = align.match_arrays(matches)
+    codes, diffs, counts, reached = align.count_alignments(codes, diffs)
+
+    counted = dict(((sid, diff), (count, position)) for sid, diff, count, position
+                   in zip(sids[codes].tolist(), diffs.tolist(), counts.tolist(), reached.tolist()))
+    assert counted == reference_counts(matches)
+
+
+def test_ties_go_to_the_pair_that_got_there_first(binning):
+    matches = [(2, 5), (1, 7), (1, 7), (2, 5), (3, 0)]
+    # (1, 7) reached 2 matches before (2, 5) did
+    assert top(matches, 1) == [(1, 7, 2)]
+    assert top(matches, 3) == [(1, 7, 2), (2, 5, 2), (3, 0, 1)]
+
+    matches = [(1, 7), (2, 5), (2, 5), (1, 7)]
+    assert top(matches, 1) == [(2, 5, 2)]
+
+
+def test_uuid_advert_ids():
+    matches = [("b-uuid", 3), ("a-uuid", 3), ("b-uuid", 3), ("a-uuid", -2)]
+    assert top(matches, 2) == [("b-uuid", 3, 2), ("a-uuid", 3, 1)]
+
+
+def test_no_matches():
+    assert top([], 1) == []
+    assert top(iter([]), None) == []
+
+
+def test_advert_alignments(binning):
+    # the end of advert 1 and the start of advert 2 in the same segment
+    matches = [(1, 40)] * 6 + [(2, -10)] * 4 + [(1, 12)] * 3 + [(3, 0)] * 2
+    sids, codes, diffs = align.match_arrays(matches)
+    codes, diffs, counts = align.advert_alignments(codes, diffs, min_count=3)
+    assert list(zip(sids[codes].tolist(), diffs.tolist(), counts.tolist())) == [(1, 40, 6), (2, -10, 4)]
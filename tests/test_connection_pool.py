@@ -0,0 +1,225 @@
+import pytest
+
+from tramscore import connection_pool
+
+
+class DriverError(Exception):
+    pass
+
+
+class FakeConnection(object):
+    """
+    A driver connection that records what was done to it.
+    """
+
+    def __init__(self, number):
+        self.number = number
+        self.alive = True
+        self.closed = False
+        self.pings = 0
+        self.commits = 0
+        self.rollbacks = 0
+        self.fail = None
+
+    def ping(self):
+        self.pings += 1
+        if not self.alive:
+            raise DriverError("gone away")
+
+    def commit(self):
+        if self.fail == "commit":
+            raise DriverError("commit failed")
+        self.commits += 1
+
+    def rollback(self):
+        if self.fail == "rollback":
+            raise DriverError("rollback failed")
+        self.rollbacks += 1
+
+    def close(self):
+        self.closed = True
+
+
+class FakePool(connection_pool.ConnectionPool):
+    Error = DriverError
+    name = "FAKE"
+
+    def __init__(self, *args, **kwargs):
+        super(FakePool, self).__init__(*args, **kwargs)
+        self.opened = []
+
+    def connect(self):
+        conn = FakeConnection(len(self.opened))
+        self.opened.append(conn)
+        return conn
+
+    def ping(self, conn):
+        conn.ping()
+
+    def closed(self, conn):
+        return conn.closed
+
+
+class FakeCursor(object):
+
+    def __init__(self):
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+
+class FakePooledCursor(connection_pool.PooledCursor):
+
+    def open(self, conn):
+        return FakeCursor()
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(connection_pool.time, "time", lambda: now[0])
+    return now
+
+
+def test_idle_connections_are_pinged_and_reused():
+    pool = FakePool()
+    conn = pool.checkout()
+    pool.checkin(conn)
+
+    assert pool.checkout() is conn
+    assert conn.pings == 1
+    assert len(pool.opened) == 1
+
+
+def test_dead_connections_are_replaced():
+    pool = FakePool()
+    conn = pool.checkout()
+    pool.checkin(conn)
+    conn.alive = False
+
+    replacement = pool.checkout()
+    assert replacement is not conn
+    assert conn.closed
+    assert len(pool.opened) == 2
+
+
+def test_connections_expire_after_max_idle(clock):
+    pool = FakePool(max_idle=60)
+    conn = pool.checkout()
+    pool.checkin(conn)
+
+    clock[0] += 30
+    assert pool.checkout() is conn
+    pool.checkin(conn)
+
+    clock[0] += 61
+    assert pool.checkout() is not conn
+    assert conn.closed
+    # expired connections are not pinged
+    assert conn.pings == 1
+
+
+def test_at_most_size_connections_are_kept():
+    pool = FakePool(size=2)
+    conns = [pool.checkout() for _ in range(3)]
+    for conn in conns:
+        pool.checkin(conn)
+
+    assert [conn.closed for conn in conns] == [False, False, True]
+    # the most recently returned first
+    assert pool.checkout() is conns[1]
+    assert pool.checkout() is conns[0]
+    assert pool.checkout() not in conns
+
+
+def test_closed_connections_are_not_kept():
+    pool = FakePool()
+    conn = pool.checkout()
+    conn.close()
+    pool.checkin(conn)
+    assert pool.checkout() is not conn
+
+
+def test_cursor_commits_and_returns_the_connection():
+    pool = FakePool()
+    with FakePooledCursor(pool=pool) as cur:
+        pass
+    conn = pool.opened[0]
+    assert cur.closed
+    assert conn.commits == 1
+    assert pool.checkout() is conn
+
+
+def test_cursor_rolls_back_on_errors():
+    pool = FakePool()
+    with pytest.raises(KeyError):
+        with FakePooledCursor(pool=pool):
+            raise KeyError("query failed")
+    conn = pool.opened[0]
+    assert (conn.commits, conn.rollbacks) == (0, 1)
+    assert pool.checkout() is conn
+
+
+def test_failed_commit_discards_the_connection():
+    pool = FakePool()
+    conn = pool.checkout()
+    conn.fail = "commit"
+    pool.checkin(conn)
+
+    with pytest.raises(DriverError):
+        with FakePooledCursor(pool=pool):
+            pass
+    assert conn.closed
+    assert pool.checkout() is not conn
+
+
+def test_failed_rollback_discards_the_connection():
+    pool = FakePool()
+    conn = pool.checkout()
+    conn.fail = "rollback"
+    pool.checkin(conn)
+
+    # the error of the block is the one raised
+    with pytest.raises(KeyError):
+        with FakePooledCursor(pool=pool):
+            raise KeyError("query failed")
+    assert conn.closed
+    assert pool.checkout() is not conn
+
+
+def test_forked_child_starts_empty(monkeypatch):
+    pool = FakePool()
+    idle = pool.checkout()
+    busy = pool.checkout()
+    pool.checkin(idle)
+    # a thread of the parent held the lock at the fork
+    pool._lock.acquire()
+
+    child_pid = pool._pid + 1
+    monkeypatch.setattr(connection_pool.os, "getpid", lambda: child_pid)
+    conn = pool.checkout()
+    assert conn not in (idle, busy)
+    # the parent's connections are neither used nor closed
+    assert idle.pings == 0
+    assert not idle.closed
+    assert pool._inherited == [idle]
+
+    # returning one taken out before the fork leaves it alone
+    pool.checkin(busy)
+    assert not busy.closed
+    pool.checkin(conn)
+    assert pool.checkout() is conn
+
+
+def test_reset_all_resets_every_pool(monkeypatch):
+    monkeypatch.setattr(connection_pool.ConnectionPool, "_pools", {})
+    pool = FakePool.get(host="reset-all-test")
+    assert FakePool.get(host="reset-all-test") is pool
+    conn = pool.checkout()
+    pool.checkin(conn)
+
+    connection_pool.ConnectionPool.reset_all()
+    assert pool._inherited == [conn]
+    assert pool.checkout() is not conn
+    assert not conn.closed
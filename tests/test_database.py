@@ -0,0 +1,158 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pytest
+
+from tramscore import align
+from tramscore.database import Database, lookup_chunks
+
+
+def echo(chunk):
+    return [value * 10 for value in chunk]
+
+
+def test_chunks_in_order_without_executor():
+    calls = []
+
+    def lookup(chunk):
+        calls.append(list(chunk))
+        return echo(chunk)
+
+    assert list(lookup_chunks(lookup, list(range(7)), 3)) == [0, 10, 20, 30, 40, 50, 60]
+    assert calls == [[0, 1, 2], [3, 4, 5], [6]]
+    assert list(lookup_chunks(lookup, [], 3)) == []
+
+
+def test_chunks_yield_as_they_complete():
+    release_first = threading.Event()
+
+    def lookup(chunk):
+        if chunk[0] == 0:
+            # the first chunk waits for the second one to be consumed
+            assert release_first.wait(5)
+        return echo(chunk)
+
+    with ThreadPoolExecutor(2) as executor:
+        results = lookup_chunks(lookup, [0, 1, 2, 3], 2, executor)
+        assert next(results) == 20
+        assert next(results) == 30
+        release_first.set()
+        assert list(results) == [0, 10]
+
+
+def test_every_item_once_with_executor():
+    values = list(range(1000))
+    with ThreadPoolExecutor(4) as executor:
+        results = list(lookup_chunks(echo, values, 7, executor))
+    assert sorted(results) == [value * 10 for value in values]
+
+
+def test_a_single_chunk_runs_in_the_caller():
+    threads = []
+
+    def lookup(chunk):
+        threads.append(threading.current_thread())
+        return echo(chunk)
+
+    with ThreadPoolExecutor(2) as executor:
+        assert list(lookup_chunks(lookup, [1, 2], 5, executor)) == [10, 20]
+    assert threads == [threading.current_thread()]
+
+
+def test_stopping_early_cancels_pending_lookups():
+    started = []
+
+    def lookup(chunk):
+        started.append(chunk[0])
+        time.sleep(0.01)
+        return echo(chunk)
+
+    with ThreadPoolExecutor(1) as executor:
+        results = lookup_chunks(lookup, list(range(20)), 1, executor)
+        assert next(results) == 0
+        results.close()
+    # at most the lookup running when the consumer stopped finished
+    assert len(started) <= 2
+
+
+def test_a_failed_lookup_cancels_the_rest():
+    started = []
+
+    def lookup(chunk):
+        started.append(chunk[0])
+        if chunk[0] == 0:
+            raise RuntimeError("lookup failed")
+        time.sleep(0.01)
+        return echo(chunk)
+
+    with ThreadPoolExecutor(1) as executor:
+        with pytest.raises(RuntimeError):
+            list(lookup_chunks(lookup, list(range(20)), 1, executor))
+    assert len(started) <= 2
+
+
+class ChannelMatches(object):
+    """
+    Only the return_matches of a database: the matches of channel i for
+    the mapper {"channel": i}.
+    """
+
+    def __init__(self, channels):
+        self.channels = channels
+
+    def return_matches(self, mapper):
+        return self.channels[mapper["channel"]]
+
+
+def channel_matches(nchannels=2, seed=0):
+    rng = np.random.RandomState(seed)
+    # few distinct pairs so counts tie, and string advert ids
+    return [list(zip(["advert-%d" % sid for sid in rng.randint(0, 4, 300).tolist()],
+                     rng.randint(-8, 8, 300).tolist()))
+            for _ in range(nchannels)]
+
+
+def top_alignments(matches, limit=None, min_count=None):
+    sids, codes, diffs = align.match_arrays(matches)
+    codes, diffs, counts = align.top_alignments(codes, diffs, None)
+    alignments = list(zip(sids[codes].tolist(), diffs.tolist(), counts.tolist()))
+    return [alignment for alignment in alignments
+            if min_count is None or alignment[2] >= min_count][:limit]
+
+
+def fallback_alignments(channels, **options):
+    mappers = [{"channel": i} for i in range(len(channels))]
+    return Database.return_alignments(ChannelMatches(channels), mappers, **options)
+
+
+@pytest.mark.parametrize("limit", [None, 1, 5])
+@pytest.mark.parametrize("min_count", [None, 1, 12, 10 ** 6])
+def test_return_alignments_fallback_matches_top_alignments(limit, min_count):
+    channels = channel_matches()
+    matches = channels[0] + channels[1]
+    alignments = fallback_alignments(channels, limit=limit, min_count=min_count)
+    assert alignments == top_alignments(matches, limit, min_count)
+    if limit is not None:
+        assert len(alignments) <= limit
+    assert all(count >= (min_count or 1) for _, _, count in alignments)
+
+
+def test_return_alignments_fallback_counts_every_channel():
+    channels = channel_matches(seed=1)
+    counts = {}
+    for match in channels[0] + channels[1]:
+        counts[match] = counts.get(match, 0) + 1
+
+    alignments = fallback_alignments(channels)
+    assert dict(((sid, diff), count) for sid, diff, count in alignments) == counts
+    assert [count for _, _, count in alignments] == sorted(counts.values(), reverse=True)
+    # limit=1 is the strongest pair
+    assert fallback_alignments(channels, limit=1) == alignments[:1]
+
+
+def test_return_alignments_fallback_without_matches():
+    assert fallback_alignments([[], []]) == []
+    assert fallback_alignments([[], []], limit=1) == []
+    assert fallback_alignments([], min_count=3) == []
@@ -0,0 +1,157 @@
+import numpy as np
+import pytest
+
+from tramscore import database_memory, fingerprint
+from tramscore.database import Database
+from tramscore.fingerprint_index import IndexFile
+
+
+class StandInBackend(object):
+    """
+    The advert and fingerprint reads and writes of a backend database,
+    from a dict.
+    """
+
+    def __init__(self, **options):
+        self.fingerprint_format = fingerprint.FINGERPRINT_FORMAT_PACKED64
+        # {sid: [(hash, offset), ...]}
+        self.fingerprints = {}
+
+    def get_adverts(self):
+        return [{Database.FIELD_ADVERT_ID: sid} for sid in sorted(self.fingerprints)]
+
+    def get_fingerprints(self, sid=None):
+        for advert, hashes in sorted(self.fingerprints.items()):
+            if sid is None or sid == advert:
+                for hash, offset in hashes:
+                    yield hash, advert, offset
+
+    def insert_hashes(self, sid, hashes):
+        self.fingerprints.setdefault(sid, []).extend(hashes)
+
+    def set_advert_fingerprinted(self, sid):
+        pass
+
+
+def packed_hashes(count, seed):
+    rng = np.random.RandomState(seed)
+    return list(zip(rng.randint(0, 1 << 40, count).tolist(), rng.randint(0, 1000, count).tolist()))
+
+
+@pytest.fixture
+def backend(monkeypatch):
+    backend = StandInBackend()
+    monkeypatch.setattr(database_memory, "get_database", lambda backend_type: lambda **options: backend)
+    backend.fingerprints = {1: packed_hashes(40, 1), 2: packed_hashes(30, 2)}
+    return backend
+
+
+@pytest.fixture(params=[False, True], ids=["memory", "index_file"])
+def index_file(request, tmpdir):
+    return str(tmpdir.join("fingerprints.idx")) if request.param else None
+
+
+def expected_matches(backend, mapper):
+    return sorted((sid, offset - mapper[hash])
+                  for sid, hashes in backend.fingerprints.items()
+                  for hash, offset in hashes if hash in mapper)
+
+
+def query_of(backend, sample_offset=5):
+    # a few hashes of every advert and one nobody has
+    mapper = dict((hash, sample_offset) for hashes in backend.fingerprints.values()
+                  for hash, _ in hashes[:3])
+    mapper[1 << 50] = sample_offset
+    return mapper
+
+
+def test_return_matches(backend, index_file):
+    db = database_memory.MemoryDatabase(index_file=index_file)
+    db.get_adverts()
+    mapper = query_of(backend)
+    assert sorted(db.return_matches(mapper)) == expected_matches(backend, mapper)
+    assert db.return_matches({}) == []
+    assert (db._file is not None) == bool(index_file)
+
+
+def test_sync_adds_and_removes_adverts(backend, index_file):
+    db = database_memory.MemoryDatabase(index_file=index_file)
+    db.get_adverts()
+
+    # fingerprinted by another process
+    backend.fingerprints[3] = packed_hashes(20, 3)
+    db.get_adverts()
+    mapper = query_of(backend)
+    assert sorted(db.return_matches(mapper)) == expected_matches(backend, mapper)
+
+    del backend.fingerprints[1]
+    db.get_adverts()
+    assert sorted(db.return_matches(mapper)) == expected_matches(backend, mapper)
+    assert 1 not in [sid for sid, _ in db.return_matches(mapper)]
+
+
+def test_inserted_adverts_are_written_to_the_index_file(backend, tmpdir):
+    path = str(tmpdir.join("fingerprints.idx"))
+    db = database_memory.MemoryDatabase(index_file=path)
+    db.get_adverts()
+
+    hashes = packed_hashes(20, 3)
+    db.insert_hashes(3, hashes)
+    db.set_advert_fingerprinted(3)
+    # in memory until the catalog is reloaded
+    assert len(db._index) == 20
+    assert sorted(IndexFile.open(path, db.index_options()).sids.tolist()) == [1, 2]
+
+    db.get_adverts()
+    assert len(db._index) == 0
+    assert sorted(IndexFile.open(path, db.index_options()).sids.tolist()) == [1, 2, 3]
+    mapper = query_of(backend)
+    assert sorted(db.return_matches(mapper)) == expected_matches(backend, mapper)
+
+
+def test_sync_switches_to_a_replaced_index_file(backend, tmpdir):
+    path = str(tmpdir.join("fingerprints.idx"))
+    writer = database_memory.MemoryDatabase(index_file=path)
+    reader = database_memory.MemoryDatabase(index_file=path)
+    writer.get_adverts()
+    reader.get_adverts()
+    opened = reader._file
+
+    writer.insert_hashes(3, packed_hashes(20, 3))
+    writer.set_advert_fingerprinted(3)
+    writer.get_adverts()
+
+    assert opened.replaced()
+    reader.get_adverts()
+    assert reader._file is not opened
+    assert sorted(reader._file.sids.tolist()) == [1, 2, 3]
+    # advert 3 comes from the new file, not from the backend
+    assert len(reader._index) == 0
+    mapper = query_of(backend)
+    assert sorted(reader.return_matches(mapper)) == expected_matches(backend, mapper)
+
+
+def test_write_index_file_merges_and_renumbers(backend, tmpdir):
+    path = str(tmpdir.join("fingerprints.idx"))
+    db = database_memory.MemoryDatabase(index_file=path)
+    db.get_adverts()
+
+    # codes handed out to adverts that never got fingerprints leave gaps
+    db._code(7)
+    db._code(8)
+    db.insert_hashes(4, packed_hashes(10, 4))
+    db.insert_hashes(3, packed_hashes(20, 3))
+    # dropped from the file, but its rows are still mapped
+    del backend.fingerprints[1]
+    db._file = db._file.without([1])
+
+    db.write_index_file()
+    index_file = IndexFile.open(path, db.index_options())
+    assert sorted(index_file.sids.tolist()) == [2, 3, 4]
+    assert sorted(np.unique(index_file.index.codes).tolist()) == [0, 1, 2]
+    assert len(index_file.index) == 60
+    assert db._file.excluded == frozenset()
+    assert len(db._index) == 0
+
+    mapper = query_of(backend)
+    assert sorted(db.return_matches(mapper)) == expected_matches(backend, mapper)
@@ -0,0 +1,152 @@
+import binascii
+import contextlib
+import struct
+import uuid
+
+import pytest
+
+pytest.importorskip("psycopg2")
+
+from tramscore import fingerprint  # noqa: E402
+from tramscore.database_postgres import PostgresDatabase  # noqa: E402
+
+SID = uuid.UUID("0f8fad5b-d9cb-469f-a165-70867728950e")
+
+
+class FakeCursor(object):
+    """
+    Records the statements and COPY data sent through it.
+    """
+
+    def __init__(self):
+        self.statements = []
+        self.copies = []
+
+    def execute(self, query, params=None):
+        self.statements.append(query)
+
+    def copy_expert(self, query, data):
+        self.copies.append((query, data.read()))
+
+
+def fake_db(fingerprint_format=fingerprint.FINGERPRINT_FORMAT_SHA1, **options):
+    db = PostgresDatabase(host="fake", **options)
+    db.fingerprint_format = fingerprint_format
+    db.fake_cursor = FakeCursor()
+
+    @contextlib.contextmanager
+    def cursor(cursor_type=None):
+        yield db.fake_cursor
+    db.cursor = cursor
+    return db
+
+
+def parse_copy(data):
+    """
+    Decodes binary COPY data the way the server does.
+
+    returns: [(field bytes, ...), ...]
+    """
+    assert data[:11] == b"PGCOPY\n\xff\r\n\x00"
+    flags, extension = struct.unpack(">ii", data[11:19])
+    assert (flags, extension) == (0, 0)
+    position = 19 + extension
+    rows = []
+    while True:
+        (nfields,) = struct.unpack(">h", data[position:position + 2])
+        position += 2
+        if nfields == -1:
+            break
+        row = []
+        for _ in range(nfields):
+            (size,) = struct.unpack(">i", data[position:position + 4])
+            position += 4
+            row.append(data[position:position + size])
+            position += size
+        rows.append(tuple(row))
+    assert position == len(data)
+    return rows
+
+
+def test_sha1_copy_rows():
+    db = fake_db()
+    hashes = [("0123456789abcdef0123", 0), ("fedcba9876543210fedc", 7), ("00000000000000000000", 2 ** 40)]
+    rows = parse_copy(db._copy_data(SID, hashes))
+
+    assert rows == [(binascii.unhexlify(hash), SID.bytes, struct.pack(">q", offset))
+                    for hash, offset in hashes]
+
+
+@pytest.mark.parametrize("fingerprint_format", [fingerprint.FINGERPRINT_FORMAT_PACKED32,
+                                                fingerprint.FINGERPRINT_FORMAT_PACKED64])
+def test_packed_copy_rows(fingerprint_format):
+    db = fake_db(fingerprint_format)
+    hashes = [(0, 1), (123456789, 2), (2 ** 63 - 1, 3)]
+    rows = parse_copy(db._copy_data(str(SID), hashes))
+
+    assert rows == [(struct.pack(">q", key), SID.bytes, struct.pack(">q", offset))
+                    for key, offset in hashes]
+
+
+def test_insert_hashes_copies_in_chunks():
+    db = fake_db(insert_chunk_size=2)
+    hashes = [("%020x" % i, i) for i in range(5)]
+    db.insert_hashes(SID, hashes)
+
+    cur = db.fake_cursor
+    assert cur.statements == [db.CREATE_FINGERPRINTS_COPY_TABLE, db.INSERT_COPIED_FINGERPRINTS]
+    assert [query for query, _ in cur.copies] == [db.COPY_FINGERPRINTS] * 3
+    rows = [row for _, data in cur.copies for row in parse_copy(data)]
+    assert [(binascii.hexlify(key).decode("ascii"), struct.unpack(">q", offset)[0])
+            for key, _, offset in rows] == hashes
+
+
+def test_insert_packed_hashes_uses_the_packed_table():
+    db = fake_db(fingerprint.FINGERPRINT_FORMAT_PACKED32)
+    db.insert_hashes(SID, [(5, 1)])
+
+    cur = db.fake_cursor
+    assert cur.statements == [db.CREATE_PACKED_FINGERPRINTS_COPY_TABLE,
+                              db.INSERT_COPIED_PACKED_FINGERPRINTS]
+    assert [query for query, _ in cur.copies] == [db.COPY_PACKED_FINGERPRINTS]
+
+
+def packed_lookup_db(**options):
+    db = fake_db(fingerprint.FINGERPRINT_FORMAT_PACKED32, lookup_chunk_size=2, **options)
+    stored = {1: [(SID, 10)], 2: [(SID, 12)], 3: [], 4: [(SID, 20), (SID, 30)], 5: [(SID, 7)]}
+    db._lookup_matches = lambda offsets, keys: [(sid, offset - offsets[key])
+                                                for key in keys for sid, offset in stored[key]]
+    return db
+
+
+def test_return_matches_in_chunks():
+    db = packed_lookup_db(lookup_workers=3)
+    mapper = {1: 0, 2: 2, 3: 5, 4: 10, 5: 7}
+    assert sorted(db.return_matches(mapper)) == [(SID, 0), (SID, 10), (SID, 10), (SID, 10), (SID, 20)]
+    db.close()
+
+
+def test_one_lookup_executor_per_database():
+    db = packed_lookup_db(lookup_workers=3)
+    executor = db.lookup_executor(db.lookup_workers)
+    assert executor._max_workers == 3
+
+    for _ in range(5):
+        list(db.return_matches({1: 0, 2: 0, 4: 0}))
+        assert db.lookup_executor(db.lookup_workers) is executor
+
+    db.before_fork()
+    with pytest.raises(RuntimeError):
+        # shut down
+        executor.submit(len, [])
+    db.after_fork()
+    assert db.lookup_executor(db.lookup_workers) not in (None, executor)
+
+    db.close()
+    assert db._lookup_executor is None
+
+
+def test_no_executor_for_one_lookup_worker():
+    db = packed_lookup_db(lookup_workers=1)
+    assert db.lookup_executor(db.lookup_workers) is None
+    assert sorted(db.return_matches({1: 0, 5: 0})) == [(SID, 7), (SID, 10)]
@@ -0,0 +1,124 @@
+import subprocess
+import types
+
+import numpy as np
+import pytest
+
+from tramscore import decoder
+
+
+class FakeStdout(object):
+    """
+    ffmpeg's stdout, handing out `data` a few bytes at a time.
+    """
+
+    def __init__(self, data, chunk_size=30000):
+        self.data = data
+        self.chunk_size = chunk_size
+        self.position = 0
+        self.reads = []
+        self.closed = False
+
+    def readinto(self, buffer):
+        self.reads.append(len(buffer))
+        chunk = self.data[self.position:self.position + min(self.chunk_size, len(buffer))]
+        buffer[:len(chunk)] = chunk
+        self.position += len(chunk)
+        return len(chunk)
+
+    def close(self):
+        self.closed = True
+
+
+class FakePopen(object):
+    """
+    Records the started ffmpeg processes, see fake_ffmpeg.
+    """
+    started = []
+    output = b""
+    returncode = 0
+
+    def __init__(self, command, stdout=None, stdin=None):
+        self.command = command
+        self.stdout = FakeStdout(FakePopen.output)
+        self.waited = False
+        FakePopen.started.append(self)
+
+    def wait(self):
+        self.waited = True
+        return FakePopen.returncode
+
+
+@pytest.fixture
+def fake_ffmpeg(monkeypatch):
+    FakePopen.started = []
+    FakePopen.output = b""
+    FakePopen.returncode = 0
+    # only decoder's view of subprocess, numpy.testing runs lscpu with it
+    monkeypatch.setattr(decoder, "subprocess", types.SimpleNamespace(
+        Popen=FakePopen, PIPE=subprocess.PIPE, DEVNULL=subprocess.DEVNULL))
+    return FakePopen
+
+
+def pcm(nsamples, seed=0):
+    return np.random.RandomState(seed).randint(-2 ** 15, 2 ** 15, nsamples).astype("<i2")
+
+
+def test_decode_ffmpeg_grows_the_buffer(tmpdir, fake_ffmpeg):
+    path = tmpdir.join("advert.mp3")
+    path.write(b"x" * 100)
+    samples = pcm(3 * 44100 + 7)
+    fake_ffmpeg.output = samples.tobytes()
+
+    channels, fs, audio_length = decoder.decode_ffmpeg(str(path), Fs=44100)
+    assert fs == 44100
+    assert len(channels) == 1
+    np.testing.assert_array_equal(channels[0], samples)
+    assert audio_length == pytest.approx(len(samples) / 44100.0)
+
+    process = fake_ffmpeg.started[0]
+    assert "-t" not in process.command
+    assert process.command[process.command.index("-i") + 1] == str(path)
+    # a small file starts from one second of PCM, doubled when full
+    assert process.stdout.reads[0] == 44100 * 2
+    assert process.stdout.closed and process.waited
+
+
+def test_decode_ffmpeg_limit(tmpdir, fake_ffmpeg):
+    path = tmpdir.join("advert.mp3")
+    path.write(b"x" * 10 ** 6)
+    samples = pcm(2 * 8000)
+    fake_ffmpeg.output = samples.tobytes()
+
+    channels, fs, audio_length = decoder.decode_ffmpeg(str(path), limit=2, Fs=8000)
+    np.testing.assert_array_equal(channels[0], samples)
+    assert audio_length == 2.0
+
+    command = fake_ffmpeg.started[0].command
+    assert command[command.index("-t") + 1] == "2"
+    assert command[command.index("-ar") + 1] == "8000"
+    # the buffer holds the limit, not the size of the file
+    assert fake_ffmpeg.started[0].stdout.reads[0] == 2 * 8000 * 2
+
+
+def test_decode_ffmpeg_failure(tmpdir, fake_ffmpeg):
+    path = tmpdir.join("broken.mp3")
+    path.write(b"x" * 100)
+    fake_ffmpeg.returncode = 1
+
+    with pytest.raises(IOError):
+        decoder.decode_ffmpeg(str(path))
+    process = fake_ffmpeg.started[0]
+    assert process.stdout.closed and process.waited
+
+
+def test_ffmpeg_decoder_reads_and_hashes(tmpdir, fake_ffmpeg):
+    path = tmpdir.join("advert.mp3")
+    path.write(b"x" * 100)
+    samples = pcm(44100)
+    fake_ffmpeg.output = samples.tobytes()
+
+    channels, fs, file_hash, audio_length = decoder.read(str(path), decoder=decoder.DECODER_FFMPEG)
+    np.testing.assert_array_equal(channels[0], samples)
+    assert file_hash == decoder.unique_hash(str(path))
+    assert audio_length == 1.0
@@ -0,0 +1,158 @@
+import numpy as np
+import pytest
+
+from tramscore import fingerprint, stft
+
+
+def random_peaks(count=300, frames=400, freqs=2049, seed=0):
+    rng = np.random.RandomState(seed)
+    return list(zip(rng.randint(0, freqs, count).tolist(),
+                    rng.randint(0, frames, count).tolist()))
+
+
+def test_hash_engines_agree():
+    peaks = random_peaks()
+    loop = list(fingerprint.generate_hashes(peaks, hash_engine=fingerprint.HASH_ENGINE_LOOP))
+    vectorized = fingerprint.generate_hashes(peaks, hash_engine=fingerprint.HASH_ENGINE_NUMPY)
+    assert loop
+    assert loop == vectorized
+
+
+def test_hash_engines_without_peaks():
+    for hash_engine in fingerprint.HASH_ENGINES:
+        assert list(fingerprint.generate_hashes([], hash_engine=hash_engine)) == []
+
+
+def test_unknown_hash_engine():
+    with pytest.raises(ValueError):
+        fingerprint.generate_hashes(random_peaks(), hash_engine="fortran")
+
+
+@pytest.mark.parametrize("fingerprint_format", [fingerprint.FINGERPRINT_FORMAT_PACKED32,
+                                                fingerprint.FINGERPRINT_FORMAT_PACKED64])
+def test_packed_hash_engines_agree(fingerprint_format):
+    peaks = random_peaks(freqs=2048, frames=200)
+    loop = list(fingerprint.generate_hashes(peaks, hash_engine=fingerprint.HASH_ENGINE_LOOP,
+                                            fingerprint_format=fingerprint_format))
+    vectorized = fingerprint.generate_hashes(peaks, hash_engine=fingerprint.HASH_ENGINE_NUMPY,
+                                             fingerprint_format=fingerprint_format)
+    assert loop
+    assert [(key, int(offset)) for key, offset in loop] == vectorized
+
+
+@pytest.mark.parametrize("fingerprint_format", sorted(fingerprint.PACKED_LAYOUTS))
+def test_pack_unpack_round_trip(fingerprint_format):
+    f1_bits, f2_bits, dt_bits = fingerprint.PACKED_LAYOUTS[fingerprint_format]
+    rng = np.random.RandomState(0)
+    freq1 = rng.randint(0, 1 << f1_bits, 1000).astype(np.int64)
+    freq2 = rng.randint(0, 1 << f2_bits, 1000).astype(np.int64)
+    t_delta = rng.randint(0, 1 << dt_bits, 1000).astype(np.int64)
+    # the largest value of every field
+    freq1[0], freq2[0], t_delta[0] = (1 << f1_bits) - 1, (1 << f2_bits) - 1, (1 << dt_bits) - 1
+
+    keys = fingerprint.pack_hashes(freq1, freq2, t_delta, fingerprint_format)
+    assert keys.min() >= 0
+    assert keys.max() < 1 << (f1_bits + f2_bits + dt_bits)
+    for unpacked, field in zip(fingerprint.unpack_hashes(keys, fingerprint_format),
+                               (freq1, freq2, t_delta)):
+        np.testing.assert_array_equal(unpacked, field)
+
+
+def test_pack_scalars():
+    key = fingerprint.pack_hashes(3, 5, 7, fingerprint.FINGERPRINT_FORMAT_PACKED32)
+    assert key == (3 << 20) | (5 << 8) | 7
+    assert fingerprint.unpack_hashes(key, fingerprint.FINGERPRINT_FORMAT_PACKED32) == (3, 5, 7)
+
+
+@pytest.mark.parametrize("fingerprint_format", sorted(fingerprint.PACKED_LAYOUTS))
+@pytest.mark.parametrize("field", range(3))
+def test_pack_rejects_values_out_of_range(fingerprint_format, field):
+    bits = fingerprint.PACKED_LAYOUTS[fingerprint_format][field]
+    for bad in (1 << bits, -1):
+        values = [np.array([1, 2], dtype=np.int64) for _ in range(3)]
+        values[field][1] = bad
+        with pytest.raises(ValueError):
+            fingerprint.pack_hashes(*values, fingerprint_format=fingerprint_format)
+
+
+def test_packed32_loop_engine_rejects_high_frequencies():
+    peaks = (np.array([4096, 10], dtype=np.int64), np.array([0, 1], dtype=np.int64))
+    for hash_engine in fingerprint.HASH_ENGINES:
+        with pytest.raises(ValueError):
+            list(fingerprint.generate_hashes(peaks, hash_engine=hash_engine,
+                                             fingerprint_format=fingerprint.FINGERPRINT_FORMAT_PACKED32))
+
+
+def noise_spectrogram(seconds=3, seed=0):
+    rng = np.random.RandomState(seed)
+    t = np.arange(seconds * fingerprint.DEFAULT_FS) / float(fingerprint.DEFAULT_FS)
+    samples = rng.randn(len(t)) * 300 + 3000 * np.sin(2 * np.pi * 440 * t)
+    # a silent second gives the flat zero background
+    samples[fingerprint.DEFAULT_FS:2 * fingerprint.DEFAULT_FS] = 0
+    arr2D = stft.specgram(samples.astype(np.int16), fingerprint.DEFAULT_WINDOW_SIZE,
+                          int(fingerprint.DEFAULT_WINDOW_SIZE * fingerprint.DEFAULT_OVERLAP_RATIO),
+                          fingerprint.DEFAULT_FS)
+    # the log scale of fingerprint.fingerprint
+    with np.errstate(divide="ignore"):
+        arr2D = 10 * np.log10(arr2D)
+    arr2D[arr2D == -np.inf] = 0
+    return arr2D
+
+
+def test_diamond_picks_the_footprint_peaks():
+    arr2D = noise_spectrogram()
+    footprint = fingerprint.get_2D_peaks(arr2D, peak_picker=fingerprint.PEAK_PICKER_FOOTPRINT)
+    diamond = fingerprint.get_2D_peaks(arr2D, peak_picker=fingerprint.PEAK_PICKER_DIAMOND)
+
+    assert len(footprint[0])
+    for expected, actual in zip(footprint, diamond):
+        np.testing.assert_array_equal(actual, expected)
+
+
+def test_diamond_matches_footprint_at_the_edges():
+    arr2D = np.random.RandomState(3).rand(60, 45) * 100
+    footprint = fingerprint.get_2D_peaks(arr2D, peak_picker=fingerprint.PEAK_PICKER_FOOTPRINT)
+    diamond = fingerprint.get_2D_peaks(arr2D, peak_picker=fingerprint.PEAK_PICKER_DIAMOND)
+    for expected, actual in zip(footprint, diamond):
+        np.testing.assert_array_equal(actual, expected)
+
+
+def test_peaks_are_loud_local_maxima():
+    arr2D = noise_spectrogram(seed=1)
+    for peak_picker in fingerprint.PEAK_PICKERS:
+        freqs, times = fingerprint.get_2D_peaks(arr2D, peak_picker=peak_picker)
+        assert len(freqs)
+        assert (arr2D[freqs, times] > fingerprint.DEFAULT_AMP_MIN).all()
+        # ordered by frequency then time
+        assert (np.lexsort((times, freqs)) == np.arange(len(freqs))).all()
+
+
+@pytest.mark.parametrize("fingerprint_format", fingerprint.FINGERPRINT_FORMATS)
+def test_hash_engines_take_index_arrays(fingerprint_format):
+    pairs = random_peaks(freqs=2048, frames=200)
+    freqs, times = (np.array(idx, dtype=np.int64) for idx in zip(*pairs))
+    for hash_engine in fingerprint.HASH_ENGINES:
+        hashes = list(fingerprint.generate_hashes((freqs, times), hash_engine=hash_engine,
+                                                  fingerprint_format=fingerprint_format))
+        assert hashes == list(fingerprint.generate_hashes(pairs, hash_engine=hash_engine,
+                                                          fingerprint_format=fingerprint_format))
+
+
+@pytest.mark.parametrize("fingerprint_format", fingerprint.FINGERPRINT_FORMATS)
+def test_hash_engines_skip_the_pairs_before_first_target(fingerprint_format):
+    pairs = sorted(random_peaks(freqs=2048, frames=200), key=lambda peak: peak[1])
+    for hash_engine in fingerprint.HASH_ENGINES:
+        everything = list(fingerprint.generate_hashes(pairs, hash_engine=hash_engine,
+                                                      fingerprint_format=fingerprint_format))
+        new = list(fingerprint.generate_hashes(pairs, hash_engine=hash_engine,
+                                               fingerprint_format=fingerprint_format,
+                                               first_target=100))
+        old = list(fingerprint.generate_hashes(pairs[:100], hash_engine=hash_engine,
+                                               fingerprint_format=fingerprint_format))
+        assert sorted(old + new) == sorted(everything)
+        assert len(new) < len(everything)
+
+
+def test_unknown_peak_picker():
+    with pytest.raises(ValueError):
+        fingerprint.get_2D_peaks(np.zeros((4, 4)), peak_picker="circle")
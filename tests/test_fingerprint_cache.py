@@ -0,0 +1,99 @@
+import os
+
+import numpy as np
+import pytest
+
+from tramscore import fingerprint
+from tramscore.fingerprint_cache import CACHE_SUFFIX, FingerprintCache
+
+OPTIONS = {"fingerprint_format": "sha1", "peak_picker": "diamond", "decoder": "pydub"}
+
+
+def hashes(count, seed=0):
+    rng = np.random.RandomState(seed)
+    keys = np.array([b"%020x" % key for key in rng.randint(0, 2 ** 30, count)])
+    return keys, np.arange(count, dtype=np.int64)
+
+
+def entries(cache):
+    return sorted(name for name in os.listdir(cache.directory) if name.endswith(CACHE_SUFFIX))
+
+
+def test_miss_then_hit(tmpdir):
+    cache = FingerprintCache(str(tmpdir.join("cache")))
+    assert cache.get("ABC", None, OPTIONS) is None
+
+    keys, offsets = hashes(100)
+    cache.put("ABC", None, OPTIONS, (keys, offsets), 12.5)
+    (cached_keys, cached_offsets), audio_length = cache.get("ABC", None, OPTIONS)
+    np.testing.assert_array_equal(cached_keys, keys)
+    np.testing.assert_array_equal(cached_offsets, offsets)
+    assert audio_length == 12.5
+
+    # another instance on the same directory, e.g. a pool worker
+    assert FingerprintCache(cache.directory).get("ABC", None, OPTIONS) is not None
+
+
+def test_parameters_are_part_of_the_key(tmpdir):
+    cache = FingerprintCache(str(tmpdir))
+    cache.put("ABC", None, OPTIONS, hashes(10), 1.0)
+
+    assert cache.get("ABD", None, OPTIONS) is None
+    assert cache.get("ABC", 30, OPTIONS) is None
+    assert cache.get("ABC", None, dict(OPTIONS, peak_picker="rectangle")) is None
+    assert cache.get("ABC", None, dict(OPTIONS, decoder="ffmpeg")) is None
+    # the order of the options does not matter
+    assert cache.get("ABC", None, dict(reversed(list(OPTIONS.items())))) is not None
+    # both hash engines give the same hashes
+    assert cache.get("ABC", None, dict(OPTIONS, hash_engine="loop")) is not None
+
+
+@pytest.mark.parametrize("name,value", [
+    ("DEFAULT_WINDOW_SIZE", 2048),
+    ("DEFAULT_OVERLAP_RATIO", 0.25),
+    ("DEFAULT_FAN_VALUE", 10),
+    ("DEFAULT_AMP_MIN", 20),
+    ("PEAK_NEIGHBORHOOD_SIZE", 10),
+    ("FINGERPRINT_REDUCTION", 16),
+    ("MIN_HASH_TIME_DELTA", 1),
+    ("MAX_HASH_TIME_DELTA", 100),
+])
+def test_tuned_module_parameters_miss(tmpdir, monkeypatch, name, value):
+    cache = FingerprintCache(str(tmpdir))
+    cache.put("ABC", None, OPTIONS, hashes(10), 1.0)
+
+    monkeypatch.setattr(fingerprint, name, value)
+    assert cache.get("ABC", None, OPTIONS) is None
+
+
+def test_unreadable_entry_is_a_miss(tmpdir):
+    cache = FingerprintCache(str(tmpdir))
+    with open(cache.entry_path("ABC", None, OPTIONS), "wb") as f:
+        f.write(b"truncated")
+    assert cache.get("ABC", None, OPTIONS) is None
+
+
+def test_least_recently_used_entries_are_evicted(tmpdir):
+    cache = FingerprintCache(str(tmpdir))
+    for i, file_hash in enumerate(("A", "B", "C")):
+        cache.put(file_hash, None, OPTIONS, hashes(200, seed=i), 1.0)
+        # distinct modification times
+        path = cache.entry_path(file_hash, None, OPTIONS)
+        os.utime(path, (1000 + i, 1000 + i))
+    size = os.path.getsize(cache.entry_path("A", None, OPTIONS))
+
+    # a hit makes A the most recently used
+    assert cache.get("A", None, OPTIONS) is not None
+    cache.max_bytes = 3 * size
+    cache.put("D", None, OPTIONS, hashes(200, seed=3), 1.0)
+
+    assert cache.get("B", None, OPTIONS) is None
+    for file_hash in ("A", "C", "D"):
+        assert cache.get(file_hash, None, OPTIONS) is not None
+    assert len(entries(cache)) == 3
+
+
+def test_no_temporary_files_left(tmpdir):
+    cache = FingerprintCache(str(tmpdir))
+    cache.put("ABC", None, OPTIONS, hashes(10), 1.0)
+    assert os.listdir(str(tmpdir)) == entries(cache)
@@ -0,0 +1,183 @@
+import binascii
+
+import numpy as np
+import pytest
+
+from tramscore import fingerprint
+from tramscore.database import Database
+from tramscore.fingerprint_index import (FingerprintIndex, IndexFile, IndexFormatError,
+                                         build_index_file, hash_key, key_dtype,
+                                         verify_index_file, write_index)
+
+OPTIONS = {"fingerprint_format": fingerprint.FINGERPRINT_FORMAT_SHA1,
+           "peak_picker": fingerprint.DEFAULT_PEAK_PICKER}
+
+
+class FakeDatabase(object):
+    """
+    The advert and fingerprint reads of a database, from dicts.
+    """
+
+    def __init__(self, fingerprints, fingerprint_format=fingerprint.FINGERPRINT_FORMAT_SHA1):
+        # {sid: [(hash, offset), ...]}
+        self.fingerprints = fingerprints
+        self.fingerprint_format = fingerprint_format
+
+    def get_adverts(self):
+        return [{Database.FIELD_ADVERT_ID: sid} for sid in sorted(self.fingerprints)]
+
+    def get_fingerprints(self, sid=None):
+        for advert, hashes in sorted(self.fingerprints.items()):
+            if sid is None or sid == advert:
+                for hash, offset in hashes:
+                    yield hash_key(hash, self.fingerprint_format), advert, offset
+
+
+def sha1_hashes(count, seed):
+    rng = np.random.RandomState(seed)
+    return [(binascii.hexlify(rng.bytes(10)).decode("ascii"), int(offset))
+            for offset in rng.randint(0, 1000, count)]
+
+
+def sample_db():
+    shared = sha1_hashes(5, 0)
+    return FakeDatabase({"a": sha1_hashes(50, 1) + shared, "b": sha1_hashes(30, 2) + shared})
+
+
+def lookup(index_file, hashes):
+    keys = np.array([hash_key(hash, fingerprint.FINGERPRINT_FORMAT_SHA1) for hash in hashes],
+                    dtype=key_dtype(fingerprint.FINGERPRINT_FORMAT_SHA1))
+    query, sids, offsets = index_file.lookup(keys)
+    return sorted(zip(query.tolist(), sids.tolist(), offsets.tolist()))
+
+
+def test_write_and_open(tmpdir):
+    path = str(tmpdir.join("fingerprints.idx"))
+    db = sample_db()
+    assert build_index_file(db, path, OPTIONS) == 90
+
+    index_file = IndexFile.open(path, OPTIONS)
+    assert sorted(index_file.sids.tolist()) == ["a", "b"]
+    assert index_file.header["parameters"]["peak_picker"] == fingerprint.DEFAULT_PEAK_PICKER
+
+    hashes = [db.fingerprints["a"][0][0], db.fingerprints["b"][-1][0], "0" * 20]
+    assert lookup(index_file, hashes) == [
+        (0, "a", db.fingerprints["a"][0][1]),
+        (1, "a", db.fingerprints["b"][-1][1]),
+        (1, "b", db.fingerprints["b"][-1][1]),
+    ]
+
+
+def test_packed_keys(tmpdir):
+    path = str(tmpdir.join("fingerprints.idx"))
+    options = dict(OPTIONS, fingerprint_format=fingerprint.FINGERPRINT_FORMAT_PACKED32)
+    db = FakeDatabase({7: [(123, 4), (456, 5)], 9: [(456, 1)]},
+                      fingerprint_format=fingerprint.FINGERPRINT_FORMAT_PACKED32)
+    build_index_file(db, path, options)
+
+    query, sids, offsets = IndexFile.open(path, options).lookup(np.array([456, 1], dtype=np.int64))
+    assert sorted(zip(query.tolist(), sids.tolist(), offsets.tolist())) == [(0, 7, 5), (0, 9, 1)]
+    assert verify_index_file(db, path, options) == []
+
+
+def test_empty_index(tmpdir):
+    path = str(tmpdir.join("fingerprints.idx"))
+    build_index_file(FakeDatabase({}), path, OPTIONS)
+    assert lookup(IndexFile.open(path, OPTIONS), ["0" * 20]) == []
+    assert verify_index_file(FakeDatabase({}), path, OPTIONS) == []
+
+
+def test_replaced_file(tmpdir):
+    path = str(tmpdir.join("fingerprints.idx"))
+    db = sample_db()
+    build_index_file(db, path, OPTIONS)
+    old = IndexFile.open(path, OPTIONS)
+    assert not old.replaced()
+
+    hash, offset = db.fingerprints["a"][0]
+    db.fingerprints = {"c": [(hash, offset + 1)]}
+    build_index_file(db, path, OPTIONS)
+    assert old.replaced()
+    # the old mapping stays usable until reopened
+    assert lookup(old, [hash]) == [(0, "a", offset)]
+    assert lookup(IndexFile.open(path, OPTIONS), [hash]) == [(0, "c", offset + 1)]
+    assert not tmpdir.listdir(lambda entry: entry.basename.startswith("."))
+
+
+def test_without_skips_adverts(tmpdir):
+    path = str(tmpdir.join("fingerprints.idx"))
+    db = sample_db()
+    build_index_file(db, path, OPTIONS)
+    index_file = IndexFile.open(path, OPTIONS).without(["a"])
+
+    assert index_file.live_sids() == {"b"}
+    shared = db.fingerprints["b"][-1]
+    assert lookup(index_file, [shared[0]]) == [(0, "b", shared[1])]
+
+
+def test_verify(tmpdir):
+    path = str(tmpdir.join("fingerprints.idx"))
+    db = sample_db()
+    build_index_file(db, path, OPTIONS)
+    assert verify_index_file(db, path, OPTIONS) == []
+
+    db.fingerprints["c"] = sha1_hashes(3, 3)
+    problems = verify_index_file(db, path, OPTIONS)
+    assert any("1 adverts missing" in problem for problem in problems)
+
+    del db.fingerprints["c"]
+    db.fingerprints["a"][0] = (db.fingerprints["a"][0][0], db.fingerprints["a"][0][1] + 1)
+    assert verify_index_file(db, path, OPTIONS) == ["fingerprints differ from the database"]
+
+
+@pytest.mark.parametrize("mismatch", [
+    {"peak_picker": fingerprint.PEAK_PICKER_RECTANGLE},
+    {"fingerprint_format": fingerprint.FINGERPRINT_FORMAT_PACKED64},
+])
+def test_parameter_mismatch(tmpdir, mismatch):
+    path = str(tmpdir.join("fingerprints.idx"))
+    db = sample_db()
+    build_index_file(db, path, OPTIONS)
+
+    options = dict(OPTIONS, **mismatch)
+    with pytest.raises(IndexFormatError):
+        IndexFile.open(path, options)
+    problems = verify_index_file(db, path, options)
+    assert len(problems) == 1
+    assert "was built with" in problems[0]
+
+
+def test_not_an_index(tmpdir):
+    path = tmpdir.join("fingerprints.idx")
+    path.write_binary(b"not an index file")
+    with pytest.raises(IndexFormatError):
+        IndexFile.open(str(path), OPTIONS)
+    assert verify_index_file(sample_db(), str(path), OPTIONS)
+
+
+def test_add_and_remove_keep_the_index_sorted():
+    rng = np.random.RandomState(0)
+    keys = rng.randint(0, 100, 200).astype(np.int64)
+    codes = rng.randint(0, 5, 200).astype(np.int32)
+    offsets = np.arange(200, dtype=np.int32)
+
+    index = FingerprintIndex.empty(np.int64).add(keys[:120], codes[:120], offsets[:120])
+    index = index.add(keys[120:], codes[120:], offsets[120:]).remove([2])
+    assert (np.diff(index.keys) >= 0).all()
+
+    keep = codes != 2
+    expected = sorted(zip(keys[keep].tolist(), codes[keep].tolist(), offsets[keep].tolist()))
+    assert sorted(zip(index.keys.tolist(), index.codes.tolist(), index.offsets.tolist())) == expected
+
+
+def test_write_index_round_trips_the_arrays(tmpdir):
+    path = str(tmpdir.join("fingerprints.idx"))
+    index = FingerprintIndex.build(np.array([3, 1, 2], dtype=np.int64),
+                                   np.array([0, 1, 0], dtype=np.int32),
+                                   np.array([10, 11, 12], dtype=np.int32))
+    options = dict(OPTIONS, fingerprint_format=fingerprint.FINGERPRINT_FORMAT_PACKED64)
+    write_index(path, index, ["x", "y"], options)
+
+    stored = IndexFile.open(path, options).index
+    for name in ("keys", "codes", "offsets"):
+        np.testing.assert_array_equal(getattr(stored, name), getattr(index, name))
@@ -0,0 +1,101 @@
+import threading
+
+import numpy as np
+
+from tramscore.ingest import RingBuffer
+
+
+def samples(start, stop):
+    return np.arange(start, stop, dtype=np.int16)
+
+
+def test_reads_what_was_written():
+    buffer = RingBuffer(10)
+    buffer.write(samples(0, 4))
+    buffer.write(samples(4, 7))
+    assert buffer.available() == 7
+
+    data, dropped = buffer.read(5)
+    assert data.tolist() == list(range(5))
+    assert dropped == 0
+    assert buffer.available() == 2
+
+
+def test_wraps_around():
+    buffer = RingBuffer(8)
+    received = []
+    for start in range(0, 40, 5):
+        buffer.write(samples(start, start + 5))
+        data, dropped = buffer.read(5)
+        assert dropped == 0
+        received.extend(data.tolist())
+    assert received == list(range(40))
+
+
+def test_drop_policy_skips_to_the_oldest_sample_held():
+    buffer = RingBuffer(8)
+    buffer.write(samples(0, 6))
+    buffer.write(samples(6, 12))
+    assert buffer.available() == 8
+
+    data, dropped = buffer.read(8)
+    assert dropped == 4
+    assert data.tolist() == list(range(4, 12))
+
+
+def test_drop_policy_counts_samples_of_an_oversized_write():
+    buffer = RingBuffer(8)
+    buffer.write(samples(0, 2))
+    buffer.write(samples(2, 22))
+
+    data, dropped = buffer.read(8)
+    assert dropped == 14
+    assert data.tolist() == list(range(14, 22))
+
+
+def test_read_times_out_with_what_is_there():
+    buffer = RingBuffer(8)
+    buffer.write(samples(0, 3))
+    data, dropped = buffer.read(5, timeout=0.05)
+    assert data.tolist() == [0, 1, 2]
+    assert dropped == 0
+
+
+def test_close_ends_the_stream():
+    buffer = RingBuffer(8)
+    buffer.write(samples(0, 3))
+    buffer.close()
+    assert buffer.closed
+    assert buffer.read(5)[0].tolist() == [0, 1, 2]
+    assert buffer.read(5)[0].tolist() == []
+
+
+def test_block_policy_waits_for_the_reader():
+    buffer = RingBuffer(8, block=True)
+    writer = threading.Thread(target=buffer.write, args=(samples(0, 100),))
+    writer.start()
+
+    received = []
+    while len(received) < 100:
+        data, dropped = buffer.read(min(7, 100 - len(received)), timeout=5)
+        assert dropped == 0
+        assert len(data)
+        assert buffer.available() <= 8
+        received.extend(data.tolist())
+    writer.join(5)
+
+    assert not writer.is_alive()
+    assert received == list(range(100))
+
+
+def test_close_releases_a_blocked_writer():
+    buffer = RingBuffer(8, block=True)
+    writer = threading.Thread(target=buffer.write, args=(samples(0, 20),))
+    writer.start()
+    writer.join(0.1)
+    assert writer.is_alive()
+
+    buffer.close()
+    writer.join(5)
+    assert not writer.is_alive()
+    assert buffer.read(20)[0].tolist() == list(range(8))
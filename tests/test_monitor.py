@@ -0,0 +1,236 @@
+import os
+import threading
+
+from tramscore import monitor
+
+
+def stream_config(**station):
+    station = dict({"name": "JOY FM", "id": 7, "stream": "http://host/joyfm.mp3"}, **station)
+    return {"monitor": {"workers": 1, "stations": [station]}}
+
+
+class FakeStream(object):
+    """
+    A PCMStream that ends at once, see opened.
+    """
+    opened = []
+
+    def __init__(self, source):
+        self.source = source
+        self.closed = 0
+
+    def start(self):
+        FakeStream.opened.append(self)
+        return self
+
+    def close(self):
+        self.closed += 1
+
+
+class RecordingEvent(type(threading.Event())):
+    """
+    Records the timeouts waited for.
+    """
+
+    def __init__(self):
+        super(RecordingEvent, self).__init__()
+        self.timeouts = []
+
+    def wait(self, timeout=None):
+        self.timeouts.append(timeout)
+        return super(RecordingEvent, self).wait(0)
+
+
+def test_ended_streams_are_reopened_with_backoff(make_tramscore, monkeypatch):
+    FakeStream.opened = []
+    monkeypatch.setattr(monitor, "PCMStream", FakeStream)
+    monkeypatch.setattr(monitor.StationIngest, "__init__", lambda self, *args, **kwargs: None)
+    monkeypatch.setattr(monitor, "RECONNECT_MAX_SECONDS", 8)
+    instance = monitor.Monitor(stream_config(), tramscore=make_tramscore())
+    instance._stopped = stopped = RecordingEvent()
+
+    def stop_after_five(self):
+        if len(FakeStream.opened) == 5:
+            stopped.set()
+        return iter([])
+    monkeypatch.setattr(monitor.StationIngest, "matches", stop_after_five)
+
+    instance._ingest(instance.stations[0])
+    assert len(FakeStream.opened) == 5
+    assert stopped.timeouts == [1, 2, 4, 8]
+    # every stream was closed once, and none is left behind
+    assert [stream.closed for stream in FakeStream.opened] == [1] * 5
+    assert instance.streams == {}
+
+
+def test_failed_opens_are_retried(make_tramscore, monkeypatch):
+    attempts = []
+
+    def refuse(source):
+        attempts.append(source)
+        if len(attempts) == 3:
+            instance._stopped.set()
+        raise OSError("ffmpeg not found")
+    monkeypatch.setattr(monitor, "PCMStream", refuse)
+    monkeypatch.setattr(monitor, "RECONNECT_MIN_SECONDS", 0.01)
+    instance = monitor.Monitor(stream_config(), tramscore=make_tramscore())
+
+    instance._ingest(instance.stations[0])
+    assert attempts == ["http://host/joyfm.mp3"] * 3
+
+
+def test_stop_closes_the_open_stream(make_tramscore, monkeypatch):
+    FakeStream.opened = []
+    monkeypatch.setattr(monitor, "PCMStream", FakeStream)
+    instance = monitor.Monitor(stream_config(), tramscore=make_tramscore())
+    stream = instance._open_stream(instance.stations[0])
+    assert instance.streams == {7: stream}
+
+    instance.stop()
+    assert stream.closed == 1
+    # a stream closed by stop() is not closed again by its thread
+    instance._close_stream(instance.stations[0], stream)
+    assert stream.closed == 1
+    # and none is opened once stopped
+    assert instance._open_stream(instance.stations[0]) is None
+
+
+class FakeExecutor(object):
+    """
+    Records the submitted calls instead of running them.
+    """
+
+    def __init__(self):
+        self.submitted = []
+
+    def submit(self, fn, *args):
+        self.submitted.append((fn.__name__, args))
+
+    def shutdown(self, wait=True):
+        pass
+
+
+def make_monitor(make_tramscore, config, recognition_url=None):
+    config["monitor"]["recognition_url"] = recognition_url
+    instance = monitor.Monitor(config, tramscore=make_tramscore())
+    instance.executor = FakeExecutor()
+    db = instance.tramscore.db
+    db.add_advert(1, u"coke", media_stations=[7, 9], audio_length=30, client_user_id=3)
+    db.add_advert(2, u"fanta", media_stations=[9], audio_length=20, client_user_id=4)
+    return instance
+
+
+def match(instance, advert_id, count=200, total_hashes=1000, **fields):
+    advert = instance.tramscore.advert_match(advert_id, 12, count, total_hashes)
+    advert.update(fields)
+    return advert
+
+
+def test_report_thresholds(make_tramscore):
+    instance = make_monitor(make_tramscore, stream_config(min_confidence=100,
+                                                          min_relative_confidence=3.0))
+    station = instance.stations[0]
+
+    assert instance.report(station, None) is None
+    # at the thresholds is not enough
+    assert instance.report(station, match(instance, 1, count=100)) is None
+    assert instance.report(station, match(instance, 1, count=300, total_hashes=10000)) is None
+
+    reported = instance.report(station, match(instance, 1, count=101, total_hashes=1000))
+    assert reported[monitor.Tramscore.ADVERT_NAME] == u"coke"
+    assert reported[monitor.Tramscore.MEDIA_STATION_ID] == 7
+    assert reported[monitor.Tramscore.RELATIVE_CONFIDENCE] == 10.1
+    assert reported[monitor.Tramscore.CLIENT_USER_ID] == 3
+    # nothing posted without a recognition_url
+    assert instance.executor.submitted == []
+
+
+def test_report_only_adverts_booked_on_the_station(make_tramscore):
+    instance = make_monitor(make_tramscore, stream_config(), recognition_url="http://host/")
+    station = instance.stations[0]
+
+    assert instance.report(station, match(instance, 2)) is None
+    reported = instance.report(station, match(instance, 1))
+    assert instance.executor.submitted == [("recognition_post", (station, reported))]
+
+
+def test_ingest_suppresses_re_reports(make_tramscore, monkeypatch):
+    instance = make_monitor(make_tramscore, stream_config())
+    monkeypatch.setattr(monitor, "PCMStream", FakeStream)
+    monkeypatch.setattr(monitor.StationIngest, "__init__", lambda self, *args, **kwargs: None)
+    stream_time = monitor.StationIngest.STREAM_TIME
+    windows = [
+        match(instance, 1, **{stream_time: 10.0}),
+        None,
+        # the same airing in the next windows
+        match(instance, 1, **{stream_time: 12.5}),
+        match(instance, 1, **{stream_time: 39.9}),
+        # too weak, does not hold back the next one
+        match(instance, 1, count=50, **{stream_time: 45.0}),
+        # aired again once the advert's length went by
+        match(instance, 1, **{stream_time: 40.0}),
+        match(instance, 1, count=50, **{stream_time: 80.0}),
+        match(instance, 1, **{stream_time: 85.0}),
+    ]
+    monkeypatch.setattr(monitor.StationIngest, "matches", lambda self: iter(windows))
+    reported = []
+    report = instance.report
+
+    def record(station, advert):
+        advert = report(station, advert)
+        if advert:
+            reported.append(advert[stream_time])
+        return advert
+    monkeypatch.setattr(instance, "report", record)
+
+    instance._ingest_stream(instance.stations[0])
+    assert reported == [10.0, 40.0, 85.0]
+
+
+def watch_config(tmpdir):
+    station = {"name": "ADOM FM", "id": 7, "watch_dir": str(tmpdir.join("watch")),
+               "detected_dir": str(tmpdir.join("detected")), "failed_dir": str(tmpdir.join("failed"))}
+    return {"monitor": {"workers": 1, "stations": [station]}}
+
+
+def segment(instance, name="segment.mp3"):
+    station = instance.stations[0]
+    station.make_dirs()
+    path = os.path.join(station.watch_dir, name)
+    with open(path, "wb") as f:
+        f.write(b"audio")
+    return station, path
+
+
+def test_recognized_segments_are_moved_to_detected_dir(make_tramscore, tmpdir, monkeypatch):
+    instance = make_monitor(make_tramscore, watch_config(tmpdir))
+    station, path = segment(instance)
+    adverts = [match(instance, 2), match(instance, 1), match(instance, 1, count=10)]
+    monkeypatch.setattr(instance.tramscore, "recognize_path",
+                        lambda path, min_count=None: adverts)
+
+    instance.recognize_segment(station, path)
+    assert not os.path.exists(path)
+    # named after the first reported advert
+    moved, = os.listdir(station.detected_dir)
+    assert moved.startswith("coke") and moved.endswith(".mp3")
+    assert os.listdir(station.failed_dir) == []
+
+
+def test_unrecognized_segments_are_moved_to_failed_dir(make_tramscore, tmpdir, monkeypatch):
+    instance = make_monitor(make_tramscore, watch_config(tmpdir))
+    station, path = segment(instance)
+    # only an advert that is not booked on the station
+    monkeypatch.setattr(instance.tramscore, "recognize_path",
+                        lambda path, min_count=None: [match(instance, 2)])
+    instance.recognize_segment(station, path)
+
+    def broken(path, min_count=None):
+        raise IOError("cannot decode")
+    monkeypatch.setattr(instance.tramscore, "recognize_path", broken)
+    station, broken_path = segment(instance, "broken.wav")
+    instance.recognize_segment(station, broken_path)
+
+    assert sorted(os.listdir(station.failed_dir)) == ["broken.wav", "segment.mp3"]
+    assert os.listdir(station.detected_dir) == []
+    assert os.listdir(station.watch_dir) == []
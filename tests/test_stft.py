@@ -0,0 +1,60 @@
+import numpy as np
+import pytest
+from matplotlib import mlab
+
+from tramscore import stft
+
+
+def mlab_specgram(samples, wsize, noverlap, Fs):
+    return mlab.specgram(samples, NFFT=wsize, Fs=Fs, window=mlab.window_hanning,
+                         noverlap=noverlap)[0]
+
+
+@pytest.mark.parametrize("nsamples", [44100, 4096, 4097, 10000, 300])
+@pytest.mark.parametrize("wsize,noverlap", [(4096, 2048), (1024, 0), (512, 384)])
+def test_matches_mlab_specgram(nsamples, wsize, noverlap):
+    samples = np.random.RandomState(nsamples).randint(-32768, 32767, nsamples).astype(np.int16)
+    expected = mlab_specgram(samples, wsize, noverlap, 44100)
+    arr2D = stft.specgram(samples, wsize, noverlap, 44100, dtype=np.float64)
+
+    assert arr2D.shape == expected.shape
+    np.testing.assert_allclose(arr2D, expected, rtol=1e-9, atol=1e-12)
+
+
+def test_float32_close_to_mlab_specgram():
+    samples = np.random.RandomState(0).randint(-32768, 32767, 44100).astype(np.int16)
+    expected = mlab_specgram(samples, 4096, 2048, 44100)
+    arr2D = stft.specgram(samples, 4096, 2048, 44100)
+
+    assert arr2D.dtype == np.float32
+    np.testing.assert_allclose(arr2D, expected, rtol=1e-3, atol=expected.max() * 1e-6)
+
+
+def test_spans_several_blocks():
+    wsize, noverlap = 64, 32
+    nsamples = (stft.FRAMES_PER_BLOCK * 2 + 10) * (wsize - noverlap) + noverlap
+    samples = np.random.RandomState(1).randn(nsamples)
+    expected = mlab_specgram(samples, wsize, noverlap, 8000)
+    arr2D = stft.specgram(samples, wsize, noverlap, 8000, dtype=np.float64)
+
+    assert arr2D.shape[1] > 2 * stft.FRAMES_PER_BLOCK
+    np.testing.assert_allclose(arr2D, expected, rtol=1e-9, atol=1e-15)
+
+
+def test_reuses_out_buffer():
+    plan = stft.get_plan(1024, 512, 44100)
+    assert stft.get_plan(1024, 512, 44100) is plan
+
+    samples = np.random.RandomState(2).randint(-32768, 32767, 8192).astype(np.int16)
+    out = np.empty((plan.num_frames(len(samples)), plan.nfreqs), dtype=plan.dtype)
+    arr2D = plan.specgram(samples, out=out)
+    assert np.shares_memory(arr2D, out)
+    np.testing.assert_array_equal(arr2D, plan.specgram(samples))
+
+    with pytest.raises(ValueError):
+        plan.specgram(samples, out=out[1:])
+
+
+def test_rejects_bad_overlap():
+    with pytest.raises(ValueError):
+        stft.STFT(1024, 1024, 44100)
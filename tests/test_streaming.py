@@ -0,0 +1,91 @@
+import numpy as np
+import pytest
+
+from tramscore import fingerprint
+from tramscore.streaming import IncrementalFingerprinter
+
+
+def stream_samples(seconds=6, seed=0):
+    rng = np.random.RandomState(seed)
+    t = np.arange(int(seconds * fingerprint.DEFAULT_FS)) / float(fingerprint.DEFAULT_FS)
+    tones = sum(np.sin(2 * np.pi * f * t + rng.rand() * np.pi) for f in rng.uniform(200, 8000, 6))
+    return (tones * 2000 + rng.randn(len(t)) * 500).astype(np.int16)
+
+
+def whole_file_hashes(samples, **options):
+    return sorted(fingerprint.fingerprint(samples, **options))
+
+
+def incremental_hashes(samples, chunk_sizes, **options):
+    fingerprinter = IncrementalFingerprinter(**options)
+    hashes = []
+    position = 0
+    for size in chunk_sizes:
+        if position >= len(samples):
+            break
+        hashes.extend(fingerprinter.feed(samples[position:position + size]))
+        position += size
+    hashes.extend(fingerprinter.feed(samples[position:]))
+    hashes.extend(fingerprinter.flush())
+    return sorted(hashes)
+
+
+@pytest.mark.parametrize("chunk_size", [1000, 4096, 22050, 100000])
+def test_chunks_give_the_whole_file_hashes(chunk_size):
+    samples = stream_samples()
+    expected = whole_file_hashes(samples)
+    assert expected
+    assert incremental_hashes(samples, [chunk_size] * len(samples)) == expected
+
+
+def test_uneven_chunks_give_the_whole_file_hashes():
+    samples = stream_samples(seed=1)
+    sizes = np.random.RandomState(1).randint(1, 30000, 100).tolist()
+    assert incremental_hashes(samples, sizes) == whole_file_hashes(samples)
+
+
+@pytest.mark.parametrize("fingerprint_format", [fingerprint.FINGERPRINT_FORMAT_PACKED32,
+                                                fingerprint.FINGERPRINT_FORMAT_PACKED64])
+def test_packed_formats(fingerprint_format):
+    samples = stream_samples(seconds=3, seed=2)
+    options = dict(fingerprint_format=fingerprint_format)
+    assert (incremental_hashes(samples, [8000] * 100, **options)
+            == whole_file_hashes(samples, **options))
+
+
+def test_shorter_than_one_window():
+    samples = stream_samples(seconds=0.05, seed=3)
+    assert len(samples) < fingerprint.DEFAULT_WINDOW_SIZE
+    assert incremental_hashes(samples, []) == whole_file_hashes(samples)
+
+
+def test_flush_starts_a_new_stream():
+    samples = stream_samples(seconds=3, seed=4)
+    fingerprinter = IncrementalFingerprinter()
+    first = fingerprinter.feed(samples) + fingerprinter.flush()
+    assert fingerprinter.frames == 0
+    second = fingerprinter.feed(samples) + fingerprinter.flush()
+    assert sorted(first) == sorted(second)
+
+
+def test_seconds():
+    fingerprinter = IncrementalFingerprinter()
+    fingerprinter.feed(np.zeros(fingerprint.DEFAULT_FS * 2, dtype=np.int16))
+    hop = fingerprint.DEFAULT_WINDOW_SIZE - int(fingerprint.DEFAULT_WINDOW_SIZE
+                                                * fingerprint.DEFAULT_OVERLAP_RATIO)
+    assert fingerprinter.seconds == fingerprinter.frames * hop / float(fingerprint.DEFAULT_FS)
+    assert fingerprinter.offset_to_seconds(10) == 10 * hop / float(fingerprint.DEFAULT_FS)
+
+
+@pytest.mark.parametrize("fingerprint_format", fingerprint.FINGERPRINT_FORMATS)
+def test_loop_hash_engine(fingerprint_format):
+    samples = stream_samples(seconds=3, seed=4)
+    options = dict(fingerprint_format=fingerprint_format, hash_engine=fingerprint.HASH_ENGINE_LOOP)
+    hashes = incremental_hashes(samples, [5000] * 100, **options)
+    assert hashes == whole_file_hashes(samples, **options)
+    assert hashes == incremental_hashes(samples, [5000] * 100, fingerprint_format=fingerprint_format)
+
+
+def test_unknown_hash_engine():
+    with pytest.raises(ValueError):
+        IncrementalFingerprinter(hash_engine="fortran")
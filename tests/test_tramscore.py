@@ -0,0 +1,297 @@
+import multiprocessing
+import wave
+
+import numpy as np
+import pytest
+
+import tramscore
+from tramscore import Tramscore, decoder, fingerprint
+from tramscore.database import Database
+from tramscore.fingerprint_cache import FingerprintCache
+
+
+def matches_of(advert_id, count, diff=7):
+    return [(advert_id, diff)] * count
+
+
+def test_metadata_is_loaded_in_bulk(make_tramscore):
+    tramscore = make_tramscore()
+    db = tramscore.db
+    db.add_advert(1, "coke", media_stations=[3, 4], **{Database.AUDIO_LENGTH: 30.0})
+    db.add_advert(2, "fanta")
+    tramscore.refresh_adverts(force=True)
+    db.calls.clear()
+
+    for _ in range(3):
+        match = tramscore.align_matches(matches_of(1, 5), total_hashes=10)
+        assert match[Tramscore.ADVERT_NAME] == b"coke"
+        assert match[Tramscore.AUDIO_LENGTH] == 30.0
+        assert match[Tramscore.CONFIDENCE] == 5
+        assert match[Tramscore.RELATIVE_CONFIDENCE] == 50.0
+        assert match[Database.MEDIA_STATION_ID] == ["3", "4"]
+    assert tramscore.align_matches(matches_of(2, 5), total_hashes=10)[Database.MEDIA_STATION_ID] == [""]
+
+    assert db.calls["get_client_advert_by_id"] == 0
+    assert db.calls["get_client_advert_media_stations_by_id"] == 0
+
+
+def test_new_adverts_are_looked_up_once(make_tramscore):
+    tramscore = make_tramscore()
+    db = tramscore.db
+    db.add_advert(5, "sprite", media_stations=[9])
+
+    for _ in range(3):
+        match = tramscore.align_matches(matches_of(5, 2), total_hashes=4)
+        assert match[Tramscore.ADVERT_NAME] == b"sprite"
+        assert match[Database.MEDIA_STATION_ID] == ["9"]
+    assert db.calls["get_client_advert_by_id"] == 1
+    assert db.calls["get_client_advert_media_stations_by_id"] == 1
+
+
+def test_unknown_advert(make_tramscore):
+    tramscore = make_tramscore()
+    assert tramscore.align_matches(matches_of(42, 3), total_hashes=3) is None
+    assert tramscore.align_all_matches(matches_of(42, 3), total_hashes=3, min_count=1) == []
+
+
+def test_invalidated_advert_is_read_again(make_tramscore):
+    tramscore = make_tramscore()
+    db = tramscore.db
+    db.add_advert(1, "coke", media_stations=[3])
+    tramscore.load_advert_metadata()
+
+    db.media_stations[1].append(8)
+    assert tramscore.get_advert_metadata(1)[1] == ["3"]
+    tramscore.invalidate_advert_metadata(1)
+    assert tramscore.get_advert_metadata(1)[1] == ["3", "8"]
+
+
+def test_refresh_reloads_metadata(make_tramscore):
+    tramscore = make_tramscore()
+    db = tramscore.db
+    db.add_advert(1, "coke")
+    tramscore.invalidate_adverts()
+    assert tramscore.refresh_adverts()
+    assert not tramscore.refresh_adverts()
+
+    db.calls.clear()
+    assert tramscore.get_advert_metadata(1)[0][Database.FIELD_ADVERTNAME] == "coke"
+    assert db.calls["get_client_advert_by_id"] == 0
+
+
+def test_min_count_skips_the_advert_lookup(make_tramscore):
+    tramscore = make_tramscore()
+    db = tramscore.db
+    db.add_advert(1, "coke")
+    db.calls.clear()
+
+    assert tramscore.align_matches(matches_of(1, 3), total_hashes=10, min_count=4) is None
+    assert db.calls["get_client_advert_by_id"] == 0
+    assert tramscore.align_matches(matches_of(1, 4), total_hashes=10, min_count=4) is not None
+
+
+def tone_channels(seconds=3, nchannels=2, seed=0):
+    rng = np.random.RandomState(seed)
+    t = np.arange(int(seconds * fingerprint.DEFAULT_FS)) / float(fingerprint.DEFAULT_FS)
+    channels = []
+    for _ in range(nchannels):
+        tones = sum(np.sin(2 * np.pi * f * t) for f in rng.uniform(200, 8000, 5))
+        channels.append((tones * 3000 + rng.randn(len(t)) * 300).astype(np.int16))
+    return channels
+
+
+def write_wav(path, channels):
+    w = wave.open(str(path), "wb")
+    w.setnchannels(len(channels))
+    w.setsampwidth(2)
+    w.setframerate(fingerprint.DEFAULT_FS)
+    w.writeframes(np.stack(channels, axis=1).astype("<i2").tobytes())
+    w.close()
+    return str(path)
+
+
+def distinct_hashes(channels, **options):
+    return sorted(set(hash for samples in channels
+                      for hash in fingerprint.fingerprint(samples, **options)))
+
+
+def worker_hashes(keys, offsets):
+    return [hash for chunk in tramscore._hash_chunks(keys, offsets) for hash in chunk]
+
+
+@pytest.mark.parametrize("fingerprint_format", fingerprint.FINGERPRINT_FORMATS)
+def test_fingerprint_worker_gives_the_distinct_hashes(tmpdir, monkeypatch, fingerprint_format):
+    # several steps per channel
+    monkeypatch.setattr(tramscore, "FINGERPRINT_STEP_SECONDS", 1)
+    channels = tone_channels()
+    path = write_wav(tmpdir.join("coke.wav"), channels)
+    options = {"fingerprint_format": fingerprint_format}
+
+    advert_name, hashes, file_hash, audio_length = tramscore._fingerprint_worker(
+        path, fingerprint_options=options)
+    assert advert_name == "coke"
+    assert file_hash == decoder.unique_hash(path)
+    assert audio_length == 3.0
+    assert worker_hashes(*hashes) == distinct_hashes(channels, **options)
+
+
+def test_hash_chunks():
+    keys = np.array([b"%020x" % i for i in range(25)])
+    offsets = np.arange(25, dtype=np.int64)
+    chunks = list(tramscore._hash_chunks(keys, offsets, size=10))
+    assert [len(chunk) for chunk in chunks] == [10, 10, 5]
+    assert chunks[0][3] == ("%020x" % 3, 3)
+    assert isinstance(chunks[0][3][0], str)
+
+    packed = list(tramscore._hash_chunks(offsets.astype(np.uint64) * 7, offsets))
+    assert packed == [[(i * 7, i) for i in range(25)]]
+    assert list(tramscore._hash_chunks(keys[:0], offsets[:0])) == []
+
+
+def test_unique_hashes():
+    keys = [np.array([b"b", b"a"]), np.array([b"a", b"b"])]
+    offsets = [np.array([1, 2]), np.array([2, 3])]
+    keys, offsets = tramscore._unique_hashes(keys, offsets, fingerprint.FINGERPRINT_FORMAT_SHA1)
+    assert list(zip(keys.tolist(), offsets.tolist())) == [(b"a", 2), (b"b", 1), (b"b", 3)]
+
+    keys, offsets = tramscore._unique_hashes([], [], fingerprint.FINGERPRINT_FORMAT_PACKED32)
+    assert len(keys) == len(offsets) == 0
+
+
+def test_fingerprint_directory_stores_the_distinct_hashes(tmpdir, make_tramscore):
+    channels = tone_channels(nchannels=1, seed=1)
+    write_wav(tmpdir.join("coke.wav"), channels)
+    # a copy is fingerprinted once
+    write_wav(tmpdir.join("copy.wav"), channels)
+    write_wav(tmpdir.join("fanta.wav"), tone_channels(seed=2))
+
+    instance = make_tramscore()
+    instance.fingerprint_directory(str(tmpdir), [".wav"], nprocesses=2)
+    db = instance.db
+    names = dict((advert[Database.FIELD_ADVERTNAME], advert_id)
+                 for advert_id, advert in db.adverts.items())
+    assert len(names) == 2
+    assert "fanta" in names
+    original = names.get("coke", names.get("copy"))
+    assert sorted(db.hashes[original]) == distinct_hashes(channels)
+    assert instance.adverthashes_set == set(decoder.unique_hash(str(path)) for path in tmpdir.listdir())
+
+    # nothing new the second time
+    instance.fingerprint_directory(str(tmpdir), [".wav"], nprocesses=2)
+    assert len(db.adverts) == 2
+
+
+def test_interrupted_migration_is_refused(tmpdir, make_tramscore, monkeypatch):
+    path = write_wav(tmpdir.join("coke.wav"), tone_channels(nchannels=1, seed=1))
+    db = make_tramscore().db
+    # every instance shares the database
+    monkeypatch.setattr(tramscore, "get_database", lambda database_type=None: lambda **options: db)
+    instance = make_tramscore()
+    db.add_advert(1, "coke")
+    db.adverts[1][Database.FIELD_FILE_SHA1] = decoder.unique_hash(path)
+    db.store_fingerprint_format(fingerprint.FINGERPRINT_FORMAT_SHA1)
+
+    def interrupt(sid, hashes):
+        raise KeyboardInterrupt
+    monkeypatch.setattr(instance, "_insert_hashes", interrupt)
+    with pytest.raises(KeyboardInterrupt):
+        instance.migrate_fingerprints(fingerprint.FINGERPRINT_FORMAT_PACKED64, str(tmpdir), [".wav"])
+    with pytest.raises(tramscore.FingerprintFormatError):
+        make_tramscore(fingerprint_format=fingerprint.FINGERPRINT_FORMAT_SHA1).check_fingerprint_format()
+    with pytest.raises(tramscore.FingerprintFormatError):
+        make_tramscore(fingerprint_format=fingerprint.FINGERPRINT_FORMAT_PACKED64).check_fingerprint_format()
+
+    # running it again finishes the migration
+    instance = make_tramscore()
+    instance.migrate_fingerprints(fingerprint.FINGERPRINT_FORMAT_PACKED64, str(tmpdir), [".wav"])
+    assert db.get_stored_fingerprint_format() == fingerprint.FINGERPRINT_FORMAT_PACKED64
+    assert db.hashes[1]
+    make_tramscore(fingerprint_format=fingerprint.FINGERPRINT_FORMAT_PACKED64).check_fingerprint_format()
+
+
+def test_recognize_directory_forks_the_workers(tmpdir, make_tramscore, monkeypatch):
+    # the recognizers need pyaudio
+    pytest.importorskip("pyaudio")
+    write_wav(tmpdir.join("coke.wav"), tone_channels(nchannels=1, seed=1))
+    write_wav(tmpdir.join("fanta.wav"), tone_channels(nchannels=1, seed=2))
+    # the instance holds locks, a spawned pool could not pickle it
+    monkeypatch.setattr(multiprocessing, "Pool", multiprocessing.get_context("spawn").Pool)
+
+    results = list(make_tramscore().recognize_directory(str(tmpdir), [".wav"], nprocesses=2))
+    assert sorted(result["file"] for result in results) == sorted(str(path) for path in tmpdir.listdir())
+    assert [result.get("error") for result in results] == [None, None]
+    assert [result["match"] for result in results] == [None, None]
+
+
+def test_insert_hashes_in_chunks(make_tramscore, monkeypatch):
+    monkeypatch.setattr(tramscore, "INSERT_HASHES_CHUNK", 4)
+    instance = make_tramscore()
+    calls = []
+    monkeypatch.setattr(instance.db, "insert_hashes", lambda sid, hashes: calls.append((sid, hashes)))
+
+    keys = np.arange(10, dtype=np.uint64)
+    instance._insert_hashes(7, (keys, np.arange(10, dtype=np.int64)))
+    assert [len(hashes) for _, hashes in calls] == [4, 4, 2]
+    assert [hash for _, hashes in calls for hash in hashes] == [(i, i) for i in range(10)]
+
+
+def test_fingerprint_worker_uses_the_cache(tmpdir, monkeypatch):
+    cache = FingerprintCache(str(tmpdir.join("cache")))
+    channels = tone_channels(nchannels=1, seed=3)
+    path = write_wav(tmpdir.join("coke.wav"), channels)
+    first = tramscore._fingerprint_worker(path, cache=cache)
+
+    def no_decoding(*args, **kwargs):
+        raise AssertionError("decoded a cached file")
+    monkeypatch.setattr(decoder, "read", no_decoding)
+
+    # a renamed copy hits the same entry
+    copy = tmpdir.join("copy.wav")
+    tmpdir.join("coke.wav").copy(copy)
+    advert_name, hashes, file_hash, audio_length = tramscore._fingerprint_worker(str(copy), cache=cache)
+    assert advert_name == "copy"
+    assert (file_hash, audio_length) == first[2:]
+    assert worker_hashes(*hashes) == worker_hashes(*first[1]) == distinct_hashes(channels)
+
+
+def test_separate_channels():
+    channels = tone_channels(seconds=2, seed=4)
+    hashes = tramscore.channel_hashes(channels, channel_mode=tramscore.CHANNELS_SEPARATE)
+    assert hashes == [fingerprint.fingerprint(samples) for samples in channels]
+
+
+def test_mono_fingerprints_the_channel_average():
+    left, right = tone_channels(seconds=2, seed=5)
+    # a sample longer than the other channel is dropped
+    hashes = tramscore.channel_hashes([left, np.append(right, 7)], channel_mode=tramscore.CHANNELS_MONO)
+
+    mixed = ((left.astype(np.int32) + right) // 2).astype(np.int16)
+    assert hashes == [fingerprint.fingerprint(mixed)]
+
+
+def test_dedup_looks_up_each_hash_once():
+    left, right = tone_channels(seconds=2, seed=6)
+    # the second channel repeats every hash of the first
+    channels = [left, left.copy(), right]
+    hashes = tramscore.channel_hashes(channels, channel_mode=tramscore.CHANNELS_DEDUP)
+
+    assert len(hashes) == 1
+    assert len(hashes[0]) == len(set(hashes[0]))
+    separate = tramscore.channel_hashes(channels)
+    assert set(hashes[0]) == set(hash for channel in separate for hash in channel)
+    # in channel order
+    assert hashes[0][:len(set(separate[0]))] == list(dict.fromkeys(separate[0]))
+
+
+@pytest.mark.parametrize("channel_mode", tramscore.CHANNEL_MODES)
+def test_a_mono_recording_is_fingerprinted_once(channel_mode):
+    channels = tone_channels(seconds=2, nchannels=1, seed=7)
+    options = {"fingerprint_format": fingerprint.FINGERPRINT_FORMAT_PACKED32}
+    hashes = tramscore.channel_hashes(channels, channel_mode=channel_mode, fingerprint_options=options)
+    assert hashes == [fingerprint.fingerprint(channels[0], **options)]
+
+
+def test_channel_mode_is_checked(make_tramscore):
+    assert make_tramscore(channel_mode="dedup").channel_mode == tramscore.CHANNELS_DEDUP
+    with pytest.raises(ValueError):
+        make_tramscore(channel_mode="surround")
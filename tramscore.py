@@ -1,13 +1,17 @@
 #!/usr/local/bin/python3.7
 
+from __future__ import print_function
+
 import os
 import sys
 import json
+import time
 import warnings
 import argparse
 
 from tramscore import Tramscore
-from tramscore.recognize import DirFileRecognizer
+from tramscore.fingerprint_index import build_index_file, verify_index_file
+from tramscore.ingest import PCMStream, StationIngest
 from tramscore.recognize import FileRecognizer
 from tramscore.recognize import MicrophoneRecognizer
 from argparse import RawTextHelpFormatter
@@ -17,9 +21,9 @@ warnings.filterwarnings("ignore")
 DEFAULT_CONFIG_FILE = "/home/blazoninnovation/testbed/tramstest/tramscore/tramscore.conf"
 
 
-def init(configpath):
+def init(configpath, **overrides):
     """ 
-    Load config from a JSON file
+    Load config from a JSON file, `overrides` replace top level keys
     """
     try:
         with open(configpath) as f:
@@ -27,6 +31,7 @@ def init(configpath):
     except IOError as err:
         print(("Cannot open configuration: %s. Exiting" % (str(err))))
         sys.exit(1)
+    config.update(overrides)
 
     # create a Tramscore instance
     return Tramscore(config)
@@ -64,10 +69,22 @@ if __name__ == '__main__':
                              'Usage: \n'
                              '--recognize mic number_of_seconds \n'
                              '--recognize file path/to/file \n' 
+                             '--recognize stream url_or_file \n'
                              '--recognize dir /path/to/directory extension\n')
+    parser.add_argument('-m', '--migrate', nargs=3,
+                        help='Re-fingerprint adverts into another fingerprint format\n'
+                             '(sha1, packed32 or packed64) from their source files\n'
+                             'Usage: \n'
+                             '--migrate format /path/to/directory extension\n')
+    parser.add_argument('-i', '--index', nargs='+',
+                        help='Build or verify the fingerprint index file, the\n'
+                             '"index_file" of the database config by default\n'
+                             'Usage: \n'
+                             '--index build [/path/to/index]\n'
+                             '--index verify [/path/to/index]\n')
     args = parser.parse_args()
 
-    if not args.fingerprint and not args.recognize:
+    if not args.fingerprint and not args.recognize and not args.migrate and not args.index:
         parser.print_help()
         sys.exit(0)
 
@@ -76,9 +93,42 @@ if __name__ == '__main__':
         config_file = DEFAULT_CONFIG_FILE
         # print("Using default config file: %s" % (config_file))
 
-    trams = init(config_file)
+    if args.migrate:
+        # the configured format may already be the target one
+        trams = init(config_file, check_fingerprint_format=False)
+    else:
+        trams = init(config_file)
+
+    if args.migrate:
+        fingerprint_format, directory, extension = args.migrate
+        trams.migrate_fingerprints(fingerprint_format, directory, ["." + extension])
+        print("Fingerprints migrated to %s, set \"fingerprint_format\": \"%s\" in %s"
+              % (fingerprint_format, fingerprint_format, config_file))
+
+    elif args.index:
+        action = args.index[0]
+        if len(args.index) > 1:
+            index_path = args.index[1]
+        else:
+            index_path = trams.config.get("database", {}).get("index_file")
+        if action not in ('build', 'verify') or not index_path:
+            print("Usage: --index build|verify [/path/to/index]")
+            sys.exit(1)
+
+        # the fingerprints of record, not an index in front of them
+        db = getattr(trams.db, "backend", trams.db)
+        if action == 'build':
+            count = build_index_file(db, index_path, trams.fingerprint_options)
+            print("Wrote %d fingerprints to %s" % (count, index_path))
+        else:
+            problems = verify_index_file(db, index_path, trams.fingerprint_options)
+            for problem in problems:
+                print(problem)
+            if problems:
+                sys.exit(1)
+            print("%s matches the database" % index_path)
 
-    if args.fingerprint:
+    elif args.fingerprint:
         if len(args.fingerprint) == 1:
             filepath = args.fingerprint[0]
             if os.path.isdir(filepath):
@@ -107,7 +157,6 @@ if __name__ == '__main__':
     elif args.recognize:
         # Recognize audio source
         advert = None
-        advertlist = []
 
         if len(args.recognize) == 2:
             source = args.recognize[0]
@@ -117,6 +166,19 @@ if __name__ == '__main__':
                 advert = trams.recognize(MicrophoneRecognizer, seconds=int(opt_arg))
             elif source == 'file':
                 advert = trams.recognize(FileRecognizer, opt_arg)
+            elif source == 'stream':
+                # decode through an ffmpeg pipe and print every window match
+                stream = PCMStream(opt_arg).start()
+                try:
+                    for advert in StationIngest(trams, stream).matches():
+                        if advert is not None:
+                            advert["advert_name"] = (advert["advert_name"]).decode('utf-8')
+                            print((json.dumps(advert)))
+                except KeyboardInterrupt:
+                    pass
+                finally:
+                    stream.close()
+                sys.exit(0)
             if advert is not None:
                 advert["advert_name"] = (advert["advert_name"]).decode('utf-8')
                 advert["file_sha1"] = advert["file_sha1"]
@@ -133,18 +195,17 @@ if __name__ == '__main__':
             extension = args.recognize[2]
 
             if source in ('dir', 'directory'):
-                print(("Recognizing all .%s files in the %s directory" % (extension, directory)))
-                advertlist = trams.recognize_directory(directory, ["." + extension], 4)
-
-            for advert in advertlist:
-                advert = trams.recognize(DirFileRecognizer, advert)
-                if advert is not None:
-                    advert["advert_name"] = (advert["advert_name"]).decode('utf-8')
-                    advert["file_sha1"] = advert["file_sha1"]
-                    # advert["file_sha1"] = (advert["file_sha1"]).decode('utf-8')
-                    print((json.dumps(advert)))
-                else:
-                    print("\n")
-                    print(advert)
+                # one JSON line per file as the workers finish them
+                print(("Recognizing all .%s files in the %s directory" % (extension, directory)),
+                      file=sys.stderr)
+                t = time.time()
+                nfiles = 0
+                for result in trams.recognize_directory(directory, ["." + extension]):
+                    print(json.dumps(result, default=str))
+                    sys.stdout.flush()
+                    nfiles += 1
+                t = time.time() - t
+                print("Recognized %d files in %.1fs (%.2f files/s)" % (nfiles, t, nfiles / t if t else 0),
+                      file=sys.stderr)
 
     sys.exit(0)
@@ -1,12 +1,28 @@
 from __future__ import absolute_import, print_function
 import multiprocessing
 import os
+import queue
+import threading
+import time
 import traceback
 import sys
 
+import numpy as np
+
+from . import align
 from . import fingerprint
 from . import decoder
-from . database import get_database, Database
+from . database import get_database, Database, FingerprintFormatError
+from . fingerprint_cache import FingerprintCache
+from . streaming import IncrementalFingerprinter
+
+# How recognizers fingerprint the channels of a file: every channel with its
+# own lookup ("separate"), downmixed to one channel ("mono"), or every
+# channel with the hashes they share dropped before one lookup ("dedup")
+CHANNELS_SEPARATE = "separate"
+CHANNELS_MONO = "mono"
+CHANNELS_DEDUP = "dedup"
+CHANNEL_MODES = (CHANNELS_SEPARATE, CHANNELS_MONO, CHANNELS_DEDUP)
 
 
 class Tramscore(object):
@@ -27,20 +43,148 @@ class Tramscore(object):
 
         self.config = config
 
+        # options handed to fingerprint.fingerprint, both when
+        # fingerprinting adverts and when recognizing
+        self.fingerprint_options = {
+            "hash_engine": self.config.get("hash_engine",
+                                           fingerprint.DEFAULT_HASH_ENGINE),
+            "fingerprint_format": self.config.get("fingerprint_format",
+                                                  fingerprint.DEFAULT_FINGERPRINT_FORMAT),
+            "peak_picker": self.config.get("peak_picker",
+                                           fingerprint.DEFAULT_PEAK_PICKER),
+        }
+        self.fingerprint_format = self.fingerprint_options["fingerprint_format"]
+
+        # how files are decoded for fingerprinting and recognizing, see
+        # decoder.DECODERS
+        self.decoder = self.config.get("decoder", decoder.DEFAULT_DECODER)
+        if self.decoder not in decoder.DECODERS:
+            raise ValueError("Unsupported decoder: %s" % self.decoder)
+
+        # fingerprint results of files by content, see fingerprint_cache
+        self.fingerprint_cache = None
+        if self.config.get("fingerprint_cache"):
+            self.fingerprint_cache = FingerprintCache(**self.config["fingerprint_cache"])
+
         # initialize db
         db_cls = get_database(config.get("database_type", None))
 
         self.db = db_cls(**config.get("database", {}))
+        self.db.fingerprint_format = self.fingerprint_format
+        self.db.peak_picker = self.fingerprint_options["peak_picker"]
         self.db.setup()
+        if self.config.get("check_fingerprint_format", True):
+            self.check_fingerprint_format()
 
         # if we should limit seconds fingerprinted,
         # None|-1 means use entire track
         self.limit = self.config.get("fingerprint_limit", None)
         if self.limit == -1:  # for JSON compatibility
             self.limit = None
+
+        # a long-lived instance reloads its advert catalog after this many
+        # seconds, or after invalidate_adverts(). None|-1 means only on
+        # invalidate_adverts()
+        self.advert_refresh_seconds = self.config.get("advert_refresh_seconds", None)
+        if self.advert_refresh_seconds == -1:  # for JSON compatibility
+            self.advert_refresh_seconds = None
+        self._adverts_lock = threading.Lock()
+        self._adverts_stale = False
+
+        # recognizers have the database count the aligned matches
+        # (Database.return_alignments) instead of fetching every match
+        self.aggregate_matches = self.config.get("aggregate_matches", False)
+
+        # see CHANNEL_MODES
+        self.channel_mode = self.config.get("channel_mode", CHANNELS_SEPARATE)
+        if self.channel_mode not in CHANNEL_MODES:
+            raise ValueError("Unsupported channel mode: %s" % self.channel_mode)
+
+        # advert_id: (advert row, media station list), what align_matches
+        # reports about a matched advert
+        self._advert_metadata = {}
+        self.load_advert_metadata()
+
         self.get_fingerprinted_adverts()
         # self.get_client_fingerprinted_adverts(client_user_id)
 
+    def check_fingerprint_format(self):
+        """
+        Makes sure the configured fingerprint format is the one the
+        database was fingerprinted with, recording it on first use.
+        """
+        stored = self.db.get_stored_fingerprint_format()
+        if stored is not None and stored.startswith(Database.SCHEMA_MIGRATING_PREFIX):
+            raise FingerprintFormatError(
+                "Database fingerprints are being migrated to %s, or the migration "
+                "was interrupted, wait for it or run the --migrate command again."
+                % stored[len(Database.SCHEMA_MIGRATING_PREFIX):])
+        if stored is None:
+            # databases from before the format was recorded hold sha1
+            # fingerprints, an empty one can start in any format
+            if self.db.get_num_adverts():
+                stored = fingerprint.FINGERPRINT_FORMAT_SHA1
+            else:
+                stored = self.fingerprint_format
+            self.db.store_fingerprint_format(stored)
+
+        if stored != self.fingerprint_format:
+            raise FingerprintFormatError(
+                "Database holds %s fingerprints but %s is configured, set "
+                "fingerprint_format to match or run the --migrate command."
+                % (stored, self.fingerprint_format))
+
+    def migrate_fingerprints(self, fingerprint_format, path, extensions):
+        """
+        Re-fingerprints the adverts found under `path` into
+        `fingerprint_format` and records it as the database format.
+
+        Adverts are matched to their source file by file SHA1. Adverts
+        without a source file are reported and keep no fingerprints in
+        the new format. sha1 fingerprints are left in place when moving to
+        a packed format; packed32 and packed64 share one table, so moving
+        between those two drops the old keys.
+
+        The fingerprints table of the new format is emptied first, so the
+        database is marked as migrating until the run finishes and
+        `check_fingerprint_format` refuses it in the meantime. An
+        interrupted migration is resumed by running it again.
+        """
+        if fingerprint_format not in fingerprint.FINGERPRINT_FORMATS:
+            raise ValueError("Unsupported fingerprint format: %s" % fingerprint_format)
+
+        adverts = dict((advert[Database.FIELD_FILE_SHA1], advert[Database.FIELD_ADVERT_ID])
+                       for advert in self.db.get_adverts())
+        options = dict(self.fingerprint_options, fingerprint_format=fingerprint_format)
+
+        self.db.fingerprint_format = fingerprint_format
+        self.db.setup()
+        self.db.store_fingerprint_format(Database.SCHEMA_MIGRATING_PREFIX + fingerprint_format)
+        self.db.reset_fingerprints()
+
+        for filename, _ in decoder.find_files(path, extensions):
+            file_hash = decoder.unique_hash(filename)
+            sid = adverts.pop(file_hash, None)
+            if sid is None:
+                print("%s is not a fingerprinted advert, skipping..." % filename)
+                continue
+
+            _, hashes, _, _ = _fingerprint_worker(filename, self.limit,
+                                                  fingerprint_options=options,
+                                                  cache=self.fingerprint_cache,
+                                                  decoder_name=self.decoder,
+                                                  file_hash=file_hash)
+            self._insert_hashes(sid, hashes)
+            print("Migrated %s to %s" % (filename, fingerprint_format))
+
+        for file_hash, sid in adverts.items():
+            print("No source file for advert %s (sha1 %s), it has no %s fingerprints"
+                  % (sid, file_hash, fingerprint_format))
+
+        self.db.store_fingerprint_format(fingerprint_format)
+        self.fingerprint_options = options
+        self.fingerprint_format = fingerprint_format
+
     def get_client_fingerprinted_adverts(self, client_ID):
         # get adverts previously indexed
         self.adverts = self.db.get_client_adverts(client_ID)
@@ -51,13 +195,91 @@ class Tramscore(object):
 
     def get_fingerprinted_adverts(self):
         # get adverts previously indexed
+        self.adverts_loaded_at = time.time()
         self.adverts = self.db.get_adverts()
         self.adverthashes_set = set()  # to know which ones we've computed before
         for advert in self.adverts:
             advert_hash = advert[Database.FIELD_FILE_SHA1]
             self.adverthashes_set.add(advert_hash)
 
+    def invalidate_adverts(self):
+        """
+        Marks the advert catalog as changed, e.g. after adverts were
+        fingerprinted by another process. The next refresh_adverts()
+        reloads it. Safe to call from a signal handler.
+        """
+        self._adverts_stale = True
+
+    def refresh_adverts(self, force=False):
+        """
+        Reloads the advert catalog if it was invalidated or is older than
+        advert_refresh_seconds.
+
+        returns: True if it was reloaded
+        """
+        if not (force or self._adverts_due()):
+            return False
+
+        with self._adverts_lock:
+            # another thread may have reloaded it while we waited
+            if not (force or self._adverts_due()):
+                return False
+            self._adverts_stale = False
+            self.get_fingerprinted_adverts()
+            self.load_advert_metadata()
+        return True
+
+    def load_advert_metadata(self):
+        """
+        Loads the rows and media stations of all adverts, two queries in
+        all instead of two per recognition.
+        """
+        media_stations = {}
+        for row in self.db.get_all_client_advert_media_stations():
+            media_stations.setdefault(row[Database.FIELD_ADVERT_ID], []).append(
+                row[Database.MEDIA_STATION_ID])
+
+        metadata = {}
+        for advert in self.db.get_all_client_adverts():
+            advert = dict(advert)
+            advert_id = advert.pop(Database.FIELD_ADVERT_ID)
+            metadata[advert_id] = (advert, _media_stations_list(media_stations.get(advert_id, [])))
+        self._advert_metadata = metadata
+
+    def invalidate_advert_metadata(self, advert_id):
+        self._advert_metadata.pop(advert_id, None)
+
+    def get_advert_metadata(self, advert_id):
+        """
+        returns: (advert row, media station list) of `advert_id`, or None
+                 for an unknown advert
+        """
+        metadata = self._advert_metadata.get(advert_id)
+        if metadata is None:
+            # e.g. inserted since the last load
+            advert = self.db.get_client_advert_by_id(advert_id)
+            if not advert:
+                return None
+            media_stations = self.db.get_client_advert_media_stations_by_id(advert_id)
+            metadata = (advert, _media_stations_list([media[Database.MEDIA_STATION_ID]
+                                                      for media in media_stations]))
+            self._advert_metadata[advert_id] = metadata
+        return metadata
+
+    def _adverts_due(self):
+        if self._adverts_stale:
+            return True
+        return (self.advert_refresh_seconds is not None and
+                time.time() - self.adverts_loaded_at >= self.advert_refresh_seconds)
+
     def fingerprint_directory(self, path, extensions, nprocesses=None):
+        """
+        Fingerprints the files in `path` that are not fingerprinted yet.
+
+        The workers hash the files and then fingerprint the new ones, the
+        adverts are written to the database by an _AdvertWriter thread
+        while the workers go on.
+        """
         # Try to use the maximum amount of processes if not given.
         try:
             nprocesses = nprocesses or multiprocessing.cpu_count()
@@ -66,50 +288,81 @@ class Tramscore(object):
         else:
             nprocesses = 1 if nprocesses <= 0 else nprocesses
 
-        pool = multiprocessing.Pool(nprocesses)
+        filenames = [filename for filename, _ in decoder.find_files(path, extensions)]
 
-        filenames_to_fingerprint = []
-        for filename, _ in decoder.find_files(path, extensions):
-
-            # don't refingerprint already fingerprinted files
-            if decoder.unique_hash(filename) in self.adverthashes_set:
-                print(("%s already fingerprinted, continuing..." % filename))
-                continue
-
-            filenames_to_fingerprint.append(filename)
-
-        # Prepare _fingerprint_worker input
-        worker_input = list(zip(filenames_to_fingerprint,
-                           [self.limit] * len(filenames_to_fingerprint)))
-
-        # Send off our tasks
-        iterator = pool.imap_unordered(_fingerprint_worker,
-                                       worker_input)
+        # the file hashes of the fingerprinted adverts, in one query
+        self.get_fingerprinted_adverts()
 
-        # Loop till we have all of them
-        while True:
+        # workers must not inherit open database connections
+        self.db.before_fork()
+        pool = multiprocessing.Pool(nprocesses)
+        completed = False
+        try:
+            # (filename, file_hash) of the new files
+            files_to_fingerprint = []
+            known = set(self.adverthashes_set)
+            for filename, file_hash in zip(filenames, pool.imap(decoder.unique_hash, filenames)):
+                # don't refingerprint already fingerprinted files, or copies
+                # of a file within the directory
+                if file_hash in known:
+                    print(("%s already fingerprinted, continuing..." % filename))
+                    continue
+                known.add(file_hash)
+                files_to_fingerprint.append((filename, file_hash))
+
+            # Prepare _fingerprint_worker input, the workers don't hash the
+            # files again
+            worker_input = [(filename, self.limit, None, self.fingerprint_options,
+                             self.fingerprint_cache, self.decoder, file_hash)
+                            for filename, file_hash in files_to_fingerprint]
+
+            writer = _AdvertWriter(self, maxsize=nprocesses)
+            writer.start()
+
+            # Send off our tasks
+            iterator = pool.imap_unordered(_fingerprint_worker_args,
+                                           worker_input)
+
+            # Loop till we have all of them
             try:
-                advert_name, hashes, file_hash, audio_length = next(iterator)
-            except multiprocessing.TimeoutError:
-                continue
-            except StopIteration:
-                break
-            except:
-                print("Failed fingerprinting")
-                # Print traceback because we can't reraise it here
-                traceback.print_exc(file=sys.stdout)
+                while True:
+                    try:
+                        result = next(iterator)
+                    except multiprocessing.TimeoutError:
+                        continue
+                    except StopIteration:
+                        break
+                    except:
+                        print("Failed fingerprinting")
+                        # Print traceback because we can't reraise it here
+                        traceback.print_exc(file=sys.stdout)
+                    else:
+                        writer.put(result)
+            finally:
+                writer.close()
+            completed = True
+        finally:
+            if completed:
+                pool.close()
             else:
-                # sid = self.db.insert_advert(advert_name, file_hash)
-                sid = self.db.insert_advert(advert_name, file_hash, audio_length)
-
-                self.db.insert_hashes(sid, hashes)
-                self.db.set_advert_fingerprinted(sid)
-                self.get_fingerprinted_adverts()
+                pool.terminate()
+            pool.join()
 
-        pool.close()
-        pool.join()
+        # adverthashes_set is up to date, the rest of the catalog reloads
+        # on the next refresh_adverts
+        self.invalidate_adverts()
 
-    def recognize_directory(self, path, extensions, nprocesses=None):
+    def recognize_directory(self, path, extensions, nprocesses=None, min_count=None):
+        """
+        Recognizes every file in `path` in `nprocesses` worker processes,
+        each a forked copy of this instance with its own database
+        connections that decodes, fingerprints and matches whole files.
+
+        Yields a dict per file in the order they finish:
+        {"file": path, "seconds": time spent on the file, "match": what
+        recognize (or with `min_count` recognize_all) returns}, or an
+        "error" message instead of "match".
+        """
         # Try to use the maximum amount of processes if not given.
         try:
             nprocesses = nprocesses or multiprocessing.cpu_count()
@@ -118,52 +371,28 @@ class Tramscore(object):
         else:
             nprocesses = 1 if nprocesses <= 0 else nprocesses
 
-        pool = multiprocessing.Pool(nprocesses)
-
-        filenames_to_recognize = []
-        for filename, _ in decoder.find_files(path, extensions):
-            """
-            # don't refingerprint already fingerprinted files
-            if decoder.unique_hash(filename) in self.adverthashes_set:
-                print ("%s already recognized, continuing..." % filename)
-                continue
-            """
-            filenames_to_recognize.append(filename)
-
-        return filenames_to_recognize
-
-        # Prepare _recognize_worker input
-        worker_input = list(zip(filenames_to_recognize,
-                                [self.limit] * len(filenames_to_recognize)))
-
-        # Send off our tasks
-        iterator = pool.imap_unordered(_recognize_worker,
-                                       worker_input)
-
-        # Loop till we have all of them
-        while True:
-            try:
-                filename = next(iterator)
-            except multiprocessing.TimeoutError:
-                continue
-            except StopIteration:
-                break
-            except:
-                print("Failed recognition")
-                # Print traceback because we can't reraise it here
-                traceback.print_exc(file=sys.stdout)
+        filenames_to_recognize = [filename for filename, _ in decoder.find_files(path, extensions)]
+
+        # workers start from the current catalog and must not inherit open
+        # database connections. They are forked explicitly: this instance
+        # holds locks and is handed over as is, not pickled as spawn and
+        # forkserver would
+        self.refresh_adverts()
+        self.db.before_fork()
+        pool = multiprocessing.get_context("fork").Pool(
+            nprocesses, initializer=_recognize_worker_init, initargs=(self, min_count))
+        completed = False
+        try:
+            for result in pool.imap_unordered(_recognize_worker, filenames_to_recognize):
+                yield result
+            completed = True
+        finally:
+            if completed:
+                pool.close()
             else:
-                
-                return filename
-                # """
-                # sid = self.db.insert_advert(advert_name, file_hash)
-                #
-                # self.db.insert_hashes(sid, hashes)
-                # self.db.set_advert_fingerprinted(sid)
-                # self.get_fingerprinted_adverts()
-                # """
-        pool.close()
-        pool.join()
+                # the caller stopped early or a worker died
+                pool.terminate()
+            pool.join()
 
     def fingerprint_file(self, filepath, advert_name=None):
         advertname = decoder.path_to_advertname(filepath)
@@ -177,12 +406,16 @@ class Tramscore(object):
             advert_name, hashes, file_hash, audio_length = _fingerprint_worker(
                 filepath,
                 self.limit,
-                advert_name=advert_name
+                advert_name=advert_name,
+                fingerprint_options=self.fingerprint_options,
+                cache=self.fingerprint_cache,
+                decoder_name=self.decoder,
+                file_hash=advert_hash
             )
             # sid = self.db.insert_advert(advert_name, file_hash)
             sid = self.db.insert_advert(advert_name, file_hash, audio_length)
 
-            self.db.insert_hashes(sid, hashes)
+            self._insert_hashes(sid, hashes)
             self.db.set_advert_fingerprinted(sid)
             self.get_fingerprinted_adverts()
 
@@ -208,9 +441,14 @@ class Tramscore(object):
             advert_name, hashes, file_hash, audio_length = _fingerprint_worker(
                 filepath,
                 self.limit,
-                advert_name=advert_name
+                advert_name=advert_name,
+                fingerprint_options=self.fingerprint_options,
+                cache=self.fingerprint_cache,
+                decoder_name=self.decoder,
+                file_hash=advert_hash
             )
             sid = self.db.insert_client_advert(advert_name, file_hash, audio_length, client_user_id)
+            self.invalidate_advert_metadata(sid)
 
             try:
                 print("Trying to insert media stations for advert id: %s" % sid)
@@ -218,10 +456,12 @@ class Tramscore(object):
                     self.db.insert_client_advert_media_stations(sid, media_station)
             except:
                 print("Sorry, couldn't insert media stations for Advert: %s" % advert_name)
+            finally:
+                self.invalidate_advert_metadata(sid)
 
             # print("\n..... %s \n....." % hashes)
             # hashes = _convert_hashes(hashes)
-            self.db.insert_hashes(sid, hashes)
+            self._insert_hashes(sid, hashes)
 
             self.db.set_advert_fingerprinted(sid)
             # self.get_fingerprinted_adverts()
@@ -232,50 +472,155 @@ class Tramscore(object):
             #     print("failed to update client campaign status...")
             #     print(err)
 
+    def _insert_hashes(self, sid, hashes):
+        """
+        Inserts the (keys, offsets) arrays of a _fingerprint_worker result,
+        INSERT_HASHES_CHUNK hashes at a time.
+        """
+        for chunk in _hash_chunks(*hashes):
+            self.db.insert_hashes(sid, chunk)
+
     def find_matches(self, samples, Fs=fingerprint.DEFAULT_FS):
-        hashes = fingerprint.fingerprint(samples, Fs=Fs)
+        hashes = fingerprint.fingerprint(samples, Fs=Fs,
+                                         **self.fingerprint_options)
+        return self.find_hash_matches(hashes)
+
+    def find_hash_matches(self, hashes):
+        """
+        Looks up already computed [(hash, offset), ...], e.g. the ones an
+        IncrementalFingerprinter returns for a stream segment.
+        """
         # return self.db.return_matches(hashes)
+        mapper, total_hashes = self._hash_mapper(hashes)
+        return self.db.return_matches(mapper), total_hashes
+
+    def _hash_mapper(self, hashes):
+        """
+        returns: ({hash: offset} as the database looks them up, number of
+                 hashes)
+        """
         mapper = {}
         total_hashes = 0
+        if self.fingerprint_format != fingerprint.FINGERPRINT_FORMAT_SHA1:
+            # packed keys are already what the database stores
+            for hash, offset in hashes:
+                mapper[hash] = offset
+                total_hashes += 1
+            return mapper, total_hashes
+
         for hash, offset in hashes:
             mapper[hash.upper()[:fingerprint.FINGERPRINT_REDUCTION]] = offset
             total_hashes += 1
-        return self.db.return_matches(mapper), total_hashes
+        return mapper, total_hashes
+
+    def align_channels(self, channels, Fs=fingerprint.DEFAULT_FS, min_count=None):
+        """
+            Fingerprints the `channels` and has the database count their
+            aligned matches, only the counts come back.
+
+            Returns what align_matches returns for the matches of every
+            channel, or with `min_count` what align_all_matches returns.
+        """
+        mappers = []
+        total_hashes = 0
+        for hashes in self.fingerprint_channels(channels, Fs=Fs):
+            mapper, channel_hashes = self._hash_mapper(hashes)
+            mappers.append(mapper)
+            total_hashes += channel_hashes
+
+        if min_count is None:
+            alignments = self.db.return_alignments(mappers, limit=1)
+            if not alignments:
+                return None
+            return self.advert_match(*alignments[0], total_hashes=total_hashes)
+
+        adverts = []
+        seen = set()
+        for advert_id, largest, largest_count in self.db.return_alignments(mappers,
+                                                                           min_count=min_count):
+            # the strongest offset of each advert
+            if advert_id in seen:
+                continue
+            seen.add(advert_id)
+            advert = self.advert_match(advert_id, largest, largest_count, total_hashes)
+            if advert is not None:
+                adverts.append(advert)
+        return adverts
+
+    def fingerprint_channels(self, channels, Fs=fingerprint.DEFAULT_FS):
+        """
+        Fingerprints the decoded `channels` of a recording as channel_mode
+        says.
+
+        returns: [[(hash, offset), ...], ...], the hashes of each lookup
+        """
+        return channel_hashes(channels, Fs=Fs, channel_mode=self.channel_mode,
+                              fingerprint_options=self.fingerprint_options)
 
-    def align_matches(self, matches, total_hashes):
+    def incremental_fingerprinter(self, Fs=fingerprint.DEFAULT_FS):
+        """
+        Returns an IncrementalFingerprinter using this instance's
+        fingerprint options, to fingerprint a stream chunk by chunk.
+        """
+        return IncrementalFingerprinter(Fs=Fs, **self.fingerprint_options)
+
+    def score_matches(self, matches, top_n=1):
+        """
+        Counts the (sid, diff) matches that agree on the same advert and
+        offset.
+
+        returns: up to `top_n` (advert_id, offset, count) tuples, the
+                 strongest first
+        """
+        sids, codes, diffs = align.match_arrays(matches)
+        codes, diffs, counts = align.top_alignments(codes, diffs, top_n)
+        return list(zip(sids[codes].tolist(), diffs.tolist(), counts.tolist()))
+
+    def align_matches(self, matches, total_hashes, min_count=None):
         # def align_matches(self, matches):
         """
             Finds hash matches that align in time with other matches and finds
             consensus about which hashes are "true" signal from the audio.
 
-            Returns a dictionary with match information.
+            Returns a dictionary with match information, or None if no
+            advert has `min_count` aligned hashes.
         """
         # align by diffs
-        diff_counter = {}
-        largest = 0
-        largest_count = 0
-        advert_id = -1
-        for tup in matches:
-            sid, diff = tup
-            if diff not in diff_counter:
-                diff_counter[diff] = {}
-            if sid not in diff_counter[diff]:
-                diff_counter[diff][sid] = 0
-            diff_counter[diff][sid] += 1
-
-            if diff_counter[diff][sid] > largest_count:
-                largest = diff
-                largest_count = diff_counter[diff][sid]
-                advert_id = sid
+        candidates = self.score_matches(matches)
+        if not candidates:
+            return None
+        advert_id, largest, largest_count = candidates[0]
+        if min_count is not None and largest_count < min_count:
+            # not reported anyway, skip the advert lookup
+            return None
+        return self.advert_match(advert_id, largest, largest_count, total_hashes)
 
+    def align_all_matches(self, matches, total_hashes, min_count):
+        """
+            Like align_matches, but returns a list with every advert that has
+            at least `min_count` hashes aligned at one offset, strongest
+            first, e.g. the end of one advert and the start of the next.
+        """
+        sids, codes, diffs = align.match_arrays(matches)
+        codes, diffs, counts = align.advert_alignments(codes, diffs, min_count)
+
+        adverts = []
+        for advert_id, largest, largest_count in zip(sids[codes].tolist(), diffs.tolist(),
+                                                     counts.tolist()):
+            advert = self.advert_match(advert_id, largest, largest_count, total_hashes)
+            if advert is not None:
+                adverts.append(advert)
+        return adverts
+
+    def advert_match(self, advert_id, largest, largest_count, total_hashes):
+        """
+            The match information of `advert_id`, aligned at offset `largest`
+            by `largest_count` of the `total_hashes` hashes.
+        """
         # extract idenfication
-        media_stations = self.db.get_client_advert_media_stations_by_id(advert_id)
-        # convert query results to a list
-        media_stations_list = (','.join([str(media["mediastation_id"]) for media in media_stations])).split(',')
-        # print("\nMedia Stations List: %s\n" % media_stations_list)
-
-        advert = self.db.get_client_advert_by_id(advert_id)
-        if advert:
+        metadata = self.get_advert_metadata(advert_id)
+        if metadata:
+            advert, media_stations_list = metadata
             # TODO: Clarify what `get_advert_by_id` should return.
             advertname = advert.get(Tramscore.ADVERT_NAME, None)
         else:
@@ -304,6 +649,104 @@ class Tramscore(object):
         r = recognizer(self)
         return r.recognize(*options, **kwoptions)
 
+    def recognize_all(self, recognizer, min_count, *options, **kwoptions):
+        """
+        Like recognize, but returns a list of every advert with at least
+        `min_count` aligned hashes.
+        """
+        r = recognizer(self, min_count=min_count)
+        return r.recognize(*options, **kwoptions)
+
+    def recognize_path(self, path, min_count=None):
+        """
+        Recognizes one audio file with this long-lived instance, refreshing
+        the advert catalog first when it is due. With `min_count`, returns
+        a list like recognize_all.
+        """
+        from .recognize import FileRecognizer
+
+        self.refresh_adverts()
+        if min_count is not None:
+            return self.recognize_all(FileRecognizer, min_count, path)
+        return self.recognize(FileRecognizer, path)
+
+
+def channel_hashes(channels, Fs=fingerprint.DEFAULT_FS, channel_mode=CHANNELS_SEPARATE,
+                   fingerprint_options=None):
+    """
+    Fingerprints `channels` in `channel_mode`, see CHANNEL_MODES. A mono
+    recording is fingerprinted once in every mode.
+
+    returns: [[(hash, offset), ...], ...], one list per channel for
+             "separate", a single list otherwise
+    """
+    fingerprint_options = fingerprint_options or {}
+    if channel_mode == CHANNELS_MONO and len(channels) > 1:
+        # the channel average, like ffmpeg -ac 1
+        length = min(len(samples) for samples in channels)
+        mixed = np.zeros(length, dtype=np.int32)
+        for samples in channels:
+            mixed += samples[:length]
+        channels = [(mixed // len(channels)).astype(np.int16)]
+
+    hashes = [fingerprint.fingerprint(samples, Fs=Fs, **fingerprint_options)
+              for samples in channels]
+    if channel_mode == CHANNELS_DEDUP and len(hashes) > 1:
+        # in channel order, so the offset kept for a hash does not vary
+        hashes = [list(dict.fromkeys(hash for channel in hashes for hash in channel))]
+    return hashes
+
+
+# seconds of a channel fingerprinted at a time by _fingerprint_worker
+FINGERPRINT_STEP_SECONDS = 60
+# hashes of a fingerprinted file handed to Database.insert_hashes at a time
+INSERT_HASHES_CHUNK = 10000
+
+
+class _AdvertWriter(threading.Thread):
+    """
+    Writes the (advert_name, hashes, file_hash, audio_length) results of
+    _fingerprint_worker to the database, one after the other in its own
+    thread, and adds them to the adverthashes_set of `tramscore`.
+    """
+
+    def __init__(self, tramscore, maxsize=0):
+        super(_AdvertWriter, self).__init__(name="advert-writer")
+        self.daemon = True
+        self.tramscore = tramscore
+        self.queue = queue.Queue(maxsize)
+
+    def put(self, result):
+        self.queue.put(result)
+
+    def close(self):
+        """ Writes what is queued and stops.
+        """
+        self.queue.put(None)
+        self.join()
+
+    def run(self):
+        db = self.tramscore.db
+        while True:
+            result = self.queue.get()
+            if result is None:
+                return
+            advert_name, hashes, file_hash, audio_length = result
+            try:
+                sid = db.insert_advert(advert_name, file_hash, audio_length)
+                self.tramscore._insert_hashes(sid, hashes)
+                db.set_advert_fingerprinted(sid)
+            except Exception:
+                print("Failed storing %s" % advert_name)
+                traceback.print_exc(file=sys.stdout)
+            else:
+                self.tramscore.adverthashes_set.add(file_hash)
+
+
+def _media_stations_list(media_station_ids):
+    # "1,2" style ids as a list of strings, [''] for none
+    return (','.join([str(media_station_id) for media_station_id in media_station_ids])).split(',')
+
 
 def _convert_hashes(hashes=None):
     new_hashes = set()
@@ -314,19 +757,41 @@ def _convert_hashes(hashes=None):
     return new_hashes
 
 
-def _fingerprint_worker(filename, limit=None, advert_name=None):
-    # Pool.imap sends arguments as tuples so we have to unpack
-    # them ourself.
-    try:
-        filename, limit = filename
-    except ValueError:
-        pass
+def _fingerprint_worker(filename, limit=None, advert_name=None,
+                        fingerprint_options=None, cache=None,
+                        decoder_name=decoder.DEFAULT_DECODER, file_hash=None):
+    """
+    Fingerprints every channel of a file, FINGERPRINT_STEP_SECONDS at a
+    time, so only the hashes of one step are held as Python tuples. With a
+    FingerprintCache a file fingerprinted before is not decoded again.
+
+    file_hash: decoder.unique_hash of the file when the caller already has
+               it, the file is then only read to decode it
+
+    returns: (advert_name, (keys, offsets), file_hash, audio_length), the
+             distinct hashes of all channels as arrays, see _unique_hashes
+    """
+    fingerprint_options = fingerprint_options or {}
+    fingerprint_format = fingerprint_options.get("fingerprint_format",
+                                                 fingerprint.DEFAULT_FINGERPRINT_FORMAT)
 
     advertname, extension = os.path.splitext(os.path.basename(filename))
     advert_name = advert_name or advertname
+    # the decoder changes the samples, so the hashes
+    cache_options = dict(fingerprint_options, decoder=decoder_name)
+    if cache is not None:
+        # the cache is looked up by content
+        file_hash = file_hash or decoder.unique_hash(filename)
+        cached = cache.get(file_hash, limit, cache_options)
+        if cached is not None:
+            print("Using cached fingerprints for %s" % filename)
+            hashes, audio_length = cached
+            return advert_name, hashes, file_hash, audio_length
+
     # channels, Fs, file_hash = decoder.read(filename, limit)
-    channels, Fs, file_hash, audio_length = decoder.read(filename, limit)
-    result = set()
+    channels, Fs, file_hash, audio_length = decoder.read(filename, limit, file_hash,
+                                                         decoder=decoder_name)
+    keys, offsets = [], []
     channel_amount = len(channels)
 
     for channeln, channel in enumerate(channels):
@@ -334,42 +799,103 @@ def _fingerprint_worker(filename, limit=None, advert_name=None):
         print(("Fingerprinting channel %d/%d for %s" % (channeln + 1,
                                                        channel_amount,
                                                        filename)))
-        hashes = fingerprint.fingerprint(channel, Fs=Fs)
+        # the same hashes as fingerprint.fingerprint on the whole channel
+        fingerprinter = IncrementalFingerprinter(Fs=Fs, **fingerprint_options)
+        step = FINGERPRINT_STEP_SECONDS * Fs
+        for start in range(0, len(channel), step):
+            _append_hash_arrays(fingerprinter.feed(channel[start:start + step]),
+                                fingerprint_format, keys, offsets)
+        _append_hash_arrays(fingerprinter.flush(), fingerprint_format, keys, offsets)
         print(("Finished channel %d/%d for %s" % (channeln + 1, channel_amount,
                                                  filename)))
-        result |= set(hashes)
 
+    hashes = _unique_hashes(keys, offsets, fingerprint_format)
+    if cache is not None:
+        cache.put(file_hash, limit, cache_options, hashes, audio_length)
     # return advert_name, result, file_hash
-    return advert_name, result, file_hash, audio_length
+    return advert_name, hashes, file_hash, audio_length
 
 
-def _recognize_worker(filename, limit=None, advert_name=None):
-    # Pool.imap sends arguments as tuples so we have to unpack
-    # them ourself.
-    try:
-        filename, limit = filename
-    except ValueError:
-        pass
+def _fingerprint_worker_args(args):
+    # Pool.imap passes one argument, the tuple of _fingerprint_worker's
+    return _fingerprint_worker(*args)
+
+
+def _hash_dtype(fingerprint_format):
+    # sha1 hex digests as ascii bytes, packed keys as integers
+    if fingerprint_format == fingerprint.FINGERPRINT_FORMAT_SHA1:
+        return np.dtype("S%d" % fingerprint.FINGERPRINT_REDUCTION)
+    return np.dtype(np.uint64)
+
+
+def _append_hash_arrays(hashes, fingerprint_format, keys, offsets):
+    if hashes:
+        keys.append(np.array([hash for hash, _ in hashes], dtype=_hash_dtype(fingerprint_format)))
+        offsets.append(np.array([offset for _, offset in hashes], dtype=np.int64))
+
+
+def _unique_hashes(keys, offsets, fingerprint_format):
     """
-    advertname, extension = os.path.splitext(os.path.basename(filename))
-    advert_name = advert_name or advertname
-    channels, Fs, file_hash = decoder.read(filename, limit)
-    result = set()
-    channel_amount = len(channels)
+    The distinct (hash, offset) pairs of lists of key and offset arrays.
+
+    returns: (keys, offsets) arrays, sorted
+    """
+    rows = np.zeros(sum(len(k) for k in keys),
+                    dtype=[("key", _hash_dtype(fingerprint_format)), ("offset", np.int64)])
+    if keys:
+        rows["key"] = np.concatenate(keys)
+        rows["offset"] = np.concatenate(offsets)
+    rows = np.unique(rows)
+    return rows["key"], rows["offset"]
 
-    for channeln, channel in enumerate(channels):
-        # TODO: Remove prints or change them into optional logging.
-        print("Fingerprinting channel %d/%d for %s" % (channeln + 1,
-                                                       channel_amount,
-                                                       filename))
-        hashes = fingerprint.fingerprint(channel, Fs=Fs)
-        print("Finished channel %d/%d for %s" % (channeln + 1, channel_amount,
-                                                 filename))
-        result |= set(hashes)
 
-    return advert_name, result, file_hash
+def _hash_chunks(keys, offsets, size=None):
     """
-    return filename
+    Yields the (keys, offsets) arrays as [(hash, offset), ...] lists of at
+    most `size` hashes, as fingerprint.fingerprint returns them.
+    """
+    size = size or INSERT_HASHES_CHUNK
+    sha1 = keys.dtype.kind == "S"
+    for start in range(0, len(keys), size):
+        chunk_keys = keys[start:start + size].tolist()
+        if sha1:
+            chunk_keys = [key.decode("ascii") for key in chunk_keys]
+        yield list(zip(chunk_keys, offsets[start:start + size].tolist()))
+
+
+# the forked Tramscore instance of a recognize_directory worker, and its
+# min_count
+_worker_tramscore = None
+_worker_min_count = None
+
+
+def _recognize_worker_init(tramscore, min_count=None):
+    global _worker_tramscore, _worker_min_count
+    tramscore.db.after_fork()
+    _worker_tramscore = tramscore
+    _worker_min_count = min_count
+
+
+def _recognize_worker(filename):
+    from .recognize import DirFileRecognizer
+
+    t = time.time()
+    result = {"file": filename}
+    try:
+        if _worker_min_count is None:
+            match = _worker_tramscore.recognize(DirFileRecognizer, filename)
+        else:
+            match = _worker_tramscore.recognize_all(DirFileRecognizer, _worker_min_count,
+                                                    filename)
+    except Exception as err:
+        result["error"] = "%s: %s" % (type(err).__name__, err)
+    else:
+        for advert in (match if isinstance(match, list) else [match]):
+            if advert:
+                advert[Tramscore.ADVERT_NAME] = advert[Tramscore.ADVERT_NAME].decode("utf8")
+        result["match"] = match
+    result["seconds"] = round(time.time() - t, 3)
+    return result
 
 
 def chunkify(lst, n):
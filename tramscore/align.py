@@ -0,0 +1,119 @@
+""" Offset alignment of hash matches.
+
+Every (sid, diff) match votes for advert `sid` airing `diff` frames into
+the query. Real detections pile many votes on one (sid, diff) pair, chance
+hash collisions spread theirs out. Votes are binned by a combined
+(advert code, diff) int64 key with np.bincount, or np.unique when the keys
+are too sparse, instead of a dict per diff.
+"""
+from __future__ import absolute_import
+
+import itertools
+
+import numpy as np
+
+# bin with np.bincount while the (code, diff) key range is at most this
+# many times the number of matches, else sort with np.unique
+BINCOUNT_RANGE_FACTOR = 2
+
+
+def match_arrays(matches):
+    """
+    [(sid, diff), ...] to arrays.
+
+    returns: (sids, codes, diffs), sids the distinct advert identifiers and
+             codes the position of each match's advert in sids
+    """
+    if not isinstance(matches, list):
+        matches = list(matches)
+    if not matches:
+        return (np.zeros(0, dtype=object), np.zeros(0, dtype=np.int64),
+                np.zeros(0, dtype=np.int64))
+
+    try:
+        # integer advert ids (mysql), one pass over the tuples
+        flat = np.fromiter(itertools.chain.from_iterable(matches), dtype=np.int64,
+                           count=2 * len(matches))
+        sids, diffs = flat[0::2], flat[1::2]
+    except (TypeError, ValueError):
+        # uuid strings (postgresql)
+        sids, diffs = zip(*matches)
+        sids, diffs = np.asarray(sids), np.asarray(diffs, dtype=np.int64)
+    sids, codes = np.unique(sids, return_inverse=True)
+    return sids, codes.astype(np.int64), diffs
+
+
+def count_alignments(codes, diffs):
+    """
+    Counts the matches of every distinct (advert code, diff) pair.
+
+    returns: (codes, diffs, counts, reached), reached the position in the
+             match order at which each pair reached its count
+    """
+    if not len(diffs):
+        empty = np.zeros(0, dtype=np.int64)
+        return empty, empty, empty, empty
+
+    low = diffs.min()
+    span = int(diffs.max() - low) + 1
+    keys = codes * span + (diffs - low)
+    key_range = (int(codes.max()) + 1) * span
+
+    # the last match of a pair is where it reached its count, repeated
+    # indices keep the last assignment
+    if key_range <= BINCOUNT_RANGE_FACTOR * len(keys):
+        counts = np.bincount(keys, minlength=key_range)
+        reached = np.zeros(key_range, dtype=np.int64)
+        reached[keys] = np.arange(len(keys))
+        pairs = np.flatnonzero(counts)
+        counts, reached = counts[pairs], reached[pairs]
+    else:
+        pairs, inverse, counts = np.unique(keys, return_inverse=True, return_counts=True)
+        reached = np.zeros(len(pairs), dtype=np.int64)
+        reached[inverse] = np.arange(len(keys))
+
+    return pairs // span, pairs % span + low, counts, reached
+
+
+def _strongest_first(counts, reached):
+    # most matches first, of equal counts the pair that got there first
+    return np.lexsort((reached, -counts))
+
+
+def top_alignments(codes, diffs, top_n=1):
+    """
+    returns: (codes, diffs, counts) of the `top_n` (advert code, diff)
+             pairs with the most matches, strongest first. Of pairs with
+             equal counts the one that reached its count first in the
+             match order comes first, as in the dict based scorer.
+    """
+    codes, diffs, counts, reached = count_alignments(codes, diffs)
+
+    if top_n is None or top_n >= len(counts):
+        order = _strongest_first(counts, reached)
+    else:
+        # only sort the pairs that can make the cut
+        cutoff = np.partition(counts, len(counts) - top_n)[len(counts) - top_n]
+        candidates = np.flatnonzero(counts >= cutoff)
+        order = candidates[_strongest_first(counts[candidates], reached[candidates])][:top_n]
+
+    return codes[order], diffs[order], counts[order]
+
+
+def advert_alignments(codes, diffs, min_count):
+    """
+    The strongest (advert code, diff) pair of every advert with at least
+    `min_count` matches at one diff, e.g. the end of one advert and the
+    start of the next in the same segment.
+
+    returns: (codes, diffs, counts), one entry per advert, strongest first
+    """
+    codes, diffs, counts, reached = count_alignments(codes, diffs)
+
+    keep = np.flatnonzero(counts >= min_count)
+    order = keep[_strongest_first(counts[keep], reached[keep])]
+    # the first, strongest, pair of each advert
+    _, first = np.unique(codes[order], return_index=True)
+    order = order[np.sort(first)]
+
+    return codes[order], diffs[order], counts[order]
@@ -0,0 +1,239 @@
+""" Process-wide pools of idle database connections for the SQL backends.
+
+A backend subclasses ConnectionPool with how to connect to its server, how
+to ping a connection and the error class of its driver, and PooledCursor
+with how to open a cursor on a connection:
+
+```python
+class ConnectionPool(connection_pool.ConnectionPool):
+    Error = driver.Error
+
+    def connect(self):
+        return driver.connect(**self.options)
+
+    def ping(self, conn):
+        conn.ping()
+```
+
+Forked processes start with empty pools, the connections of the parent
+are never used or closed in the child.
+"""
+from __future__ import absolute_import
+
+import logging
+import os
+import threading
+import time
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+# idle connections kept per process and connection options
+DEFAULT_POOL_SIZE = 5
+# seconds an idle connection is kept, well below MySQL's default wait_timeout
+DEFAULT_POOL_MAX_IDLE = 300
+
+
+class ConnectionPool(object):
+    """
+    Process-wide pool of idle connections, one per backend and set of
+    connection options.
+
+    A connection is pinged when it is taken out and replaced by a new one
+    if it is dead or was idle longer than `max_idle` seconds. At most
+    `size` idle connections are kept, the rest are closed when returned.
+    Pools notice they were inherited by a forked process and start empty
+    there.
+    """
+    # raised by the driver for dead connections, see ping()
+    Error = Exception
+    # name of the backend in log messages
+    name = "DATABASE"
+
+    # every pool of every backend, by (class, connection options)
+    _pools = {}
+    _pools_lock = threading.Lock()
+
+    def __init__(self, size=DEFAULT_POOL_SIZE, max_idle=DEFAULT_POOL_MAX_IDLE, **options):
+        super(ConnectionPool, self).__init__()
+        self.size = size
+        self.max_idle = max_idle
+        self.options = options
+        self._lock = threading.Lock()
+        self._reset()
+
+    @classmethod
+    def get(cls, size=DEFAULT_POOL_SIZE, max_idle=DEFAULT_POOL_MAX_IDLE, **options):
+        key = (cls,) + tuple(sorted(options.items()))
+        pool = ConnectionPool._pools.get(key)
+        if pool is None:
+            with ConnectionPool._pools_lock:
+                pool = ConnectionPool._pools.get(key)
+                if pool is None:
+                    pool = ConnectionPool._pools[key] = cls(size, max_idle, **options)
+        return pool
+
+    @classmethod
+    def pools(cls):
+        return [pool for pool in list(ConnectionPool._pools.values()) if isinstance(pool, cls)]
+
+    @classmethod
+    def close_all(cls):
+        for pool in cls.pools():
+            pool.close()
+
+    @classmethod
+    def reset_all(cls):
+        """
+        Resets the pools in a forked child, see reset().
+        """
+        ConnectionPool._pools_lock = threading.Lock()
+        for pool in cls.pools():
+            pool.reset()
+
+    def _reset(self):
+        self._pid = os.getpid()
+        # (connection, time it was returned), the most recent last
+        self._idle = deque()
+        # connections of the parent process, see reset()
+        self._inherited = []
+
+    def reset(self):
+        """
+        Forgets the idle connections after a fork. They are kept referenced
+        but never used or closed: closing one would end the parent's session.
+
+        Only called in the forked child, which has a single thread. The lock
+        is not taken but replaced: a thread of the parent, e.g. a lookup
+        worker, may have held it at the fork and it is never released here.
+        """
+        self._lock = threading.Lock()
+        inherited = self._inherited + [conn for conn, _ in self._idle]
+        self._reset()
+        self._inherited = inherited
+
+    def _check_pid(self):
+        if self._pid != os.getpid():
+            self.reset()
+
+    def connect(self):
+        raise NotImplementedError()
+
+    def ping(self, conn):
+        """
+        Raises self.Error if `conn` is no longer usable.
+        """
+        raise NotImplementedError()
+
+    def closed(self, conn):
+        return False
+
+    def checkout(self):
+        """
+        returns: a live connection, an idle one if there is one
+        """
+        self._check_pid()
+        while True:
+            with self._lock:
+                if not self._idle:
+                    break
+                conn, returned = self._idle.pop()
+
+            if self.closed(conn) or time.time() - returned > self.max_idle:
+                self._close(conn)
+                continue
+            try:
+                self.ping(conn)
+            except self.Error:
+                # dropped by the server, reconnect
+                self._close(conn)
+                continue
+            return conn
+
+        logger.debug("%s: opening connection..." % self.name)
+        return self.connect()
+
+    def checkin(self, conn):
+        if self._pid != os.getpid():
+            # taken out before a fork, belongs to the other process
+            return
+        if not self.closed(conn):
+            with self._lock:
+                if len(self._idle) < self.size:
+                    self._idle.append((conn, time.time()))
+                    return
+        self._close(conn)
+
+    def discard(self, conn):
+        self._close(conn)
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, deque()
+        for conn, _ in idle:
+            self._close(conn)
+
+    def _close(self, conn):
+        try:
+            conn.close()
+        except self.Error:
+            pass
+
+
+class PooledCursor(object):
+    """
+    Checks out a pooled connection and returns an open cursor. The
+    transaction is committed, or rolled back on errors, and the connection
+    returned to the pool on exit.
+
+    ```python
+    # Use as context manager
+    with Cursor(DictCursor, pool) as cur:
+        cur.execute(query)
+    ```
+    """
+
+    def __init__(self, cursor_type=None, pool=None):
+        super(PooledCursor, self).__init__()
+        self.pool = pool
+        self.cursor_type = cursor_type
+        self.conn = None
+        self.cursor = None
+
+    @classmethod
+    def clear_cache(cls):
+        ConnectionPool.reset_all()
+
+    def open(self, conn):
+        """
+        returns: a cursor of self.cursor_type on `conn`
+        """
+        raise NotImplementedError()
+
+    def __enter__(self):
+        self.conn = self.pool.checkout()
+        self.cursor = self.open(self.conn)
+        return self.cursor
+
+    def __exit__(self, extype, exvalue, traceback):
+        conn, self.conn = self.conn, None
+        try:
+            self.cursor.close()
+            if extype is None:
+                conn.commit()
+            else:
+                # if we had an error we try to rollback the transaction.
+                logger.error("%s ERROR: trying to rollback..." % self.pool.name)
+                conn.rollback()
+        except self.pool.Error as err:
+            logger.error("%s ERROR: dropping connection: %s" % (self.pool.name, err))
+            self.pool.discard(conn)
+            if extype is None:
+                raise
+        else:
+            self.pool.checkin(conn)
+
+
+if hasattr(os, "register_at_fork"):
+    # multiprocessing workers start with empty pools
+    os.register_at_fork(after_in_child=ConnectionPool.reset_all)
@@ -1,5 +1,11 @@
 
 import abc
+import itertools
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from . import align
+from .fingerprint import DEFAULT_PEAK_PICKER, FINGERPRINT_FORMAT_SHA1
 
 
 class Database(object, metaclass=abc.ABCMeta):
@@ -13,18 +19,34 @@ class Database(object, metaclass=abc.ABCMeta):
     # CLIENT_ID = 0
     MEDIA_STATION_ID = 'mediastation_id'
 
+    # Key in the schema table that records the fingerprint format
+    SCHEMA_FINGERPRINT_FORMAT = 'fingerprint_format'
+    # Prefix of the recorded format while fingerprints are being migrated
+    # into the format that follows it
+    SCHEMA_MIGRATING_PREFIX = 'migrating:'
+
+    # Format of the fingerprints this instance reads and writes,
+    # one of fingerprint.FINGERPRINT_FORMATS
+    fingerprint_format = FINGERPRINT_FORMAT_SHA1
+    # Peak picker the fingerprints were computed with, recorded by indexes
+    # built from them, one of fingerprint.PEAK_PICKERS
+    peak_picker = DEFAULT_PEAK_PICKER
+
     # Name of your Database subclass, this is used in configuration
     # to refer to your class
     type = None
 
     def __init__(self):
         super(Database, self).__init__()
+        # see lookup_executor()
+        self._lookup_executor = None
+        self._lookup_executor_lock = threading.Lock()
 
     def before_fork(self):
         """
         Called before the database instance is given to the new process
         """
-        pass
+        self.shutdown_lookups()
 
     def after_fork(self):
         """
@@ -32,7 +54,36 @@ class Database(object, metaclass=abc.ABCMeta):
 
         This will be called in the new process.
         """
-        pass
+        # the threads of an executor the parent still had are not in the
+        # child, and one of them may have held the lock
+        self._lookup_executor = None
+        self._lookup_executor_lock = threading.Lock()
+
+    def close(self):
+        """
+        Releases the threads and connections of this instance.
+        """
+        self.shutdown_lookups()
+
+    def lookup_executor(self, workers):
+        """
+        The thread pool of `workers` threads that runs this instance's
+        concurrent lookups, see lookup_chunks. Created on first use and
+        kept until before_fork or close. None for a single worker, lookups
+        then run in the calling thread.
+        """
+        if workers <= 1:
+            return None
+        with self._lookup_executor_lock:
+            if self._lookup_executor is None:
+                self._lookup_executor = ThreadPoolExecutor(max_workers=workers)
+            return self._lookup_executor
+
+    def shutdown_lookups(self):
+        with self._lookup_executor_lock:
+            executor, self._lookup_executor = self._lookup_executor, None
+        if executor is not None:
+            executor.shutdown(wait=True)
 
     def setup(self):
         """
@@ -47,6 +98,31 @@ class Database(object, metaclass=abc.ABCMeta):
         """
         pass
 
+    @abc.abstractmethod
+    def reset_fingerprints(self):
+        """
+        Called when all fingerprints of the current fingerprint format
+        should be dropped, e.g. before re-fingerprinting into a new format.
+        """
+        pass
+
+    @abc.abstractmethod
+    def get_stored_fingerprint_format(self):
+        """
+        Returns the fingerprint format recorded for the stored fingerprints,
+        or None for databases created before the format was recorded.
+        """
+        pass
+
+    @abc.abstractmethod
+    def store_fingerprint_format(self, fingerprint_format):
+        """
+        Records the fingerprint format of the stored fingerprints.
+
+        fingerprint_format: One of fingerprint.FINGERPRINT_FORMATS
+        """
+        pass
+
     @abc.abstractmethod
     def delete_unfingerprinted_adverts(self):
         """
@@ -99,7 +175,8 @@ class Database(object, metaclass=abc.ABCMeta):
         """
         Inserts a single fingerprint into the database.
 
-          hash: Part of a sha1 hash, in hexadecimal format
+          hash: Part of a sha1 hash, in hexadecimal format, or a packed
+                integer key for the packed fingerprint formats
            sid: Advert identifier this fingerprint is off
         offset: The offset this hash is from
         """
@@ -132,6 +209,18 @@ class Database(object, metaclass=abc.ABCMeta):
         """
         pass
 
+    @abc.abstractmethod
+    def get_fingerprints(self, sid=None):
+        """
+        Returns every fingerprint of the current fingerprint format as
+        (hash, sid, offset) tuples, or only the ones of one advert.
+
+        sid: Advert identifier, None for all adverts
+        hash: The stored key, the raw bytes of the sha1 prefix or a
+              packed integer key
+        """
+        pass
+
     @abc.abstractmethod
     def insert_hashes(self, sid, hashes):
         """
@@ -160,6 +249,26 @@ class Database(object, metaclass=abc.ABCMeta):
         """
         pass
 
+    def return_alignments(self, mappers, limit=None, min_count=None):
+        """
+        Counts the matches of the {hash: sample_offset} `mappers`, e.g. one
+        per channel, per (sid, offset_difference) pair.
+
+        Returns up to `limit` (sid, offset_difference, count) tuples with
+        at least `min_count` matches, the most matches first.
+
+        Counted from return_matches here, the SQL databases count in the
+        database and only send the counts.
+        """
+        matches = itertools.chain.from_iterable(self.return_matches(mapper) for mapper in mappers)
+        sids, codes, diffs = align.match_arrays(matches)
+        codes, diffs, counts = align.top_alignments(codes, diffs,
+                                                    limit if min_count is None else None)
+        alignments = zip(sids[codes].tolist(), diffs.tolist(), counts.tolist())
+        if min_count is not None:
+            alignments = [alignment for alignment in alignments if alignment[2] >= min_count]
+        return list(alignments)[:limit]
+
     @abc.abstractmethod
     def insert_client_advert(self, advert_name, client_user_id):
         """
@@ -207,6 +316,21 @@ class Database(object, metaclass=abc.ABCMeta):
         """
         pass
 
+    @abc.abstractmethod
+    def get_all_client_adverts(self):
+        """
+        Returns every advert as a row with its advert id, name, file sha1,
+        client user id and audio length.
+        """
+        pass
+
+    @abc.abstractmethod
+    def get_all_client_advert_media_stations(self):
+        """
+        Returns every (advert id, media station id) row.
+        """
+        pass
+
     @abc.abstractmethod
     def update_client_campaign(self, advert_name, client_user_id):
         """
@@ -226,6 +350,8 @@ def get_database(database_type=None):
         import tramscore.database_postgres
     elif database_type == 'mysql':
         import tramscore.database_sql
+    elif database_type == 'memory':
+        import tramscore.database_memory
 
     for db_cls in Database.__subclasses__():
         if db_cls.type == database_type:
@@ -234,5 +360,45 @@ def get_database(database_type=None):
     raise TypeError("Unsupported database type supplied, Fred.")
 
 
+# return_matches strategies of the SQL backends: hash lists in chunks of
+# queries, or a temporary table of the hashes joined to the fingerprints
+LOOKUP_CHUNKS = "chunks"
+LOOKUP_TEMP_TABLE = "temp_table"
+LOOKUP_STRATEGIES = (LOOKUP_CHUNKS, LOOKUP_TEMP_TABLE)
+
+
+def lookup_chunks(lookup, values, chunk_size, executor=None):
+    """
+    Calls `lookup(chunk)` on `chunk_size` slices of the `values` list, in
+    the threads of `executor` (see Database.lookup_executor) or else one
+    after the other, and yields the items of the lists it returns as each
+    chunk completes.
+    """
+    chunks = [values[i:i + chunk_size] for i in range(0, len(values), chunk_size)]
+    if executor is None or len(chunks) <= 1:
+        for chunk in chunks:
+            for item in lookup(chunk):
+                yield item
+        return
+
+    futures = [executor.submit(lookup, chunk) for chunk in chunks]
+    try:
+        for future in as_completed(futures):
+            for item in future.result():
+                yield item
+    finally:
+        # the consumer stopped early or a lookup failed
+        for future in futures:
+            future.cancel()
+
+
+class FingerprintFormatError(Exception):
+    """
+    Raised when the configured fingerprint format does not match the
+    format of the fingerprints stored in the database.
+    """
+    pass
+
+
 # Import our default database handler
 # import tramscore.database_sql
@@ -0,0 +1,359 @@
+""" In-process fingerprint index in front of a SQL database.
+
+Fingerprints are held in a FingerprintIndex (see fingerprint_index.py),
+so recognition does not wait on the database. Adverts, media stations and
+everything else are still read from and written to the backend database.
+
+Config:
+
+    "database_type": "memory",
+    "database": {
+        "backend": "mysql",
+        "host": "127.0.0.1", "user": "root", "passwd": "...", "db": "test_db",
+        "index_file": "/var/lib/tramscore/fingerprints.idx"
+    }
+
+The index follows the backend: fingerprints inserted through it are added
+right away, and adverts fingerprinted by other processes are loaded when
+the advert catalog is reloaded (Tramscore.refresh_adverts).
+
+With "index_file" the bulk of the index is a memory mapped file shared by
+every process (built from the backend if missing). Each process only keeps
+the adverts the file lacks in memory. A process that fingerprints adverts
+rewrites the file when its catalog is reloaded afterwards, the others
+switch to the new file on their next reload.
+"""
+from __future__ import absolute_import
+
+import logging
+import threading
+
+import numpy as np
+
+from .database import Database, get_database
+from .fingerprint_index import (FingerprintIndex, IndexFile, IndexFormatError,
+                                build_index_file, hash_key, index_arrays, key_dtype,
+                                write_index)
+
+logger = logging.getLogger(__name__)
+
+
+class MemoryDatabase(Database):
+    """
+    Answers return_matches from a FingerprintIndex, or an IndexFile plus
+    a FingerprintIndex of the adverts not in the file yet, and delegates
+    the rest to the backend database.
+    """
+    type = "memory"
+
+    def __init__(self, backend="mysql", index_file=None, **options):
+        super(MemoryDatabase, self).__init__()
+        self.backend = get_database(backend)(**options)
+        self.index_file = index_file
+
+        # advert identifiers by code and codes by identifier, of _index
+        self._sids = []
+        self._codes = {}
+        self._lock = threading.Lock()
+        self._loaded = False
+        # adverts were fingerprinted since the index file was written
+        self._dirty = False
+        self._index = FingerprintIndex.empty(key_dtype(self.fingerprint_format))
+        self._file = None
+
+    @property
+    def fingerprint_format(self):
+        return self.backend.fingerprint_format
+
+    @fingerprint_format.setter
+    def fingerprint_format(self, fingerprint_format):
+        if fingerprint_format != self.backend.fingerprint_format:
+            self.backend.fingerprint_format = fingerprint_format
+            self._clear()
+
+    def index_options(self):
+        """
+        The fingerprint options recorded in and checked against the index
+        file header.
+        """
+        return {"fingerprint_format": self.fingerprint_format, "peak_picker": self.peak_picker}
+
+    def _clear(self):
+        with self._lock:
+            self._loaded = False
+            self._index = FingerprintIndex.empty(key_dtype(self.fingerprint_format))
+            self._file = None
+
+    def _code(self, sid):
+        code = self._codes.get(sid)
+        if code is None:
+            code = self._codes[sid] = len(self._sids)
+            self._sids.append(sid)
+        return code
+
+    def _arrays(self, rows):
+        return index_arrays(rows, self.fingerprint_format)
+
+    @property
+    def num_indexed(self):
+        return len(self._index) + (len(self._file.index) if self._file else 0)
+
+    def load(self, sids=None):
+        """
+        (Re)builds the index from the backend, or opens the index file.
+        `sids` restricts it to those adverts, e.g. the fully fingerprinted
+        ones.
+        """
+        if self.index_file:
+            index_file = self._open_index_file()
+            if index_file is None:
+                logger.info("Building %s" % self.index_file)
+                build_index_file(self.backend, self.index_file, self.index_options())
+                index_file = IndexFile.open(self.index_file, self.index_options())
+            with self._lock:
+                self._file = index_file
+                self._index = FingerprintIndex.empty(key_dtype(self.fingerprint_format))
+                self._loaded = True
+            return
+
+        wanted = None if sids is None else set(sids)
+        rows = [(hash, self._code(sid), offset)
+                for hash, sid, offset in self.backend.get_fingerprints()
+                if wanted is None or sid in wanted]
+        index = FingerprintIndex.build(*self._arrays(rows))
+        with self._lock:
+            self._index = index
+            self._loaded = True
+
+    def _open_index_file(self):
+        try:
+            return IndexFile.open(self.index_file, self.index_options())
+        except (IOError, OSError) as err:
+            logger.info("Cannot open %s: %s" % (self.index_file, err))
+        except (ValueError, IndexFormatError) as err:
+            logger.warning("Ignoring %s: %s" % (self.index_file, err))
+        return None
+
+    def sync(self, adverts):
+        """
+        Brings the index in line with the `adverts` catalog: switches to a
+        rebuilt index file, loads the fingerprints of adverts it does not
+        hold yet and drops the ones of adverts that are gone.
+        """
+        sids = [advert[Database.FIELD_ADVERT_ID] for advert in adverts]
+        if not self._loaded:
+            self.load(sids)
+            if not self.index_file:
+                return
+        elif self._file is not None and self._file.replaced():
+            index_file = self._open_index_file()
+            if index_file is not None:
+                with self._lock:
+                    self._file = index_file
+                    self._index = FingerprintIndex.empty(key_dtype(self.fingerprint_format))
+
+        index_file = self._file
+        in_file = index_file.live_sids() if index_file is not None else set()
+        in_memory = set(self._sids[code] for code in np.unique(self._index.codes).tolist())
+
+        catalog = set(sids)
+        removed_from_file = in_file.difference(catalog)
+        removed = [self._codes[sid] for sid in in_memory.difference(catalog)]
+        added = [sid for sid in sids if sid not in in_file and sid not in in_memory]
+
+        rows = []
+        for sid in added:
+            rows.extend((hash, self._code(sid), offset)
+                        for hash, _, offset in self.backend.get_fingerprints(sid))
+
+        if removed_from_file or removed or rows:
+            with self._lock:
+                if removed_from_file:
+                    self._file = self._file.without(removed_from_file)
+                index = self._index
+                if removed:
+                    index = index.remove(removed)
+                if rows:
+                    index = index.add(*self._arrays(rows))
+                self._index = index
+
+        if self.index_file and (self._dirty or removed_from_file):
+            self.write_index_file()
+
+    def write_index_file(self):
+        """
+        Atomically replaces the index file with the current index: the
+        live rows of the file plus the adverts held in memory.
+        """
+        with self._lock:
+            index_file, index, sids = self._file, self._index, list(self._sids)
+            self._dirty = False
+
+        parts = [(index, sids)]
+        if index_file is not None:
+            live = index_file.index
+            if index_file.live is not None:
+                keep = index_file.live[live.codes]
+                live = FingerprintIndex(live.keys[keep], live.codes[keep], live.offsets[keep])
+            parts.append((live, index_file.sids.tolist()))
+
+        # renumber the adverts of both parts into one list
+        out_sids, out_codes = [], {}
+        keys, codes, offsets = [], [], []
+        for part, part_sids in parts:
+            remap = np.zeros(len(part_sids), dtype=np.int32)
+            for code in np.unique(part.codes).tolist():
+                sid = part_sids[code]
+                if sid not in out_codes:
+                    out_codes[sid] = len(out_sids)
+                    out_sids.append(sid)
+                remap[code] = out_codes[sid]
+            keys.append(np.asarray(part.keys))
+            codes.append(remap[part.codes])
+            offsets.append(np.asarray(part.offsets))
+        merged = FingerprintIndex.build(np.concatenate(keys), np.concatenate(codes),
+                                        np.concatenate(offsets))
+
+        write_index(self.index_file, merged, out_sids, self.index_options())
+        reopened = IndexFile.open(self.index_file, self.index_options())
+        with self._lock:
+            # rows added meanwhile stay in memory
+            if self._index is index:
+                self._index = FingerprintIndex.empty(key_dtype(self.fingerprint_format))
+            else:
+                self._index = self._index.remove([self._codes[sid] for sid in sids
+                                                  if sid in out_codes])
+            self._file = reopened
+
+    def _add_hashes(self, sid, hashes):
+        code = self._code(sid)
+        rows = [(hash_key(hash, self.fingerprint_format), code, offset)
+                for hash, offset in hashes]
+        if rows:
+            with self._lock:
+                self._index = self._index.add(*self._arrays(rows))
+
+    def before_fork(self):
+        self.backend.before_fork()
+
+    def after_fork(self):
+        self.backend.after_fork()
+
+    def close(self):
+        self.backend.close()
+
+    def setup(self):
+        self.backend.setup()
+
+    def empty(self):
+        self.backend.empty()
+        self._clear()
+
+    def reset_fingerprints(self):
+        self.backend.reset_fingerprints()
+        # nothing left to load for the current format
+        with self._lock:
+            self._index = FingerprintIndex.empty(key_dtype(self.fingerprint_format))
+            self._file = None
+            self._loaded = True
+            self._dirty = True
+
+    def get_stored_fingerprint_format(self):
+        return self.backend.get_stored_fingerprint_format()
+
+    def store_fingerprint_format(self, fingerprint_format):
+        self.backend.store_fingerprint_format(fingerprint_format)
+
+    def delete_unfingerprinted_adverts(self):
+        self.backend.delete_unfingerprinted_adverts()
+
+    def get_num_adverts(self):
+        return self.backend.get_num_adverts()
+
+    def get_num_fingerprints(self):
+        return self.backend.get_num_fingerprints()
+
+    def set_advert_fingerprinted(self, sid):
+        self.backend.set_advert_fingerprinted(sid)
+        self._dirty = True
+
+    def get_adverts(self):
+        # called whenever Tramscore (re)loads its catalog
+        adverts = list(self.backend.get_adverts())
+        self.sync(adverts)
+        return adverts
+
+    def get_advert_by_id(self, sid):
+        return self.backend.get_advert_by_id(sid)
+
+    def insert(self, hash, sid, offset):
+        self.backend.insert(hash, sid, offset)
+        self._add_hashes(sid, [(hash, offset)])
+
+    def insert_advert(self, *args, **kwargs):
+        return self.backend.insert_advert(*args, **kwargs)
+
+    def query(self, hash):
+        return self.backend.query(hash)
+
+    def get_iterable_kv_pairs(self):
+        return self.backend.get_iterable_kv_pairs()
+
+    def get_fingerprints(self, sid=None):
+        return self.backend.get_fingerprints(sid)
+
+    def insert_hashes(self, sid, hashes):
+        hashes = list(hashes)
+        self.backend.insert_hashes(sid, hashes)
+        self._add_hashes(sid, hashes)
+
+    def return_matches(self, mapper):
+        """
+        Return the (advert_id, offset_diff) tuples associated with
+        a {hash: sample_offset} mapping, without a database query.
+        """
+        if not self._loaded:
+            self.load()
+        index, index_file = self._index, self._file
+        if not mapper or not (len(index) or index_file is not None):
+            return []
+
+        keys = np.array([hash_key(hash, self.fingerprint_format) for hash in mapper],
+                        dtype=key_dtype(self.fingerprint_format))
+        sample_offsets = np.fromiter(mapper.values(), dtype=np.int64, count=len(mapper))
+
+        matches = []
+        if index_file is not None:
+            query, sids, offsets = index_file.lookup(keys)
+            diffs = offsets - sample_offsets[query]
+            matches.extend(zip(sids.tolist(), diffs.tolist()))
+        if len(index):
+            query, codes, offsets = index.lookup(keys)
+            sids = np.array(self._sids, dtype=object)[codes]
+            diffs = offsets - sample_offsets[query]
+            matches.extend(zip(sids.tolist(), diffs.tolist()))
+        return matches
+
+    def insert_client_advert(self, *args, **kwargs):
+        return self.backend.insert_client_advert(*args, **kwargs)
+
+    def insert_client_advert_media_stations(self, advert_id, mediastation_id):
+        return self.backend.insert_client_advert_media_stations(advert_id, mediastation_id)
+
+    def get_client_adverts(self, *args, **kwargs):
+        return self.backend.get_client_adverts(*args, **kwargs)
+
+    def get_client_advert_by_id(self, sid):
+        return self.backend.get_client_advert_by_id(sid)
+
+    def get_client_advert_media_stations_by_id(self, sid):
+        return self.backend.get_client_advert_media_stations_by_id(sid)
+
+    def get_all_client_adverts(self):
+        return self.backend.get_all_client_adverts()
+
+    def get_all_client_advert_media_stations(self):
+        return self.backend.get_all_client_advert_media_stations()
+
+    def update_client_campaign(self, advert_name, client_user_id):
+        return self.backend.update_client_campaign(advert_name, client_user_id)
@@ -3,17 +3,19 @@
 from __future__ import absolute_import
 # from itertools import zip_longest, chain
 # import queue
+import io
 import sys
 import math
+import uuid
+import struct
+import logging
 import binascii
 
 if sys.version_info[0] != 2:
-    import queue
     from itertools import zip_longest, chain
 else:
     # 3.x renames
     from itertools import izip_longest as zip_longest, chain
-    import Queue as queue
 
 try:
     import psycopg2
@@ -21,9 +23,24 @@ except ImportError as err:
     print("Module not installed", err)
     sys.exit(1)
 
+import numpy as np
+import psycopg2.extensions
 from psycopg2.extras import DictCursor, RealDictCursor
-from .database import Database
-from .fingerprint import FINGERPRINT_REDUCTION
+from . import connection_pool
+from .connection_pool import DEFAULT_POOL_SIZE, DEFAULT_POOL_MAX_IDLE
+from .database import (Database, LOOKUP_CHUNKS, LOOKUP_TEMP_TABLE, LOOKUP_STRATEGIES,
+                       lookup_chunks)
+from .fingerprint import FINGERPRINT_REDUCTION, FINGERPRINT_FORMAT_SHA1
+
+logger = logging.getLogger(__name__)
+
+# hashes looked up per query, and queries run at a time, in return_matches
+DEFAULT_LOOKUP_CHUNK_SIZE = 5000
+DEFAULT_LOOKUP_WORKERS = 4
+
+# framing of binary COPY data
+COPY_HEADER = b"PGCOPY\n\xff\r\n\x00" + struct.pack(">ii", 0, 0)
+COPY_TRAILER = struct.pack(">h", -1)
 
 
 class PostgresDatabase(Database):
@@ -39,6 +56,8 @@ class PostgresDatabase(Database):
 
     # Tables
     FINGERPRINTS_TABLENAME = "trams_fingerprint"
+    PACKED_FINGERPRINTS_TABLENAME = "trams_fingerprint_packed"
+    SCHEMA_TABLENAME = "trams_schema"
     ADVERTS_TABLENAME = "trams_advert"
 
     ADVERTS_MEDIA_STATIONS_TABLENAME = "trams_advert_media_stations"
@@ -64,6 +83,8 @@ class PostgresDatabase(Database):
     FIELD_FINGERPRINTED = "fingerprinted"
     FIELD_CAMPAIGN_STATUS = "campaign_status"
     FIELD_CAMPAIGN_FILE_NAME = "advert_file_name"
+    FIELD_SCHEMA_NAME = "name"
+    FIELD_SCHEMA_VALUE = "value"
 
     # int NOT NULL REFERENCES %s(%s) ON DELETE CASCADE ON UPDATE CASCADE
     # creates postgres table if it doesn't exist
@@ -107,6 +128,48 @@ class PostgresDatabase(Database):
             FIELD_HASH
         )
 
+    # Packed fingerprints, the hash is the bit-packed (freq1, freq2, t_delta)
+    # key. Postgres has no unsigned types, so both packed32 and packed64
+    # keys are kept in a bigint (packed64 leaves the sign bit free).
+    CREATE_PACKED_FINGERPRINTS_TABLE = """
+        CREATE TABLE IF NOT EXISTS %s (
+            %s bigint NOT NULL,
+            %s uuid NOT NULL REFERENCES %s(%s) ON DELETE CASCADE ON UPDATE CASCADE,
+            %s bigint NOT NULL,
+            CONSTRAINT comp_key_packed UNIQUE (%s, %s, %s)
+        );""" % (
+                PACKED_FINGERPRINTS_TABLENAME,
+                FIELD_HASH,         # packed fingerprint key
+                FIELD_ADVERT_ID,    # advert id (fkey to adverts tables)
+                ADVERTS_TABLENAME,  # Adverts table
+                FIELD_ADVERT_ID,    # foreign key
+                FIELD_OFFSET,       # offset relative to START of advert
+                FIELD_HASH,         # unique constraint
+                FIELD_ADVERT_ID,    # unique constraint
+                FIELD_OFFSET        # unique constraint
+            )
+
+    CREATE_PACKED_FINGERPRINT_INDEX = """
+        CREATE INDEX IF NOT EXISTS fingerprint_packed_index ON %s.%s (%s);
+        """ % (
+            DEFAULT_SCHEMA,
+            PACKED_FINGERPRINTS_TABLENAME,
+            FIELD_HASH
+        )
+
+    # Key/value flags describing the stored data, e.g. the fingerprint format
+    CREATE_SCHEMA_TABLE = """
+        CREATE TABLE IF NOT EXISTS %s (
+            %s varchar(64) NOT NULL,
+            %s varchar(64) NOT NULL,
+            PRIMARY KEY (%s)
+        );""" % (
+            SCHEMA_TABLENAME,
+            FIELD_SCHEMA_NAME,
+            FIELD_SCHEMA_VALUE,
+            FIELD_SCHEMA_NAME
+        )
+
     # many to many relations table
     # serial
     CREATE_ADVERTS_MEDIA_STATIONS_TABLE = """
@@ -166,6 +229,29 @@ class PostgresDatabase(Database):
             FIELD_OFFSET
         )
 
+    INSERT_PACKED_FINGERPRINT = """
+        INSERT INTO %s (%s, %s, %s)
+        values (%%s, %%s, %%s) ON CONFLICT DO NOTHING;
+        """ % (
+            PACKED_FINGERPRINTS_TABLENAME,
+            FIELD_HASH,
+            FIELD_ADVERT_ID,
+            FIELD_OFFSET
+        )
+
+    UPSERT_SCHEMA_VALUE = """
+        INSERT INTO %s (%s, %s)
+        values (%%s, %%s)
+        ON CONFLICT (%s) DO UPDATE SET %s = EXCLUDED.%s;
+        """ % (
+            SCHEMA_TABLENAME,
+            FIELD_SCHEMA_NAME,
+            FIELD_SCHEMA_VALUE,
+            FIELD_SCHEMA_NAME,
+            FIELD_SCHEMA_VALUE,
+            FIELD_SCHEMA_VALUE
+        )
+
     # Inserts advert information.
     INSERT_ADVERT = """
         INSERT INTO %s (%s, %s, %s)
@@ -217,13 +303,17 @@ class PostgresDatabase(Database):
             FIELD_HASH
         )
 
-    # Selects multiple fingerprints based on hashes
-    SELECT_MULTIPLE = """
-        SELECT fred_hex(%s) as %s, %s, %s
+    # Prepared statements, prepared on a connection the first time they
+    # are used there (see _execute_prepared). Hashes go over as one bytea
+    # or bigint array parameter instead of a placeholder per hash.
+    MATCHES_STATEMENT = "trams_matches"
+    PREPARE_MATCHES = """
+        PREPARE %s (bytea[]) AS
+        SELECT %s, %s, %s
         FROM %s
-        WHERE %s IN %%s;
+        WHERE %s = ANY($1);
         """ % (
-            FIELD_HASH,
+            MATCHES_STATEMENT,
             FIELD_HASH,
             FIELD_ADVERT_ID,
             FIELD_OFFSET,
@@ -231,6 +321,211 @@ class PostgresDatabase(Database):
             FIELD_HASH
         )
 
+    PACKED_MATCHES_STATEMENT = "trams_packed_matches"
+    PREPARE_PACKED_MATCHES = """
+        PREPARE %s (bigint[]) AS
+        SELECT %s, %s, %s
+        FROM %s
+        WHERE %s = ANY($1);
+        """ % (
+            PACKED_MATCHES_STATEMENT,
+            FIELD_HASH,
+            FIELD_ADVERT_ID,
+            FIELD_OFFSET,
+            PACKED_FINGERPRINTS_TABLENAME,
+            FIELD_HASH
+        )
+
+    # Fingerprints are COPYed into a session temporary table, emptied on
+    # commit, and moved from there ignoring duplicates. COPY itself would
+    # abort on the first duplicate.
+    CREATE_FINGERPRINTS_COPY_TABLE = """
+        CREATE TEMP TABLE IF NOT EXISTS %s_copy (LIKE %s) ON COMMIT DELETE ROWS;
+        """ % (FINGERPRINTS_TABLENAME, FINGERPRINTS_TABLENAME)
+
+    COPY_FINGERPRINTS = """
+        COPY %s_copy (%s, %s, %s) FROM STDIN WITH (FORMAT binary);
+        """ % (FINGERPRINTS_TABLENAME, FIELD_HASH, FIELD_ADVERT_ID, FIELD_OFFSET)
+
+    INSERT_COPIED_FINGERPRINTS = """
+        INSERT INTO %s (%s, %s, %s)
+        SELECT %s, %s, %s FROM %s_copy
+        ON CONFLICT DO NOTHING;
+        """ % (
+            FINGERPRINTS_TABLENAME,
+            FIELD_HASH,
+            FIELD_ADVERT_ID,
+            FIELD_OFFSET,
+            FIELD_HASH,
+            FIELD_ADVERT_ID,
+            FIELD_OFFSET,
+            FINGERPRINTS_TABLENAME
+        )
+
+    CREATE_PACKED_FINGERPRINTS_COPY_TABLE = """
+        CREATE TEMP TABLE IF NOT EXISTS %s_copy (LIKE %s) ON COMMIT DELETE ROWS;
+        """ % (PACKED_FINGERPRINTS_TABLENAME, PACKED_FINGERPRINTS_TABLENAME)
+
+    COPY_PACKED_FINGERPRINTS = """
+        COPY %s_copy (%s, %s, %s) FROM STDIN WITH (FORMAT binary);
+        """ % (PACKED_FINGERPRINTS_TABLENAME, FIELD_HASH, FIELD_ADVERT_ID, FIELD_OFFSET)
+
+    INSERT_COPIED_PACKED_FINGERPRINTS = """
+        INSERT INTO %s (%s, %s, %s)
+        SELECT %s, %s, %s FROM %s_copy
+        ON CONFLICT DO NOTHING;
+        """ % (
+            PACKED_FINGERPRINTS_TABLENAME,
+            FIELD_HASH,
+            FIELD_ADVERT_ID,
+            FIELD_OFFSET,
+            FIELD_HASH,
+            FIELD_ADVERT_ID,
+            FIELD_OFFSET,
+            PACKED_FINGERPRINTS_TABLENAME
+        )
+
+    # Session table of the (hash, sample offset) pairs of one lookup, see
+    # _join_matches, emptied on commit
+    QUERY_HASHES_TABLENAME = "trams_query_hashes"
+    FIELD_SAMPLE_OFFSET = "sample_offset"
+
+    CREATE_QUERY_HASHES_TABLE = """
+        CREATE TEMP TABLE IF NOT EXISTS %s (
+            %s bytea NOT NULL,
+            %s bigint NOT NULL
+        ) ON COMMIT DELETE ROWS;""" % (QUERY_HASHES_TABLENAME, FIELD_HASH, FIELD_SAMPLE_OFFSET)
+
+    QUERY_PACKED_HASHES_TABLENAME = "trams_query_packed_hashes"
+    CREATE_QUERY_PACKED_HASHES_TABLE = """
+        CREATE TEMP TABLE IF NOT EXISTS %s (
+            %s bigint NOT NULL,
+            %s bigint NOT NULL
+        ) ON COMMIT DELETE ROWS;""" % (QUERY_PACKED_HASHES_TABLENAME, FIELD_HASH,
+                                       FIELD_SAMPLE_OFFSET)
+
+    INSERT_QUERY_HASHES = """
+        INSERT INTO %s (%s, %s)
+        SELECT * FROM unnest(%%s::bytea[], %%s::bigint[]);
+        """ % (QUERY_HASHES_TABLENAME, FIELD_HASH, FIELD_SAMPLE_OFFSET)
+
+    INSERT_QUERY_PACKED_HASHES = """
+        INSERT INTO %s (%s, %s)
+        SELECT * FROM unnest(%%s::bigint[], %%s::bigint[]);
+        """ % (QUERY_PACKED_HASHES_TABLENAME, FIELD_HASH, FIELD_SAMPLE_OFFSET)
+
+    # temp tables are never analyzed by autovacuum, the join plan needs
+    # the row count
+    ANALYZE_QUERY_HASHES = "ANALYZE %s;" % QUERY_HASHES_TABLENAME
+    ANALYZE_QUERY_PACKED_HASHES = "ANALYZE %s;" % QUERY_PACKED_HASHES_TABLENAME
+
+    # (advert_id, db_offset - sample_offset) of every matching fingerprint
+    SELECT_JOIN_MATCHES = """
+        SELECT f.%s, f.%s - q.%s
+        FROM %s f
+        JOIN %s q ON f.%s = q.%s;
+        """ % (
+            FIELD_ADVERT_ID, FIELD_OFFSET, FIELD_SAMPLE_OFFSET,
+            FINGERPRINTS_TABLENAME, QUERY_HASHES_TABLENAME, FIELD_HASH, FIELD_HASH
+        )
+
+    SELECT_JOIN_PACKED_MATCHES = """
+        SELECT f.%s, f.%s - q.%s
+        FROM %s f
+        JOIN %s q ON f.%s = q.%s;
+        """ % (
+            FIELD_ADVERT_ID, FIELD_OFFSET, FIELD_SAMPLE_OFFSET,
+            PACKED_FINGERPRINTS_TABLENAME, QUERY_PACKED_HASHES_TABLENAME, FIELD_HASH, FIELD_HASH
+        )
+
+    # (advert_id, diff, count) of the pairs with at least min_count matches,
+    # the most first. Filled in with min_count and the LIMIT row count.
+    SELECT_JOIN_ALIGNMENTS = """
+        SELECT f.%s, f.%s - q.%s AS diff, COUNT(*) AS cnt
+        FROM %s f
+        JOIN %s q ON f.%s = q.%s
+        GROUP BY f.%s, diff
+        HAVING COUNT(*) >= %%d
+        ORDER BY cnt DESC, f.%s, diff
+        LIMIT %%s;
+        """ % (
+            FIELD_ADVERT_ID, FIELD_OFFSET, FIELD_SAMPLE_OFFSET,
+            FINGERPRINTS_TABLENAME, QUERY_HASHES_TABLENAME, FIELD_HASH, FIELD_HASH,
+            FIELD_ADVERT_ID, FIELD_ADVERT_ID
+        )
+
+    SELECT_JOIN_PACKED_ALIGNMENTS = """
+        SELECT f.%s, f.%s - q.%s AS diff, COUNT(*) AS cnt
+        FROM %s f
+        JOIN %s q ON f.%s = q.%s
+        GROUP BY f.%s, diff
+        HAVING COUNT(*) >= %%d
+        ORDER BY cnt DESC, f.%s, diff
+        LIMIT %%s;
+        """ % (
+            FIELD_ADVERT_ID, FIELD_OFFSET, FIELD_SAMPLE_OFFSET,
+            PACKED_FINGERPRINTS_TABLENAME, QUERY_PACKED_HASHES_TABLENAME, FIELD_HASH, FIELD_HASH,
+            FIELD_ADVERT_ID, FIELD_ADVERT_ID
+        )
+
+    # LIMIT row count for no limit
+    NO_LIMIT = "ALL"
+
+    # Every fingerprint, or the ones of one advert, with the raw stored hash
+    SELECT_FINGERPRINTS = """
+        SELECT %s, %s, %s
+        FROM %s;
+        """ % (
+            FIELD_HASH,
+            FIELD_ADVERT_ID,
+            FIELD_OFFSET,
+            FINGERPRINTS_TABLENAME
+        )
+
+    SELECT_ADVERT_FINGERPRINTS = """
+        SELECT %s, %s, %s
+        FROM %s
+        WHERE %s = %%s;
+        """ % (
+            FIELD_HASH,
+            FIELD_ADVERT_ID,
+            FIELD_OFFSET,
+            FINGERPRINTS_TABLENAME,
+            FIELD_ADVERT_ID
+        )
+
+    SELECT_PACKED_FINGERPRINTS = """
+        SELECT %s, %s, %s
+        FROM %s;
+        """ % (
+            FIELD_HASH,
+            FIELD_ADVERT_ID,
+            FIELD_OFFSET,
+            PACKED_FINGERPRINTS_TABLENAME
+        )
+
+    SELECT_ADVERT_PACKED_FINGERPRINTS = """
+        SELECT %s, %s, %s
+        FROM %s
+        WHERE %s = %%s;
+        """ % (
+            FIELD_HASH,
+            FIELD_ADVERT_ID,
+            FIELD_OFFSET,
+            PACKED_FINGERPRINTS_TABLENAME,
+            FIELD_ADVERT_ID
+        )
+
+    SELECT_SCHEMA_VALUE = """
+        SELECT %s
+        FROM %s
+        WHERE %s = %%s;
+        """ % (
+            FIELD_SCHEMA_VALUE,
+            SCHEMA_TABLENAME,
+            FIELD_SCHEMA_NAME
+        )
+
     # Selects all adverts/fingerprints from the fingerprints table.
     SELECT_ALL = """
         SELECT %s, %s
@@ -278,6 +573,29 @@ class PostgresDatabase(Database):
         Database.FIELD_ADVERT_ID
     )
 
+    # all adverts and their media stations, for the metadata cache
+    SELECT_ALL_CLIENT_ADVERTS = """
+        SELECT %s, %s, fred_hex(%s) as %s, %s, %s 
+        FROM %s;
+        """ % (
+        Database.FIELD_ADVERT_ID,
+        Database.FIELD_ADVERTNAME,
+        Database.FIELD_FILE_SHA1,
+        Database.FIELD_FILE_SHA1,
+        Database.CLIENT_USER_ID,
+        Database.AUDIO_LENGTH,
+        ADVERTS_TABLENAME
+    )
+
+    SELECT_ALL_CLIENT_ADVERT_MEDIA_STATIONS = """
+        SELECT %s, %s 
+        FROM %s;
+        """ % (
+        Database.FIELD_ADVERT_ID,
+        Database.MEDIA_STATION_ID,
+        ADVERTS_MEDIA_STATIONS_TABLENAME
+    )
+
     # Selects all FINGERPRINTED adverts.
     SELECT_ADVERTS = """
         SELECT %s, %s, fred_hex(%s) as %s
@@ -314,6 +632,13 @@ class PostgresDatabase(Database):
             FINGERPRINTS_TABLENAME
         )
 
+    SELECT_NUM_PACKED_FINGERPRINTS = """
+        SELECT COUNT(*) as n
+        FROM %s
+        """ % (
+            PACKED_FINGERPRINTS_TABLENAME
+        )
+
     # Selects unique advert ids
     SELECT_UNIQUE_ADVERT_IDS = """
         SELECT COUNT(DISTINCT %s) as n
@@ -338,6 +663,18 @@ class PostgresDatabase(Database):
             FINGERPRINTS_TABLENAME
         )
 
+    # Drops the packed fingerprints table (removes EVERYTHING!)
+    DROP_PACKED_FINGERPRINTS = """
+        DROP TABLE IF EXISTS %s;""" % (
+            PACKED_FINGERPRINTS_TABLENAME
+        )
+
+    # Drops the schema flags table
+    DROP_SCHEMA = """
+        DROP TABLE IF EXISTS %s;""" % (
+            SCHEMA_TABLENAME
+        )
+
     # Drops the adverts table (removes EVERYTHING!)
     DROP_ADVERTS = """
         DROP TABLE IF EXISTS %s;
@@ -379,19 +716,66 @@ class PostgresDatabase(Database):
             FIELD_FINGERPRINTED
         )
 
-    def __init__(self, **options):
+    def __init__(self, pool_size=DEFAULT_POOL_SIZE, pool_max_idle=DEFAULT_POOL_MAX_IDLE,
+                 insert_chunk_size=NUM_HASHES, lookup_chunk_size=DEFAULT_LOOKUP_CHUNK_SIZE,
+                 lookup_workers=DEFAULT_LOOKUP_WORKERS, lookup_strategy=LOOKUP_CHUNKS,
+                 **options):
         """ Creates the DB layout, creates connection, etc.
+        `insert_chunk_size` fingerprints are sent per COPY, return_matches
+        looks up `lookup_chunk_size` hashes per query, up to
+        `lookup_workers` queries at a time on pooled connections, or with
+        `lookup_strategy` "temp_table" joins a temporary table of them.
         """
         super(PostgresDatabase, self).__init__()
-        self.cursor = cursor_factory(**options)
-        self._options = options
+        if lookup_strategy not in LOOKUP_STRATEGIES:
+            raise ValueError("Unknown lookup_strategy %r, expected one of %s" %
+                             (lookup_strategy, ", ".join(LOOKUP_STRATEGIES)))
+        self.cursor = cursor_factory(pool_size, pool_max_idle, **options)
+        self.insert_chunk_size = insert_chunk_size
+        self.lookup_chunk_size = lookup_chunk_size
+        self.lookup_workers = lookup_workers
+        self.lookup_strategy = lookup_strategy
+        self._options = dict(options, pool_size=pool_size, pool_max_idle=pool_max_idle,
+                             insert_chunk_size=insert_chunk_size,
+                             lookup_chunk_size=lookup_chunk_size,
+                             lookup_workers=lookup_workers, lookup_strategy=lookup_strategy)
+
+    def _is_packed(self):
+        """ True when fingerprints are stored as packed integer keys.
+        """
+        return self.fingerprint_format != FINGERPRINT_FORMAT_SHA1
+
+    def before_fork(self):
+        """
+        Close the idle connections, a child must not share their sockets.
+        """
+        super(PostgresDatabase, self).before_fork()
+        ConnectionPool.close_all()
 
     def after_fork(self):
         """
         Clear the cursor cache, we don't want any stale connections from
         the previous process.
         """
-        Cursor.clear_cache()
+        super(PostgresDatabase, self).after_fork()
+        ConnectionPool.reset_all()
+
+    def close(self):
+        """
+        Stops the lookup threads and closes the idle connections.
+        """
+        super(PostgresDatabase, self).close()
+        ConnectionPool.close_all()
+
+    def _execute_prepared(self, cur, name, prepare, args):
+        """
+        Executes prepared statement `name` with `args`, preparing it with
+        the `prepare` statement first if this connection has not yet.
+        """
+        if name not in cur.connection.prepared:
+            cur.execute(prepare)
+            cur.connection.prepared.add(name)
+        cur.execute("EXECUTE %s (%s);" % (name, ", ".join(["%s"] * len(args))), args)
 
     def setup(self):
         """
@@ -400,9 +784,13 @@ class PostgresDatabase(Database):
         fingerprints associated with them.
         """
         with self.cursor() as cur:
+            cur.execute(self.CREATE_SCHEMA_TABLE)
             cur.execute(self.CREATE_ADVERTS_TABLE)
             cur.execute(self.CREATE_FINGERPRINTS_TABLE)
             cur.execute(self.CREATE_FINGERPRINT_INDEX)
+            if self._is_packed():
+                cur.execute(self.CREATE_PACKED_FINGERPRINTS_TABLE)
+                cur.execute(self.CREATE_PACKED_FINGERPRINT_INDEX)
             cur.execute(self.CREATE_ADVERTS_MEDIA_STATIONS_TABLE)
             cur.execute(self.DELETE_UNFINGERPRINTED)
 
@@ -416,9 +804,44 @@ class PostgresDatabase(Database):
         with self.cursor() as cur:
             cur.execute(self.DROP_ADVERTS_MEDIA_STATIONS_TABLE)
             cur.execute(self.DROP_FINGERPRINTS)
+            cur.execute(self.DROP_PACKED_FINGERPRINTS)
             cur.execute(self.DROP_ADVERTS)
+            cur.execute(self.DROP_SCHEMA)
         self.setup()
 
+    def reset_fingerprints(self):
+        """
+        Drops and recreates the fingerprints table of the current
+        fingerprint format, keeping the adverts.
+        """
+        with self.cursor() as cur:
+            if self._is_packed():
+                cur.execute(self.DROP_PACKED_FINGERPRINTS)
+                cur.execute(self.CREATE_PACKED_FINGERPRINTS_TABLE)
+                cur.execute(self.CREATE_PACKED_FINGERPRINT_INDEX)
+            else:
+                cur.execute(self.DROP_FINGERPRINTS)
+                cur.execute(self.CREATE_FINGERPRINTS_TABLE)
+                cur.execute(self.CREATE_FINGERPRINT_INDEX)
+
+    def get_stored_fingerprint_format(self):
+        """
+        Returns the fingerprint format recorded in the schema table.
+        """
+        with self.cursor() as cur:
+            cur.execute(self.SELECT_SCHEMA_VALUE, (self.SCHEMA_FINGERPRINT_FORMAT,))
+            for value, in cur:
+                return value
+            return None
+
+    def store_fingerprint_format(self, fingerprint_format):
+        """
+        Records the fingerprint format of the stored fingerprints.
+        """
+        with self.cursor() as cur:
+            cur.execute(self.UPSERT_SCHEMA_VALUE,
+                        (self.SCHEMA_FINGERPRINT_FORMAT, fingerprint_format))
+
     def delete_unfingerprinted_adverts(self):
         """
         Removes all adverts that have no fingerprints associated with them.
@@ -441,8 +864,9 @@ class PostgresDatabase(Database):
         """
         Returns number of fingerprints present.
         """
+        query = self.SELECT_NUM_PACKED_FINGERPRINTS if self._is_packed() else self.SELECT_NUM_FINGERPRINTS
         with self.cursor() as cur:
-            cur.execute(self.SELECT_NUM_FINGERPRINTS)
+            cur.execute(query)
 
             for count, in cur:
                 return count
@@ -478,8 +902,9 @@ class PostgresDatabase(Database):
         """
         Insert a (sha1, advert_id, offset) row into database.
         """
+        query = self.INSERT_PACKED_FINGERPRINT if self._is_packed() else self.INSERT_FINGERPRINT
         with self.cursor() as cur:
-            cur.execute(self.INSERT_FINGERPRINT, bhash, sid, offset)
+            cur.execute(query, (bhash, sid, offset))
 
     # def insert_advert(self, advertname):
     def insert_advert(self, advertname, file_hash, audio_length):
@@ -513,55 +938,155 @@ class PostgresDatabase(Database):
         """
         return self.query(None)
 
+    def get_fingerprints(self, sid=None):
+        """
+        Yields every (hash, advert_id, offset) of the current fingerprint
+        format, or only the ones of advert `sid`.
+        """
+        if self._is_packed():
+            query = self.SELECT_PACKED_FINGERPRINTS if sid is None else self.SELECT_ADVERT_PACKED_FINGERPRINTS
+        else:
+            query = self.SELECT_FINGERPRINTS if sid is None else self.SELECT_ADVERT_FINGERPRINTS
+
+        with self.cursor(cursor_type=None) as cur:
+            cur.execute(query, None if sid is None else (sid,))
+            for hash, sid, offset in cur:
+                if not self._is_packed():
+                    # bytea comes back as a memoryview
+                    hash = bytes(hash)
+                yield (hash, sid, offset)
+
     def insert_hashes(self, sid, hashes):
         """
         Insert series of hash => advert_id, offset
         values into the database.
         """
-        values = []
-        for bhash, offset in hashes:
-            values.append((bhash, sid, offset))
+        if self._is_packed():
+            create, copy, insert = (self.CREATE_PACKED_FINGERPRINTS_COPY_TABLE,
+                                    self.COPY_PACKED_FINGERPRINTS,
+                                    self.INSERT_COPIED_PACKED_FINGERPRINTS)
+        else:
+            create, copy, insert = (self.CREATE_FINGERPRINTS_COPY_TABLE,
+                                    self.COPY_FINGERPRINTS,
+                                    self.INSERT_COPIED_FINGERPRINTS)
 
-        # base_query = "INSERT IGNORE INTO %s (%s, %s, %s) values " % \
-        base_query = "INSERT INTO %s (%s, %s, %s) values " % \
-                     (self.FINGERPRINTS_TABLENAME, Database.FIELD_HASH, Database.FIELD_ADVERT_ID, Database.FIELD_OFFSET)
         with self.cursor() as cur:
-            values.sort(key=lambda tup: tup[0])
-            cur.execute("START TRANSACTION;")
-            for split_values in grouper(values, 1000):
-
-                # print("\n....***** %s ******...\n\n" % split_values)
+            # once per advert, a rolled back transaction also drops the table
+            cur.execute(create)
+            for split_values in grouper(hashes, self.insert_chunk_size):
+                cur.copy_expert(copy, io.BytesIO(self._copy_data(sid, split_values)))
+            cur.execute(insert)
 
-                cur.executemany(self.INSERT_FINGERPRINT, split_values)
-                values2tuple = tuple(chain.from_iterable(split_values))
-                query = base_query + ', '.join(["(fred_unhex_bytea(%s), %s, %s)"] * len(split_values))
-                # query = base_query + ', '.join(["UNHEX(%s), %s, %s) ON CONFLICT DO NOTHING"] * len(split_values))
-                query += " ON CONFLICT DO NOTHING;"
-
-                # print("\n.... %s ....\n" % query)
-
-                cur.execute(query, values2tuple)
-            cur.execute("COMMIT;")
+    def _copy_data(self, sid, hashes):
+        """
+        Binary COPY data of the (hash, advert_id, offset) rows, built as
+        one numpy record array.
+        """
+        hashes, offsets = zip(*hashes)
+        if self._is_packed():
+            keys = np.array(hashes, dtype=">i8")
+        else:
+            # raw bytea, no fred_unhex_bytea call per hash
+            keys = np.array([binascii.unhexlify(hash[:FINGERPRINT_REDUCTION]) for hash in hashes])
+
+        rows = np.zeros(len(offsets), dtype=[
+            ("fields", ">i2"),
+            ("hash_size", ">i4"), ("hash", keys.dtype),
+            ("advert_id_size", ">i4"), ("advert_id", "S16"),
+            ("offset_size", ">i4"), ("offset", ">i8")])
+        rows["fields"] = 3
+        rows["hash_size"] = keys.dtype.itemsize
+        rows["hash"] = keys
+        rows["advert_id_size"] = 16
+        rows["advert_id"] = uuid.UUID(str(sid)).bytes
+        rows["offset_size"] = 8
+        rows["offset"] = offsets
+        return COPY_HEADER + rows.tobytes() + COPY_TRAILER
 
     def return_matches(self, mapper):
         """
         Return the (advert_id, offset_diff) tuples associated with
-        a list of (sha1, sample_offset) values as a generator.
+        a list of (sha1, sample_offset) values as a generator, a chunk of
+        hashes at a time.
         """
-        # Get an iteratable of all the hashes we need
-        vals = list(mapper.keys())
-
-        with self.cursor() as cur:
-            # Create our IN part of the query
-            query = self.SELECT_MULTIPLE
-            # query = query % ', '.join(["decode(%s, 'hex')"] * len(vals))
-            query = query % ', '.join(['(fred_unhex_bytea(%s)'] * len(vals))
+        if self._is_packed():
+            offsets = mapper
+        else:
+            # raw sha1 bytes both ways
+            offsets = dict((binascii.unhexlify(bhash), offset) for bhash, offset in mapper.items())
+        if self.lookup_strategy == LOOKUP_TEMP_TABLE:
+            return self._join_matches(offsets)
+        return lookup_chunks(lambda keys: self._lookup_matches(offsets, keys),
+                             list(offsets.keys()), self.lookup_chunk_size,
+                             self.lookup_executor(self.lookup_workers))
+
+    def _join_matches(self, offsets):
+        """
+        return_matches by inserting the (hash, sample_offset) pairs into a
+        temporary table and joining it to the fingerprints, the offset
+        differences are computed by the database.
+        """
+        select = self.SELECT_JOIN_PACKED_MATCHES if self._is_packed() else self.SELECT_JOIN_MATCHES
+        with self.cursor(cursor_type=None) as cur:
+            self._fill_query_hashes(cur, [offsets])
+            cur.execute(select)
+            for sid, diff in cur:
+                yield (sid, diff)
+
+    def return_alignments(self, mappers, limit=None, min_count=None):
+        """
+        Counts the matches per (advert_id, offset_diff) pair in the
+        database, with a temporary table of the hashes whatever the
+        lookup_strategy. Only the counted pairs are sent back.
+        """
+        if self._is_packed():
+            select = self.SELECT_JOIN_PACKED_ALIGNMENTS
+        else:
+            select = self.SELECT_JOIN_ALIGNMENTS
+            # raw sha1 bytes
+            mappers = [dict((binascii.unhexlify(bhash), offset) for bhash, offset in mapper.items())
+                       for mapper in mappers]
+        query = select % (int(min_count or 1), self.NO_LIMIT if limit is None else int(limit))
+
+        with self.cursor(cursor_type=None) as cur:
+            self._fill_query_hashes(cur, mappers)
+            cur.execute(query)
+            return [(sid, diff, count) for sid, diff, count in cur]
 
-            cur.execute(query, vals)
+    def _fill_query_hashes(self, cur, mappers):
+        """
+        Fills the session's query hashes table, emptied on commit, with the
+        (hash, sample_offset) pairs of the `mappers`.
+        """
+        if self._is_packed():
+            create, insert, analyze = (self.CREATE_QUERY_PACKED_HASHES_TABLE,
+                                       self.INSERT_QUERY_PACKED_HASHES,
+                                       self.ANALYZE_QUERY_PACKED_HASHES)
+        else:
+            create, insert, analyze = (self.CREATE_QUERY_HASHES_TABLE,
+                                       self.INSERT_QUERY_HASHES,
+                                       self.ANALYZE_QUERY_HASHES)
+
+        cur.execute(create)
+        items = chain.from_iterable(mapper.items() for mapper in mappers)
+        for split_values in grouper(items, self.insert_chunk_size):
+            keys, sample_offsets = zip(*split_values)
+            cur.execute(insert, (list(keys), list(sample_offsets)))
+        cur.execute(analyze)
+
+    def _lookup_matches(self, offsets, keys):
+        """
+        return_matches of the hash `keys`, in one query with the keys as
+        a single bytea or bigint array.
+        """
+        with self.cursor(cursor_type=None) as cur:
+            if self._is_packed():
+                self._execute_prepared(cur, self.PACKED_MATCHES_STATEMENT,
+                                       self.PREPARE_PACKED_MATCHES, (keys,))
+                return [(sid, offset - offsets[key]) for key, sid, offset in cur]
 
-            for bhash, sid, offset in cur:
-                bhash = binascii.hexlify(bhash).upper()
-                yield (sid, offset - mapper[bhash])
+            self._execute_prepared(cur, self.MATCHES_STATEMENT, self.PREPARE_MATCHES, (keys,))
+            return [(sid, offset - offsets[bytes(bhash)]) for bhash, sid, offset in cur]
 
     def insert_client_advert(self, advertname, file_hash, audio_length, client_user_id):
         """
@@ -612,6 +1137,22 @@ class PostgresDatabase(Database):
             return cur.fetchall()
             # return cur.fetchone()
 
+    def get_all_client_adverts(self):
+        """
+        Returns every advert with its client and audio length.
+        """
+        with self.cursor(cursor_type=RealDictCursor) as cur:
+            cur.execute(self.SELECT_ALL_CLIENT_ADVERTS)
+            return cur.fetchall()
+
+    def get_all_client_advert_media_stations(self):
+        """
+        Returns the media stations of every advert.
+        """
+        with self.cursor(cursor_type=RealDictCursor) as cur:
+            cur.execute(self.SELECT_ALL_CLIENT_ADVERT_MEDIA_STATIONS)
+            return cur.fetchall()
+
     def update_client_campaign(self, advert_name, client_user_id):
         """
         Returns advert media_stations by their IDs.
@@ -620,11 +1161,12 @@ class PostgresDatabase(Database):
             cur.execute(self.UPDATE_CLIENT_CAMPAIGN, (advert_name, client_user_id,))
 
     def __getstate__(self):
-        return self._options,
+        return self._options, self.fingerprint_format
 
     def __setstate__(self, state):
-        self._options, = state
-        self.cursor = cursor_factory(**self._options)
+        options, fingerprint_format = state
+        self.__init__(**options)
+        self.fingerprint_format = fingerprint_format
 
 
 def grouper(iterable, num, fillvalue=None):
@@ -635,66 +1177,63 @@ def grouper(iterable, num, fillvalue=None):
             in zip_longest(fillvalue=fillvalue, *args))
 
 
-def cursor_factory(**factory_options):
+def cursor_factory(pool_size=DEFAULT_POOL_SIZE, pool_max_idle=DEFAULT_POOL_MAX_IDLE,
+                   **factory_options):
     """ Initializes the cursor, ex passes hostname, port,
     etc.
     """
-    def cursor(**options):
+    def cursor(cursor_type=DictCursor, **options):
         """ Builds a cursor.
         """
         options.update(factory_options)
-        return Cursor(**options)
+        pool = ConnectionPool.get(pool_size, pool_max_idle, **options)
+        return Cursor(cursor_type, pool)
     return cursor
 
 
-class Cursor(object):
-    """
-    Establishes a connection to the database and returns an open cursor.
-    ```python
-    # Use as context manager
-    with Cursor() as cur:
-        cur.execute(query)
-    ```
+class Connection(psycopg2.extensions.connection):
+    """ A connection that knows which statements are prepared on it.
     """
-    # _cache = queue.Queue(maxsize=5)
 
-    def __init__(self, cursor_type=DictCursor, **options):
-        super(Cursor, self).__init__()
+    def __init__(self, *args, **kwargs):
+        super(Connection, self).__init__(*args, **kwargs)
+        self.prepared = set()
 
-        self._cache = queue.Queue(maxsize=5)
 
-        try:
-            conn = self._cache.get_nowait()
-        except queue.Empty:
-            conn = psycopg2.connect(**options)
-        else:
-            # Ping the connection before using it from the cache.
-            conn.cursor().execute('SELECT 1')
+class ConnectionPool(connection_pool.ConnectionPool):
+    """
+    Process-wide pool of idle Postgres connections, see
+    connection_pool.ConnectionPool.
+    """
+    Error = psycopg2.Error
+    name = "POSTGRES"
 
-        self.conn = conn
-        # self.conn.autocommit(False)
-        self.cursor_type = cursor_type
+    def connect(self):
+        return psycopg2.connect(connection_factory=Connection, **self.options)
 
-    @classmethod
-    def clear_cache(cls):
-        """ Clears the cache.
-        """
-        cls._cache = queue.Queue(maxsize=5)
+    def ping(self, conn):
+        # Ping the connection before using it from the cache.
+        with conn.cursor() as cur:
+            cur.execute('SELECT 1')
+        conn.rollback()
 
-    def __enter__(self):
-        self.cursor = self.conn.cursor(cursor_factory=self.cursor_type)
-        return self.cursor
+    def closed(self, conn):
+        return bool(conn.closed)
 
-    def __exit__(self, extype, exvalue, traceback):
-        # if we had a Postgres related error we try to rollback the cursor.
-        if extype in [psycopg2.DatabaseError, psycopg2.InternalError]:
-            self.conn.rollback()
 
-        self.cursor.close()
-        self.conn.commit()
+class Cursor(connection_pool.PooledCursor):
+    """
+    A cursor of `cursor_type` on a pooled Postgres connection, see
+    connection_pool.PooledCursor.
+    ```python
+    # Use as context manager
+    with Cursor(DictCursor, pool) as cur:
+        cur.execute(query)
+    ```
+    """
+
+    def __init__(self, cursor_type=DictCursor, pool=None):
+        super(Cursor, self).__init__(cursor_type, pool)
 
-        # Put it back on the queue
-        try:
-            self._cache.put_nowait(self.conn)
-        except queue.Full:
-            self.conn.close()
+    def open(self, conn):
+        return conn.cursor(cursor_factory=self.cursor_type)
@@ -1,28 +1,40 @@
 from __future__ import absolute_import
 
+import os
 import sys
 import math
 import logging
+import tempfile
 
 import MySQLdb as mysql
 from MySQLdb.cursors import DictCursor
 
-from .database import Database
-from .fingerprint import FINGERPRINT_REDUCTION
+from . import connection_pool
+from .connection_pool import DEFAULT_POOL_SIZE, DEFAULT_POOL_MAX_IDLE
+from .database import (Database, LOOKUP_CHUNKS, LOOKUP_TEMP_TABLE, LOOKUP_STRATEGIES,
+                       lookup_chunks)
+from .fingerprint import (FINGERPRINT_REDUCTION, FINGERPRINT_FORMAT_SHA1,
+                          FINGERPRINT_FORMAT_PACKED32, FINGERPRINT_FORMAT_PACKED64)
 
 if sys.version_info[0] != 2:
-    import queue
     from itertools import zip_longest, chain
 else:
     # 3.x renames
     from itertools import izip_longest as zip_longest, chain
-    import Queue as queue
 
 logging.basicConfig(level=logging.INFO,
                     format='%(asctime)s - %(levelname)s - %(process)d - %(message)s',
                     datefmt='%Y-%m-%d %H:%M:%S')
 logger = logging.getLogger(__name__)
 
+# fingerprints written per INSERT or LOAD DATA statement
+DEFAULT_INSERT_CHUNK_SIZE = 10000
+# hashes looked up per query, and queries run at a time, in return_matches
+DEFAULT_LOOKUP_CHUNK_SIZE = 5000
+DEFAULT_LOOKUP_WORKERS = 4
+# LOAD DATA LOCAL INFILE reads a file, keep it in memory where there is tmpfs
+LOAD_DATA_DIR = "/dev/shm" if os.path.isdir("/dev/shm") else None
+
 
 class SQLDatabase(Database):
     """
@@ -64,6 +76,8 @@ class SQLDatabase(Database):
 
     # tables
     FINGERPRINTS_TABLENAME = "trams_fingerprint"
+    PACKED_FINGERPRINTS_TABLENAME = "trams_fingerprint_packed"
+    SCHEMA_TABLENAME = "trams_schema"
     ADVERTS_TABLENAME = "trams_advert"
     ADVERTS_MEDIA_STATIONS_TABLENAME = "trams_advert_media_stations"
     MEDIA_STATION_TABLENAME = "trams_mediastation"
@@ -79,6 +93,14 @@ class SQLDatabase(Database):
     ID = "id"
     FIELD_CAMPAIGN_STATUS = "campaign_status"
     FIELD_CAMPAIGN_FILE_NAME = "advert_file_name"
+    FIELD_SCHEMA_NAME = "name"
+    FIELD_SCHEMA_VALUE = "value"
+
+    # column type of the hash for each packed fingerprint format
+    PACKED_HASH_TYPES = {
+        FINGERPRINT_FORMAT_PACKED32: "int unsigned",
+        FINGERPRINT_FORMAT_PACKED64: "bigint unsigned",
+    }
 
     # creates
     CREATE_FINGERPRINTS_TABLE = """
@@ -96,6 +118,32 @@ class SQLDatabase(Database):
         Database.FIELD_ADVERT_ID, ADVERTS_TABLENAME, Database.FIELD_ADVERT_ID
     )
 
+    # the hash column type is filled in from PACKED_HASH_TYPES
+    CREATE_PACKED_FINGERPRINTS_TABLE = """
+        CREATE TABLE IF NOT EXISTS `%s` (
+             `%s` %%s not null,
+             `%s` mediumint unsigned not null,
+             `%s` int unsigned not null,
+        INDEX (%s),
+        UNIQUE KEY `unique_constraint` (%s, %s, %s),
+        FOREIGN KEY (%s) REFERENCES %s(%s) ON DELETE CASCADE
+    ) ENGINE=INNODB;""" % (
+        PACKED_FINGERPRINTS_TABLENAME, Database.FIELD_HASH,
+        Database.FIELD_ADVERT_ID, Database.FIELD_OFFSET, Database.FIELD_HASH,
+        Database.FIELD_ADVERT_ID, Database.FIELD_OFFSET, Database.FIELD_HASH,
+        Database.FIELD_ADVERT_ID, ADVERTS_TABLENAME, Database.FIELD_ADVERT_ID
+    )
+
+    # key/value flags describing the stored data, e.g. the fingerprint format
+    CREATE_SCHEMA_TABLE = """
+        CREATE TABLE IF NOT EXISTS `%s` (
+            `%s` varchar(64) not null,
+            `%s` varchar(64) not null,
+        PRIMARY KEY (`%s`)
+    ) ENGINE=INNODB;""" % (
+        SCHEMA_TABLENAME, FIELD_SCHEMA_NAME, FIELD_SCHEMA_VALUE, FIELD_SCHEMA_NAME
+    )
+
     CREATE_ADVERTS_TABLE = """
         CREATE TABLE IF NOT EXISTS `%s` (
             `%s` mediumint unsigned not null auto_increment,
@@ -140,6 +188,70 @@ class SQLDatabase(Database):
         Database.FIELD_OFFSET
     )
 
+    INSERT_PACKED_FINGERPRINT = """
+        INSERT IGNORE INTO %s (%s, %s, %s) 
+        values (%%s, %%s, %%s);
+    """ % (
+        PACKED_FINGERPRINTS_TABLENAME,
+        Database.FIELD_HASH,
+        Database.FIELD_ADVERT_ID,
+        Database.FIELD_OFFSET
+    )
+
+    # multi-row inserts (ignores duplicates), the rows are filled in per chunk
+    INSERT_FINGERPRINTS = """
+        INSERT IGNORE INTO %s (%s, %s, %s) 
+        values %%s;
+    """ % (
+        FINGERPRINTS_TABLENAME,
+        Database.FIELD_HASH,
+        Database.FIELD_ADVERT_ID,
+        Database.FIELD_OFFSET
+    )
+
+    INSERT_PACKED_FINGERPRINTS = """
+        INSERT IGNORE INTO %s (%s, %s, %s) 
+        values %%s;
+    """ % (
+        PACKED_FINGERPRINTS_TABLENAME,
+        Database.FIELD_HASH,
+        Database.FIELD_ADVERT_ID,
+        Database.FIELD_OFFSET
+    )
+
+    # bulk loads (ignores duplicates) tab separated hex hash, advert, offset
+    # lines from a client side file
+    LOAD_FINGERPRINTS = """
+        LOAD DATA LOCAL INFILE %%s IGNORE INTO TABLE %s (@hash, %s, %s)
+        SET %s = UNHEX(@hash);
+    """ % (
+        FINGERPRINTS_TABLENAME,
+        Database.FIELD_ADVERT_ID,
+        Database.FIELD_OFFSET,
+        Database.FIELD_HASH
+    )
+
+    LOAD_PACKED_FINGERPRINTS = """
+        LOAD DATA LOCAL INFILE %%s IGNORE INTO TABLE %s (%s, %s, %s);
+    """ % (
+        PACKED_FINGERPRINTS_TABLENAME,
+        Database.FIELD_HASH,
+        Database.FIELD_ADVERT_ID,
+        Database.FIELD_OFFSET
+    )
+
+    UPSERT_SCHEMA_VALUE = """
+        INSERT INTO %s (%s, %s) 
+        values (%%s, %%s)
+        ON DUPLICATE KEY UPDATE %s = VALUES(%s);
+    """ % (
+        SCHEMA_TABLENAME,
+        FIELD_SCHEMA_NAME,
+        FIELD_SCHEMA_VALUE,
+        FIELD_SCHEMA_VALUE,
+        FIELD_SCHEMA_VALUE
+    )
+
     # inserts advert in database
     INSERT_ADVERT = """
         INSERT INTO %s (%s, %s, %s) 
@@ -197,6 +309,164 @@ class SQLDatabase(Database):
         Database.FIELD_HASH
     )
 
+    SELECT_PACKED_MULTIPLE = """
+        SELECT %s, %s, %s 
+        FROM %s 
+        WHERE %s IN (%%s);
+    """ % (
+        Database.FIELD_HASH,
+        Database.FIELD_ADVERT_ID,
+        Database.FIELD_OFFSET,
+        PACKED_FINGERPRINTS_TABLENAME,
+        Database.FIELD_HASH
+    )
+
+    # Session table of the (hash, sample offset) pairs of one lookup, see
+    # _join_matches. Offsets are signed for the difference in SQL.
+    QUERY_HASHES_TABLENAME = "trams_query_hashes"
+    FIELD_SAMPLE_OFFSET = "sample_offset"
+
+    CREATE_QUERY_HASHES_TABLE = """
+        CREATE TEMPORARY TABLE IF NOT EXISTS `%s` (
+             `%s` binary(%s) not null,
+             `%s` int not null,
+        INDEX (%s)
+    ) ENGINE=MEMORY;""" % (
+        QUERY_HASHES_TABLENAME, Database.FIELD_HASH, str(math.ceil(FINGERPRINT_REDUCTION / 2.)),
+        FIELD_SAMPLE_OFFSET, Database.FIELD_HASH
+    )
+
+    QUERY_PACKED_HASHES_TABLENAME = "trams_query_packed_hashes"
+    CREATE_QUERY_PACKED_HASHES_TABLE = """
+        CREATE TEMPORARY TABLE IF NOT EXISTS `%s` (
+             `%s` bigint unsigned not null,
+             `%s` int not null,
+        INDEX (%s)
+    ) ENGINE=MEMORY;""" % (
+        QUERY_PACKED_HASHES_TABLENAME, Database.FIELD_HASH, FIELD_SAMPLE_OFFSET,
+        Database.FIELD_HASH
+    )
+
+    TRUNCATE_QUERY_HASHES = "TRUNCATE TABLE `%s`;" % QUERY_HASHES_TABLENAME
+    TRUNCATE_QUERY_PACKED_HASHES = "TRUNCATE TABLE `%s`;" % QUERY_PACKED_HASHES_TABLENAME
+
+    INSERT_QUERY_HASHES = """
+        INSERT INTO `%s` (%s, %s) values %%s;
+    """ % (QUERY_HASHES_TABLENAME, Database.FIELD_HASH, FIELD_SAMPLE_OFFSET)
+
+    INSERT_QUERY_PACKED_HASHES = """
+        INSERT INTO `%s` (%s, %s) values %%s;
+    """ % (QUERY_PACKED_HASHES_TABLENAME, Database.FIELD_HASH, FIELD_SAMPLE_OFFSET)
+
+    # (advert_id, db_offset - sample_offset) of every matching fingerprint
+    SELECT_JOIN_MATCHES = """
+        SELECT f.%s, CAST(f.%s AS SIGNED) - q.%s
+        FROM %s f
+        JOIN `%s` q ON f.%s = q.%s;
+    """ % (
+        Database.FIELD_ADVERT_ID, Database.FIELD_OFFSET, FIELD_SAMPLE_OFFSET,
+        FINGERPRINTS_TABLENAME, QUERY_HASHES_TABLENAME, Database.FIELD_HASH,
+        Database.FIELD_HASH
+    )
+
+    SELECT_JOIN_PACKED_MATCHES = """
+        SELECT f.%s, CAST(f.%s AS SIGNED) - q.%s
+        FROM %s f
+        JOIN `%s` q ON f.%s = q.%s;
+    """ % (
+        Database.FIELD_ADVERT_ID, Database.FIELD_OFFSET, FIELD_SAMPLE_OFFSET,
+        PACKED_FINGERPRINTS_TABLENAME, QUERY_PACKED_HASHES_TABLENAME, Database.FIELD_HASH,
+        Database.FIELD_HASH
+    )
+
+    # (advert_id, diff, count) of the pairs with at least min_count matches,
+    # the most first. Filled in with min_count and the LIMIT row count.
+    SELECT_JOIN_ALIGNMENTS = """
+        SELECT f.%s, CAST(f.%s AS SIGNED) - q.%s AS diff, COUNT(*) AS cnt
+        FROM %s f
+        JOIN `%s` q ON f.%s = q.%s
+        GROUP BY f.%s, diff
+        HAVING COUNT(*) >= %%d
+        ORDER BY cnt DESC, f.%s, diff
+        LIMIT %%s;
+    """ % (
+        Database.FIELD_ADVERT_ID, Database.FIELD_OFFSET, FIELD_SAMPLE_OFFSET,
+        FINGERPRINTS_TABLENAME, QUERY_HASHES_TABLENAME, Database.FIELD_HASH,
+        Database.FIELD_HASH, Database.FIELD_ADVERT_ID, Database.FIELD_ADVERT_ID
+    )
+
+    SELECT_JOIN_PACKED_ALIGNMENTS = """
+        SELECT f.%s, CAST(f.%s AS SIGNED) - q.%s AS diff, COUNT(*) AS cnt
+        FROM %s f
+        JOIN `%s` q ON f.%s = q.%s
+        GROUP BY f.%s, diff
+        HAVING COUNT(*) >= %%d
+        ORDER BY cnt DESC, f.%s, diff
+        LIMIT %%s;
+    """ % (
+        Database.FIELD_ADVERT_ID, Database.FIELD_OFFSET, FIELD_SAMPLE_OFFSET,
+        PACKED_FINGERPRINTS_TABLENAME, QUERY_PACKED_HASHES_TABLENAME, Database.FIELD_HASH,
+        Database.FIELD_HASH, Database.FIELD_ADVERT_ID, Database.FIELD_ADVERT_ID
+    )
+
+    # LIMIT row count for no limit
+    NO_LIMIT = "18446744073709551615"
+
+    # Every fingerprint, or the ones of one advert, with the raw stored hash
+    SELECT_FINGERPRINTS = """
+        SELECT %s, %s, %s 
+        FROM %s;
+    """ % (
+        Database.FIELD_HASH,
+        Database.FIELD_ADVERT_ID,
+        Database.FIELD_OFFSET,
+        FINGERPRINTS_TABLENAME
+    )
+
+    SELECT_ADVERT_FINGERPRINTS = """
+        SELECT %s, %s, %s 
+        FROM %s 
+        WHERE %s = %%s;
+    """ % (
+        Database.FIELD_HASH,
+        Database.FIELD_ADVERT_ID,
+        Database.FIELD_OFFSET,
+        FINGERPRINTS_TABLENAME,
+        Database.FIELD_ADVERT_ID
+    )
+
+    SELECT_PACKED_FINGERPRINTS = """
+        SELECT %s, %s, %s 
+        FROM %s;
+    """ % (
+        Database.FIELD_HASH,
+        Database.FIELD_ADVERT_ID,
+        Database.FIELD_OFFSET,
+        PACKED_FINGERPRINTS_TABLENAME
+    )
+
+    SELECT_ADVERT_PACKED_FINGERPRINTS = """
+        SELECT %s, %s, %s 
+        FROM %s 
+        WHERE %s = %%s;
+    """ % (
+        Database.FIELD_HASH,
+        Database.FIELD_ADVERT_ID,
+        Database.FIELD_OFFSET,
+        PACKED_FINGERPRINTS_TABLENAME,
+        Database.FIELD_ADVERT_ID
+    )
+
+    SELECT_SCHEMA_VALUE = """
+        SELECT %s 
+        FROM %s 
+        WHERE %s = %%s;
+    """ % (
+        FIELD_SCHEMA_VALUE,
+        SCHEMA_TABLENAME,
+        FIELD_SCHEMA_NAME
+    )
+
     SELECT_ALL = """
         SELECT %s, %s 
         FROM %s;
@@ -250,6 +520,29 @@ class SQLDatabase(Database):
         Database.FIELD_ADVERT_ID
     )
 
+    # all adverts and their media stations, for the metadata cache
+    SELECT_ALL_CLIENT_ADVERTS = """
+        SELECT %s, %s, HEX(%s) as %s, %s, %s 
+        FROM %s;
+        """ % (
+        Database.FIELD_ADVERT_ID,
+        Database.FIELD_ADVERTNAME,
+        Database.FIELD_FILE_SHA1,
+        Database.FIELD_FILE_SHA1,
+        Database.CLIENT_USER_ID,
+        Database.AUDIO_LENGTH,
+        ADVERTS_TABLENAME
+    )
+
+    SELECT_ALL_CLIENT_ADVERT_MEDIA_STATIONS = """
+        SELECT %s, %s 
+        FROM %s;
+        """ % (
+        Database.FIELD_ADVERT_ID,
+        Database.MEDIA_STATION_ID,
+        ADVERTS_MEDIA_STATIONS_TABLENAME
+    )
+
     SELECT_ADVERTS = """
         SELECT %s, %s, HEX(%s) as %s 
         FROM %s 
@@ -285,6 +578,13 @@ class SQLDatabase(Database):
         FINGERPRINTS_TABLENAME
     )
 
+    SELECT_NUM_PACKED_FINGERPRINTS = """
+        SELECT COUNT(*) as n 
+        FROM %s;
+    """ % (
+        PACKED_FINGERPRINTS_TABLENAME
+    )
+
     SELECT_UNIQUE_ADVERT_IDS = """
         SELECT COUNT(DISTINCT %s) as n 
         FROM %s 
@@ -323,7 +623,9 @@ class SQLDatabase(Database):
     # drops
     DROP_ADVERTS_MEDIA_STATIONS = """DROP TABLE IF EXISTS %s;""" % ADVERTS_MEDIA_STATIONS_TABLENAME
     DROP_FINGERPRINTS = """DROP TABLE IF EXISTS %s;""" % FINGERPRINTS_TABLENAME
+    DROP_PACKED_FINGERPRINTS = """DROP TABLE IF EXISTS %s;""" % PACKED_FINGERPRINTS_TABLENAME
     DROP_ADVERTS = """DROP TABLE IF EXISTS %s;""" % ADVERTS_TABLENAME
+    DROP_SCHEMA = """DROP TABLE IF EXISTS %s;""" % SCHEMA_TABLENAME
 
     # delete
     # DELETE_UNFINGERPRINTED = """
@@ -335,15 +637,51 @@ class SQLDatabase(Database):
         DELETE FROM %s WHERE %s = 0;
     """ % (ADVERTS_TABLENAME, FIELD_FINGERPRINTED)
 
-    def __init__(self, **options):
+    def __init__(self, pool_size=DEFAULT_POOL_SIZE, pool_max_idle=DEFAULT_POOL_MAX_IDLE,
+                 insert_chunk_size=DEFAULT_INSERT_CHUNK_SIZE, load_data=False,
+                 lookup_chunk_size=DEFAULT_LOOKUP_CHUNK_SIZE,
+                 lookup_workers=DEFAULT_LOOKUP_WORKERS, lookup_strategy=LOOKUP_CHUNKS,
+                 **options):
+        """
+        `insert_chunk_size` fingerprints are written per statement, with
+        LOAD DATA LOCAL INFILE if `load_data` (the server must allow
+        local_infile) or else a multi-row INSERT.
+        return_matches looks up `lookup_chunk_size` hashes per query, up to
+        `lookup_workers` queries at a time on pooled connections, or with
+        `lookup_strategy` "temp_table" joins a temporary table of them.
+        """
         super(SQLDatabase, self).__init__()
-        self.cursor = cursor_factory(**options)
-        self._options = options
+        if lookup_strategy not in LOOKUP_STRATEGIES:
+            raise ValueError("Unknown lookup_strategy %r, expected one of %s" %
+                             (lookup_strategy, ", ".join(LOOKUP_STRATEGIES)))
+        self.cursor = cursor_factory(pool_size, pool_max_idle, **options)
+        self.insert_chunk_size = insert_chunk_size
+        self.load_data = load_data
+        self.lookup_chunk_size = lookup_chunk_size
+        self.lookup_workers = lookup_workers
+        self.lookup_strategy = lookup_strategy
+        self._options = dict(options, pool_size=pool_size, pool_max_idle=pool_max_idle,
+                             insert_chunk_size=insert_chunk_size, load_data=load_data,
+                             lookup_chunk_size=lookup_chunk_size,
+                             lookup_workers=lookup_workers, lookup_strategy=lookup_strategy)
+
+    def _is_packed(self):
+        return self.fingerprint_format != FINGERPRINT_FORMAT_SHA1
+
+    def before_fork(self):
+        super(SQLDatabase, self).before_fork()
+        # Close the idle connections, a child must not share their sockets.
+        ConnectionPool.close_all()
 
     def after_fork(self):
+        super(SQLDatabase, self).after_fork()
         # Clear the cursor cache, we don't want any stale connections from
         # the previous process.
-        Cursor.clear_cache()
+        ConnectionPool.reset_all()
+
+    def close(self):
+        super(SQLDatabase, self).close()
+        ConnectionPool.close_all()
 
     def setup(self):
         """
@@ -353,8 +691,12 @@ class SQLDatabase(Database):
         fingerprints associated with them.
         """
         with self.cursor(charset="utf8") as cur:
+            cur.execute(self.CREATE_SCHEMA_TABLE)
             cur.execute(self.CREATE_ADVERTS_TABLE)
             cur.execute(self.CREATE_FINGERPRINTS_TABLE)
+            if self._is_packed():
+                cur.execute(self.CREATE_PACKED_FINGERPRINTS_TABLE %
+                            self.PACKED_HASH_TYPES[self.fingerprint_format])
             cur.execute(self.CREATE_ADVERTS_MEDIA_STATIONS_TABLE)
             cur.execute(self.DELETE_UNFINGERPRINTED)
 
@@ -369,9 +711,46 @@ class SQLDatabase(Database):
         with self.cursor(charset="utf8") as cur:
             cur.execute(self.DROP_ADVERTS_MEDIA_STATIONS_TABLE)
             cur.execute(self.DROP_FINGERPRINTS)
+            cur.execute(self.DROP_PACKED_FINGERPRINTS)
             cur.execute(self.DROP_ADVERTS)
+            cur.execute(self.DROP_SCHEMA)
         self.setup()
 
+    def reset_fingerprints(self):
+        """
+        Drops and recreates the fingerprints table of the current
+        fingerprint format, keeping the adverts.
+
+        .. warning:
+            This will result in a loss of data
+        """
+        with self.cursor(charset="utf8") as cur:
+            if self._is_packed():
+                cur.execute(self.DROP_PACKED_FINGERPRINTS)
+                cur.execute(self.CREATE_PACKED_FINGERPRINTS_TABLE %
+                            self.PACKED_HASH_TYPES[self.fingerprint_format])
+            else:
+                cur.execute(self.DROP_FINGERPRINTS)
+                cur.execute(self.CREATE_FINGERPRINTS_TABLE)
+
+    def get_stored_fingerprint_format(self):
+        """
+        Returns the fingerprint format recorded in the schema table.
+        """
+        with self.cursor(charset="utf8") as cur:
+            cur.execute(self.SELECT_SCHEMA_VALUE, (self.SCHEMA_FINGERPRINT_FORMAT,))
+            for value, in cur:
+                return value
+            return None
+
+    def store_fingerprint_format(self, fingerprint_format):
+        """
+        Records the fingerprint format of the stored fingerprints.
+        """
+        with self.cursor(charset="utf8") as cur:
+            cur.execute(self.UPSERT_SCHEMA_VALUE,
+                        (self.SCHEMA_FINGERPRINT_FORMAT, fingerprint_format))
+
     def delete_unfingerprinted_adverts(self):
         """
         Removes all adverts that have no fingerprints associated with them.
@@ -394,8 +773,9 @@ class SQLDatabase(Database):
         """
         Returns number of fingerprints the database has fingerprinted.
         """
+        query = self.SELECT_NUM_PACKED_FINGERPRINTS if self._is_packed() else self.SELECT_NUM_FINGERPRINTS
         with self.cursor(charset="utf8") as cur:
-            cur.execute(self.SELECT_NUM_FINGERPRINTS)
+            cur.execute(query)
 
             for count, in cur:
                 return count
@@ -430,8 +810,9 @@ class SQLDatabase(Database):
         """
         Insert a (sha1, advert_id, offset) row into database.
         """
+        query = self.INSERT_PACKED_FINGERPRINT if self._is_packed() else self.INSERT_FINGERPRINT
         with self.cursor(charset="utf8") as cur:
-            cur.execute(self.INSERT_FINGERPRINT, (hash, sid, offset))
+            cur.execute(query, (hash, sid, offset))
 
     # def insert_advert(self, advertname, file_hash):
     def insert_advert(self, advertname, file_hash, audio_length):
@@ -464,54 +845,141 @@ class SQLDatabase(Database):
         """
         return self.query(None)
 
+    def get_fingerprints(self, sid=None):
+        """
+        Yields every (hash, advert_id, offset) of the current fingerprint
+        format, or only the ones of advert `sid`.
+        """
+        if self._is_packed():
+            query = self.SELECT_PACKED_FINGERPRINTS if sid is None else self.SELECT_ADVERT_PACKED_FINGERPRINTS
+        else:
+            query = self.SELECT_FINGERPRINTS if sid is None else self.SELECT_ADVERT_FINGERPRINTS
+
+        # unbuffered, so the whole table is never held in a result set
+        with self.cursor(cursor_type=mysql.cursors.SSCursor, charset="utf8") as cur:
+            cur.execute(query, None if sid is None else (sid,))
+            for hash, sid, offset in cur:
+                yield (hash, sid, offset)
+
     def insert_hashes(self, sid, hashes):
         """
         Insert series of hash => advert_id, offset
         values into the database.
         """
-        values = []
-        for hash, offset in hashes:
-            values.append((hash, sid, offset))
+        if self.load_data:
+            self._load_hashes(sid, hashes)
+            return
+
+        if self._is_packed():
+            insert, placeholder = self.INSERT_PACKED_FINGERPRINTS, '(%s, %s, %s)'
+        else:
+            insert, placeholder = self.INSERT_FINGERPRINTS, '(UNHEX(%s), %s, %s)'
 
-        base_query = "INSERT IGNORE INTO %s (%s, %s, %s) values " % \
-                     (self.FINGERPRINTS_TABLENAME, Database.FIELD_HASH, Database.FIELD_ADVERT_ID, Database.FIELD_OFFSET)
+        values = [(hash, sid, offset) for hash, offset in hashes]
         with self.cursor(charset="utf8") as cur:
-            values.sort(key=lambda tup: tup[0])
-            cur.execute("START TRANSACTION;")
-            for split_values in grouper(values, 1000):
-                cur.executemany(self.INSERT_FINGERPRINT, split_values)
-                values2tuple = tuple(chain.from_iterable(split_values))
-                query = base_query + ', '.join(['(UNHEX(%s), %s, %s)'] * len(split_values))
-                query += ";"
-                cur.execute(query, values2tuple)
-            cur.execute("COMMIT;")
+            # one multi-row insert per chunk, committed together on exit
+            for split_values in grouper(values, self.insert_chunk_size):
+                query = insert % ', '.join([placeholder] * len(split_values))
+                cur.execute(query, tuple(chain.from_iterable(split_values)))
+
+    def _load_hashes(self, sid, hashes):
+        """
+        insert_hashes with LOAD DATA LOCAL INFILE, a chunk at a time
+        through a temporary file in LOAD_DATA_DIR.
+        """
+        load = self.LOAD_PACKED_FINGERPRINTS if self._is_packed() else self.LOAD_FINGERPRINTS
+        line = "%s\t" + str(sid) + "\t%d\n"
+
+        with self.cursor(charset="utf8", local_infile=1) as cur:
+            for split_values in grouper(hashes, self.insert_chunk_size):
+                data = "".join([line % (hash, offset) for hash, offset in split_values])
+                with tempfile.NamedTemporaryFile(suffix=".tsv", dir=LOAD_DATA_DIR) as f:
+                    f.write(data.encode("utf8"))
+                    f.flush()
+                    cur.execute(load, (f.name,))
 
     def return_matches(self, mapper):
         """
         Return the (advert_id, offset_diff) tuples associated with
-        a list of (sha1, sample_offset) values.
+        a list of (sha1, sample_offset) values as a generator, a chunk of
+        hashes at a time.
         """
-        # Create a dictionary of hash => offset pairs for later lookups
-        # mapper = {}
-        # for hash, offset in hashes:
-        #     mapper[hash.upper()] = offset
+        if self.lookup_strategy == LOOKUP_TEMP_TABLE:
+            return self._join_matches(mapper)
+        return lookup_chunks(lambda vals: self._lookup_matches(mapper, vals),
+                             list(mapper.keys()), self.lookup_chunk_size,
+                             self.lookup_executor(self.lookup_workers))
 
-        # Get an iteratable of all the hashes we need
-        # values = list(mapper.keys())
-        vals = list(mapper.keys())
+    def _join_matches(self, mapper):
+        """
+        return_matches by inserting the (hash, sample_offset) pairs into a
+        temporary table and joining it to the fingerprints, the offset
+        differences are computed by the database.
+        """
+        select = self.SELECT_JOIN_PACKED_MATCHES if self._is_packed() else self.SELECT_JOIN_MATCHES
+        with self.cursor(charset="utf8") as cur:
+            self._fill_query_hashes(cur, [mapper])
+            cur.execute(select)
+            for sid, diff in cur:
+                yield (sid, diff)
+
+    def return_alignments(self, mappers, limit=None, min_count=None):
+        """
+        Counts the matches per (advert_id, offset_diff) pair in the
+        database, with a temporary table of the hashes whatever the
+        lookup_strategy. Only the counted pairs are sent back.
+        """
+        if self._is_packed():
+            select = self.SELECT_JOIN_PACKED_ALIGNMENTS
+        else:
+            select = self.SELECT_JOIN_ALIGNMENTS
+        query = select % (int(min_count or 1), self.NO_LIMIT if limit is None else int(limit))
 
         with self.cursor(charset="utf8") as cur:
-            # for split_values in grouper(values, 1000):
-            #     vals = list(split_values)
-            # Create our IN part of the query
+            self._fill_query_hashes(cur, mappers)
+            cur.execute(query)
+            return [(sid, diff, count) for sid, diff, count in cur]
+
+    def _fill_query_hashes(self, cur, mappers):
+        """
+        Replaces the contents of the session's query hashes table with the
+        (hash, sample_offset) pairs of the `mappers`.
+        """
+        if self._is_packed():
+            create, truncate, insert = (self.CREATE_QUERY_PACKED_HASHES_TABLE,
+                                        self.TRUNCATE_QUERY_PACKED_HASHES,
+                                        self.INSERT_QUERY_PACKED_HASHES)
+            placeholder = '(%s, %s)'
+        else:
+            create, truncate, insert = (self.CREATE_QUERY_HASHES_TABLE,
+                                        self.TRUNCATE_QUERY_HASHES,
+                                        self.INSERT_QUERY_HASHES)
+            placeholder = '(UNHEX(%s), %s)'
+
+        # the table lives as long as the pooled connection
+        cur.execute(create)
+        cur.execute(truncate)
+        items = chain.from_iterable(mapper.items() for mapper in mappers)
+        for split_values in grouper(items, self.insert_chunk_size):
+            query = insert % ', '.join([placeholder] * len(split_values))
+            cur.execute(query, tuple(chain.from_iterable(split_values)))
+
+    def _lookup_matches(self, mapper, vals):
+        """
+        return_matches of the hashes `vals`, in one query.
+        """
+        # Create our IN part of the query
+        if self._is_packed():
+            # packed keys are plain integers, no UNHEX/HEX round trip
+            query = self.SELECT_PACKED_MULTIPLE % ', '.join(['%s'] * len(vals))
+        else:
             query = self.SELECT_MULTIPLE
             query = query % ', '.join(['UNHEX(%s)'] * len(vals))
 
+        with self.cursor(charset="utf8") as cur:
             cur.execute(query, vals)
-
-            for hash, sid, offset in cur:
-                # (sid, db_offset - advert_sampled_offset)
-                yield (sid, offset - mapper[hash])
+            # (sid, db_offset - advert_sampled_offset)
+            return [(sid, offset - mapper[hash]) for hash, sid, offset in cur]
 
     def insert_client_advert(self, advertname, file_hash, audio_length, client_user_id):
         """
@@ -556,6 +1024,22 @@ class SQLDatabase(Database):
             return cur.fetchall()
             # return cur.fetchone()
 
+    def get_all_client_adverts(self):
+        """
+        Returns every advert with its client and audio length.
+        """
+        with self.cursor(cursor_type=DictCursor, charset="utf8") as cur:
+            cur.execute(self.SELECT_ALL_CLIENT_ADVERTS)
+            return cur.fetchall()
+
+    def get_all_client_advert_media_stations(self):
+        """
+        Returns the media stations of every advert.
+        """
+        with self.cursor(cursor_type=DictCursor, charset="utf8") as cur:
+            cur.execute(self.SELECT_ALL_CLIENT_ADVERT_MEDIA_STATIONS)
+            return cur.fetchall()
+
     def update_client_campaign(self, advert_name, client_user_id):
         """
         Returns advert media_stations by their IDs.
@@ -564,11 +1048,12 @@ class SQLDatabase(Database):
             cur.execute(self.UPDATE_CLIENT_CAMPAIGN, (advert_name, client_user_id))
 
     def __getstate__(self):
-        return self._options,
+        return self._options, self.fingerprint_format
 
     def __setstate__(self, state):
-        self._options, = state
-        self.cursor = cursor_factory(**self._options)
+        options, fingerprint_format = state
+        self.__init__(**options)
+        self.fingerprint_format = fingerprint_format
 
 
 def grouper(iterable, n, fillvalue=None):
@@ -577,88 +1062,46 @@ def grouper(iterable, n, fillvalue=None):
             in zip_longest(fillvalue=fillvalue, *args))
 
 
-def cursor_factory(**factory_options):
-    def cursor(**options):
+def cursor_factory(pool_size=DEFAULT_POOL_SIZE, pool_max_idle=DEFAULT_POOL_MAX_IDLE,
+                   **factory_options):
+    def cursor(cursor_type=mysql.cursors.Cursor, **options):
         options.update(factory_options)
-        return Cursor(**options)
+        pool = ConnectionPool.get(pool_size, pool_max_idle, **options)
+        return Cursor(cursor_type, pool)
     return cursor
 
 
-class Cursor(object):
+class ConnectionPool(connection_pool.ConnectionPool):
+    """
+    Process-wide pool of idle MySQL connections, see
+    connection_pool.ConnectionPool.
     """
-    Establishes a connection to the database and returns an open cursor.
+    Error = mysql.MySQLError
+    name = "MYSQL"
+
+    def connect(self):
+        return mysql.connect(**self.options)
 
+    def ping(self, conn):
+        conn.ping()
+
+
+class Cursor(connection_pool.PooledCursor):
+    """
+    A cursor of `cursor_type` on a pooled MySQL connection, see
+    connection_pool.PooledCursor.
 
     ```python
     # Use as context manager
-    with Cursor() as cur:
+    with Cursor(DictCursor, pool) as cur:
         cur.execute(query)
     ```
     """
-    # _cache = queue.Queue(maxsize=5)
-
-    def __init__(self, cursor_type=mysql.cursors.Cursor, **options):
-        super(Cursor, self).__init__()
-
-        self._cache = queue.Queue(maxsize=5)
-
-        try:
-            self.temp_conn = self._cache.get_nowait()
-            # self._cache.task_done()
-
-            logger.info("MYSQL: setting connection to get items from cache...")
-
-        # except (queue.Empty, mysql.MySQLError) as err:
-        except:
-            self.temp_conn = mysql.connect(**options)
-            logger.error("MYSQL queue empty error: trying to establish new connection...")
-            # logger.error("MYSQL queue empty error: trying to establish new connection...CAUSE: %s" % err)
-        # else:
-        #     # Ping the connection before using it from the cache.
-        #     self.temp_conn.ping(True)
-
-        self.conn = self.temp_conn
-        self.conn.autocommit(False)
-        self.cursor_type = cursor_type
-
-    @classmethod
-    def clear_cache(cls):
-        cls._cache = queue.Queue(maxsize=5)
-        # cls.__class__._cache = queue.Queue(maxsize=5)
-
-    def __enter__(self):
-        self.cursor = self.conn.cursor(self.cursor_type)
-        logger.info("MYSQL: running query...")
-        return self.cursor
-
-    def __exit__(self, extype, exvalue, traceback):
-        # if we had a MySQL related error we try to rollback the cursor.
-        if extype is mysql.MySQLError:
-            self.cursor.rollback()
-            logger.error("MYSQL ERROR: trying to rollback...")
-
-        # if exvalue:
-        #     logger.info("MYSQL CURSOR EXIT: Exvalue: %s ..." % exvalue)
-        # if traceback:
-        #     logger.info("MYSQL CURSOR EXIT: Traceback: %s ..." % traceback)
-
-        self.cursor.close()
-        self.conn.commit()
-
-        # Put it back on the queue
-        try:
-            self._cache.put_nowait(self.conn)
-            # self.__class__._cache.put_nowait(self.conn)
-            self._cache.task_done()
-            logger.info("MYSQL Cache: trying to put items back into queue...")
-        # except (queue.Full, mysql.MySQLError) as err:
-        except:
-            self.conn.close()
-            logger.error("MYSQL ERROR: trying to close connection...")
-            # logger.error("MYSQL ERROR: trying to close connection...CAUSE: %s" % err)
-
-        # added for test
-        else:
-            if self.conn:
-                self.conn.close()
-                logger.info("MYSQL Connection: Closing connection...")
+
+    def __init__(self, cursor_type=mysql.cursors.Cursor, pool=None):
+        super(Cursor, self).__init__(cursor_type, pool)
+
+    def open(self, conn):
+        conn.autocommit(False)
+        logger.debug("MYSQL: running query...")
+        return conn.cursor(self.cursor_type)
@@ -1,13 +1,30 @@
+import io
 import os
 import fnmatch
+import subprocess
 from hashlib import sha1
 
 import numpy as np
 from pydub import AudioSegment
 from pydub.utils import audioop
 
+from . import fingerprint
 from . import wavio
 
+######################################################################
+# How files are decoded. "pydub" keeps every channel at the file's own
+# sample rate. "ffmpeg" decodes straight from an ffmpeg pipe to one mono
+# channel at fingerprint.DEFAULT_FS, fingerprinting half the samples of a
+# stereo file.
+DECODER_PYDUB = "pydub"
+DECODER_FFMPEG = "ffmpeg"
+DECODERS = (DECODER_PYDUB, DECODER_FFMPEG)
+DEFAULT_DECODER = DECODER_PYDUB
+
+######################################################################
+# ffmpeg binary, can be a full path
+FFMPEG_BIN = "ffmpeg"
+
 # try:
 #     range = xrange
 # except NameError:
@@ -42,7 +59,48 @@ def find_files(path, extensions):
                 yield (p, extension)
 
 
-def read(filename, limit=None):
+def ffmpeg_command(source, Fs=fingerprint.DEFAULT_FS, realtime=False, loop=False,
+                   ffmpeg=FFMPEG_BIN, limit=None):
+    """
+    ffmpeg arguments decoding `source` (file path or stream URL) to mono
+    s16le PCM at `Fs` on stdout.
+
+    realtime: read the input at its native rate (-re), e.g. to replay a
+              local file as if it were live
+        loop: repeat the input forever, only for local files
+       limit: stop after this many seconds of the input (-t)
+    """
+    command = [ffmpeg, "-hide_banner", "-loglevel", "error", "-nostdin"]
+    if realtime:
+        command.append("-re")
+    if loop:
+        command.extend(["-stream_loop", "-1"])
+    if limit:
+        command.extend(["-t", str(limit)])
+    command.extend(["-i", source, "-vn", "-ac", "1", "-ar", str(Fs),
+                    "-f", "s16le", "-acodec", "pcm_s16le", "pipe:1"])
+    return command
+
+
+def read_hashed(filepath, blocksize=2**20):
+    """
+    Reads a whole file, computing its unique_hash in the same pass.
+
+    returns: (data, file_hash)
+    """
+    s = sha1()
+    data = []
+    with open(filepath, "rb") as f:
+        while True:
+            buf = f.read(blocksize)
+            if not buf:
+                break
+            s.update(buf)
+            data.append(buf)
+    return b"".join(data), s.hexdigest().upper()
+
+
+def read(filename, limit=None, file_hash=None, decoder=DEFAULT_DECODER):
     """
     Reads any file supported by pydub (ffmpeg) and returns the data contained
     within. If file reading fails due to input being a 24-bit wav file,
@@ -52,14 +110,76 @@ def read(filename, limit=None):
     of the file by specifying the `limit` parameter. This is the amount of
     seconds from the start of the file.
 
-    returns: (channels, samplerate)
+    The file is read once, hashing it on the way, unless its `file_hash`
+    is already known. With the ffmpeg `decoder` ffmpeg reads the file
+    itself, see decode_ffmpeg.
+
+    returns: (channels, samplerate, file_hash, audio_length)
+    """
+    if decoder == DECODER_FFMPEG:
+        file_hash = file_hash or unique_hash(filename)
+        channels, fs, audio_length = decode_ffmpeg(filename, limit)
+        return channels, fs, file_hash, audio_length
+    if decoder != DECODER_PYDUB:
+        raise ValueError("Unsupported decoder: %s" % decoder)
+
+    file_name, file_extension = os.path.splitext(filename)
+    if file_hash is None:
+        data, file_hash = read_hashed(filename)
+        channels, fs, audio_length = decode(io.BytesIO(data), file_extension[1:], limit)
+    else:
+        with open(filename, "rb") as f:
+            channels, fs, audio_length = decode(f, file_extension[1:], limit)
+    return channels, fs, file_hash, audio_length
+
+
+def decode_ffmpeg(filename, limit=None, Fs=fingerprint.DEFAULT_FS):
+    """
+    Decodes a file to mono s16le PCM at `Fs` with one ffmpeg process,
+    reading its stdout straight into a preallocated buffer. With a `limit`
+    ffmpeg stops after that many seconds.
+
+    returns: ([samples], Fs, audio_length)
+    """
+    if limit:
+        nbytes = int(limit * Fs) * 2
+    else:
+        # the PCM of a 16 bit stereo wav at Fs, grown when short
+        nbytes = max(os.path.getsize(filename) // 2, Fs * 2)
+    data = bytearray(nbytes)
+    size = 0
+
+    process = subprocess.Popen(ffmpeg_command(filename, Fs=Fs, limit=limit),
+                               stdout=subprocess.PIPE, stdin=subprocess.DEVNULL)
+    try:
+        while True:
+            if size == len(data):
+                data.extend(bytes(len(data)))
+            n = process.stdout.readinto(memoryview(data)[size:])
+            if not n:
+                break
+            size += n
+    finally:
+        process.stdout.close()
+        returncode = process.wait()
+    if returncode != 0:
+        raise IOError("ffmpeg exited with %d decoding %s" % (returncode, filename))
+
+    samples = np.frombuffer(data, dtype="<i2", count=size // 2)
+    return [samples], Fs, float(len(samples)) / Fs
+
+
+def decode(f, format, limit=None):
+    """
+    Decodes the audio file object `f` of `format` (its file extension).
+
+    returns: (channels, samplerate, audio_length)
     """
     # pydub does not support 24-bit wav files, use wavio when this occurs
     try:
-        file_name, file_extension = os.path.splitext(filename)
         # This method will play back file types whose extension matches the coded
         # This includes wav and mp3 so we should be good
-        audiofile = AudioSegment.from_file(filename, format=file_extension[1:])
+        audiofile = AudioSegment.from_file(f, format=format)
 
         # audiofile = AudioSegment.from_file(filename, format="mp3")
 
@@ -68,7 +188,7 @@ def read(filename, limit=None):
         if limit:
             audiofile = audiofile[:limit * 1000]
 
-        data = np.fromstring(audiofile._data, np.int16)
+        data = np.frombuffer(audiofile._data, np.int16)
 
         channels = []
         for chn in range(audiofile.channels):
@@ -76,7 +196,8 @@ def read(filename, limit=None):
 
         fs = audiofile.frame_rate
     except audioop.error:
-        fs, _, audiofile = wavio.readwav(filename)
+        f.seek(0)
+        fs, _, audiofile = wavio.readwav(f)
 
         if limit:
             audiofile = audiofile[:limit * 1000]
@@ -88,8 +209,7 @@ def read(filename, limit=None):
         for chn in audiofile:
             channels.append(chn)
 
-    # return channels, audiofile.frame_rate, unique_hash(filename)
-    return channels, audiofile.frame_rate, unique_hash(filename), float(len(audiofile)) / 1000.0
+    return channels, fs, float(len(audiofile)) / 1000.0
 
 
 def path_to_advertname(path):
@@ -3,12 +3,12 @@ import hashlib
 from operator import itemgetter
 
 import numpy as np
-import matplotlib.mlab as mlab
-import matplotlib.pyplot as plt
-from scipy.ndimage.filters import maximum_filter
+from scipy.ndimage.filters import maximum_filter, maximum_filter1d
 from scipy.ndimage.morphology import (generate_binary_structure,
                                       iterate_structure, binary_erosion)
 
+from . import stft
+
 IDX_FREQ_I = 0
 IDX_TIME_J = 1
 
@@ -44,6 +44,25 @@ DEFAULT_AMP_MIN = 10
 # fingerprints and faster matching, but can potentially affect accuracy.
 PEAK_NEIGHBORHOOD_SIZE = 20
 
+######################################################################
+# Peak picker used by get_2D_peaks.
+# "footprint": the original scipy maximum_filter with a diamond footprint
+# of radius PEAK_NEIGHBORHOOD_SIZE.
+# "diamond": the same diamond computed by dilating with a 3x3 cross
+# PEAK_NEIGHBORHOOD_SIZE times, finds exactly the same peaks much faster.
+# "rectangle": separable 1-D max filters over a square of half width
+# PEAK_RECTANGLE_SIZE. Fastest, but approximates the diamond, so adverts
+# must be fingerprinted with the same picker that recognizes them.
+PEAK_PICKER_FOOTPRINT = "footprint"
+PEAK_PICKER_DIAMOND = "diamond"
+PEAK_PICKER_RECTANGLE = "rectangle"
+PEAK_PICKERS = (PEAK_PICKER_FOOTPRINT, PEAK_PICKER_DIAMOND, PEAK_PICKER_RECTANGLE)
+DEFAULT_PEAK_PICKER = PEAK_PICKER_DIAMOND
+
+# Half width of the square neighborhood of the "rectangle" picker, chosen
+# so the square covers about the same area as the diamond.
+PEAK_RECTANGLE_SIZE = int(round(PEAK_NEIGHBORHOOD_SIZE / np.sqrt(2)))
+
 ######################################################################
 # Thresholds on how close or far fingerprints can be in time in order
 # to be paired as a fingerprint. If your max is too low, higher values of
@@ -67,69 +86,105 @@ FINGERPRINT_REDUCTION = 20
 FINGERPRINT_REDUCTION = (40 if FINGERPRINT_REDUCTION > 40 else FINGERPRINT_REDUCTION)
 FINGERPRINT_REDUCTION = (FINGERPRINT_REDUCTION + 1 if FINGERPRINT_REDUCTION % 2 == 1 else FINGERPRINT_REDUCTION)
 
+######################################################################
+# Engine used to pair peaks into hashes. "loop" is the original
+# per-pair Python loop, "numpy" builds every (freq1, freq2, t_delta, t1)
+# pair in bulk and only SHA1s each distinct triple once. Both produce
+# bit-identical hashes in the same order.
+HASH_ENGINE_LOOP = "loop"
+HASH_ENGINE_NUMPY = "numpy"
+HASH_ENGINES = (HASH_ENGINE_LOOP, HASH_ENGINE_NUMPY)
+DEFAULT_HASH_ENGINE = HASH_ENGINE_NUMPY
+
+######################################################################
+# How a fingerprint is stored. "sha1" is the hex SHA1 prefix above,
+# the packed formats bit-pack the (freq1, freq2, t_delta) triple into a
+# single integer key. Field widths are (freq1, freq2, t_delta) in bits,
+# packed64 leaves the sign bit free so it fits a signed BIGINT.
+FINGERPRINT_FORMAT_SHA1 = "sha1"
+FINGERPRINT_FORMAT_PACKED32 = "packed32"
+FINGERPRINT_FORMAT_PACKED64 = "packed64"
+FINGERPRINT_FORMATS = (FINGERPRINT_FORMAT_SHA1,
+                       FINGERPRINT_FORMAT_PACKED32,
+                       FINGERPRINT_FORMAT_PACKED64)
+DEFAULT_FINGERPRINT_FORMAT = FINGERPRINT_FORMAT_SHA1
+
+PACKED_LAYOUTS = {
+    FINGERPRINT_FORMAT_PACKED32: (12, 12, 8),
+    FINGERPRINT_FORMAT_PACKED64: (20, 20, 23),
+}
+
 
 def fingerprint(channel_samples, Fs=DEFAULT_FS,
                 wsize=DEFAULT_WINDOW_SIZE,
                 wratio=DEFAULT_OVERLAP_RATIO,
                 fan_value=DEFAULT_FAN_VALUE,
-                amp_min=DEFAULT_AMP_MIN):
+                amp_min=DEFAULT_AMP_MIN,
+                hash_engine=DEFAULT_HASH_ENGINE,
+                fingerprint_format=DEFAULT_FINGERPRINT_FORMAT,
+                peak_picker=DEFAULT_PEAK_PICKER):
     """
     FFT the channel, log transform output, find local maxima, then return
     locally sensitive hashes.
     """
-    # FFT the signal and extract frequency components
-    arr2D = mlab.specgram(
-        channel_samples,
-        NFFT=wsize,
-        Fs=Fs,
-        window=mlab.window_hanning,
-        noverlap=int(wsize * wratio))[0]
-
-    # apply log transform since specgram() returns linear array
-    arr2D = 10 * np.log10(arr2D)
-    arr2D[arr2D == -np.inf] = 0  # replace infs with zeros
+    arr2D = spectrogram(channel_samples, Fs=Fs, wsize=wsize, wratio=wratio)
 
     # find local maxima
-    local_maxima = get_2D_peaks(arr2D, plot=False, amp_min=amp_min)
+    local_maxima = get_2D_peaks(arr2D, plot=False, amp_min=amp_min,
+                                peak_picker=peak_picker)
 
     # return hashes
-    return generate_hashes(local_maxima, fan_value=fan_value)
+    return generate_hashes(local_maxima, fan_value=fan_value,
+                           hash_engine=hash_engine,
+                           fingerprint_format=fingerprint_format)
 
 
-def get_2D_peaks(arr2D, plot=False, amp_min=DEFAULT_AMP_MIN):
-    # http://docs.scipy.org/doc/scipy/reference/generated/scipy.ndimage.morphology.iterate_structure.html#scipy.ndimage.morphology.iterate_structure
-    struct = generate_binary_structure(2, 1)
-    neighborhood = iterate_structure(struct, PEAK_NEIGHBORHOOD_SIZE)
+def spectrogram(channel_samples, Fs=DEFAULT_FS,
+                wsize=DEFAULT_WINDOW_SIZE,
+                wratio=DEFAULT_OVERLAP_RATIO):
+    """
+    Log power spectrogram of the channel, (frequencies, frames).
+    """
+    # FFT the signal and extract frequency components
+    arr2D = stft.specgram(
+        channel_samples,
+        wsize=wsize,
+        noverlap=int(wsize * wratio),
+        Fs=Fs)
 
-    # find local maxima using our fliter shape
-    local_max = maximum_filter(arr2D, footprint=neighborhood) == arr2D
-    background = (arr2D == 0)
-    eroded_background = binary_erosion(background, structure=neighborhood,
-                                       border_value=1)
+    # apply log transform since specgram() returns linear array
+    with np.errstate(divide="ignore"):
+        np.log10(arr2D, out=arr2D)
+    arr2D *= 10
+    arr2D[arr2D == -np.inf] = 0  # replace infs with zeros
+    return arr2D
 
-    # Boolean mask of arr2D with True at peaks
-    detected_peaks = local_max ^ eroded_background
-
-    # extract peaks
-    amps = arr2D[detected_peaks]
-    j, i = np.where(detected_peaks)
-
-    # filter peaks
-    amps = amps.flatten()
-    peaks = list(zip(i, j, amps))
-    # peaks_filtered = [x for x in peaks if x[2] > amp_min]  # freq, time, amp
-    peaks_filtered = [x for x in peaks if x[2] > amp_min]  # freq, time, amp
-
-    # get indices for frequency and time
-    # frequency_idx = [x[1] for x in peaks_filtered]
-    # time_idx = [x[0] for x in peaks_filtered]
-    frequency_idx = []
-    time_idx = []
-    for x in peaks_filtered:
-        frequency_idx.append(x[1])
-        time_idx.append(x[0])
+
+def get_2D_peaks(arr2D, plot=False, amp_min=DEFAULT_AMP_MIN,
+                 peak_picker=DEFAULT_PEAK_PICKER):
+    """
+    Finds the local maxima of the spectrogram louder than `amp_min`.
+
+    returns: (frequency_idx, time_idx) int arrays, ordered by frequency
+             then time
+    """
+    if peak_picker == PEAK_PICKER_FOOTPRINT:
+        local_max = _footprint_local_max(arr2D)
+    elif peak_picker == PEAK_PICKER_DIAMOND:
+        local_max = _diamond_local_max(arr2D)
+    elif peak_picker == PEAK_PICKER_RECTANGLE:
+        local_max = _rectangle_local_max(arr2D)
+    else:
+        raise ValueError("Unsupported peak picker: %s" % peak_picker)
+
+    # a quiet cell is never a peak, this also drops the flat zero
+    # background that is trivially a local maximum
+    local_max &= arr2D > amp_min
+    frequency_idx, time_idx = np.nonzero(local_max)
 
     if plot:
+        import matplotlib.pyplot as plt
+
         # scatter of the peaks
         fig, ax = plt.subplots()
         ax.imshow(arr2D)
@@ -140,21 +195,125 @@ def get_2D_peaks(arr2D, plot=False, amp_min=DEFAULT_AMP_MIN):
         plt.gca().invert_yaxis()
         plt.show()
 
-    return list(zip(frequency_idx, time_idx))
+    return frequency_idx, time_idx
+
 
+_neighborhood = None
+
+
+def _footprint_local_max(arr2D):
+    global _neighborhood
+    if _neighborhood is None:
+        # http://docs.scipy.org/doc/scipy/reference/generated/scipy.ndimage.morphology.iterate_structure.html#scipy.ndimage.morphology.iterate_structure
+        struct = generate_binary_structure(2, 1)
+        _neighborhood = iterate_structure(struct, PEAK_NEIGHBORHOOD_SIZE)
+
+    # find local maxima using our fliter shape
+    local_max = maximum_filter(arr2D, footprint=_neighborhood) == arr2D
+    background = (arr2D == 0)
+    eroded_background = binary_erosion(background, structure=_neighborhood,
+                                       border_value=1)
 
-def generate_hashes(peaks, fan_value=DEFAULT_FAN_VALUE):
+    # Boolean mask of arr2D with True at peaks
+    return local_max ^ eroded_background
+
+
+def _diamond_local_max(arr2D):
+    # dilating PEAK_NEIGHBORHOOD_SIZE times with a 3x3 cross is the same as
+    # one max filter over the diamond footprint. Edges repeat themselves,
+    # which matches the "reflect" mode of maximum_filter.
+    dilated = np.array(arr2D)
+    previous = np.empty_like(dilated)
+    for _ in range(PEAK_NEIGHBORHOOD_SIZE):
+        previous[...] = dilated
+        np.maximum(dilated[1:], previous[:-1], out=dilated[1:])
+        np.maximum(dilated[:-1], previous[1:], out=dilated[:-1])
+        np.maximum(dilated[:, 1:], previous[:, :-1], out=dilated[:, 1:])
+        np.maximum(dilated[:, :-1], previous[:, 1:], out=dilated[:, :-1])
+    return dilated == arr2D
+
+
+def _rectangle_local_max(arr2D):
+    size = 2 * PEAK_RECTANGLE_SIZE + 1
+    dilated = maximum_filter1d(arr2D, size, axis=0)
+    maximum_filter1d(dilated, size, axis=1, output=dilated)
+    return dilated == arr2D
+
+
+def generate_hashes(peaks, fan_value=DEFAULT_FAN_VALUE,
+                    hash_engine=DEFAULT_HASH_ENGINE,
+                    fingerprint_format=DEFAULT_FINGERPRINT_FORMAT,
+                    first_target=0):
     """
     Hash list structure:
        sha1_hash[0:20]    time_offset
     [(e05b341a9b77a51fd26, 32), ... ]
+
+    With a packed `fingerprint_format` the hash is an int key instead:
+    [(8392904, 32), ... ]
+
+    `hash_engine` selects how the peak pairs are built, see HASH_ENGINES.
+    `first_target` skips pairs of peaks already hashed, see peak_pairs.
+    """
+    if fingerprint_format not in FINGERPRINT_FORMATS:
+        raise ValueError("Unsupported fingerprint format: %s" % fingerprint_format)
+
+    if hash_engine == HASH_ENGINE_LOOP:
+        if fingerprint_format == FINGERPRINT_FORMAT_SHA1:
+            return _generate_hashes_loop(peaks, fan_value, first_target)
+        return _generate_packed_hashes_loop(peaks, fan_value, fingerprint_format, first_target)
+    elif hash_engine == HASH_ENGINE_NUMPY:
+        if fingerprint_format == FINGERPRINT_FORMAT_SHA1:
+            return _generate_hashes_numpy(peaks, fan_value, first_target)
+        return _generate_packed_hashes_numpy(peaks, fan_value, fingerprint_format, first_target)
+
+    raise ValueError("Unsupported hash engine: %s" % hash_engine)
+
+
+def pack_hashes(freq1, freq2, t_delta, fingerprint_format=FINGERPRINT_FORMAT_PACKED32):
+    """
+    Bit-packs (freq1, freq2, t_delta) into one integer key per pair.
+
+    Works on scalars as well as int arrays. Raises ValueError if a field
+    does not fit the layout of `fingerprint_format`.
     """
+    f1_bits, f2_bits, dt_bits = PACKED_LAYOUTS[fingerprint_format]
+    for name, value, bits in (("freq1", freq1, f1_bits),
+                              ("freq2", freq2, f2_bits),
+                              ("t_delta", t_delta, dt_bits)):
+        if np.size(value) and (np.min(value) < 0 or np.max(value) >> bits):
+            raise ValueError("%s does not fit in %d bits of %s fingerprints"
+                             % (name, bits, fingerprint_format))
+
+    return (freq1 << (f2_bits + dt_bits)) | (freq2 << dt_bits) | t_delta
+
+
+def unpack_hashes(keys, fingerprint_format=FINGERPRINT_FORMAT_PACKED32):
+    """
+    Inverse of `pack_hashes`, returns (freq1, freq2, t_delta).
+    """
+    f1_bits, f2_bits, dt_bits = PACKED_LAYOUTS[fingerprint_format]
+    return (keys >> (f2_bits + dt_bits),
+            (keys >> dt_bits) & ((1 << f2_bits) - 1),
+            keys & ((1 << dt_bits) - 1))
+
+
+def _peak_list(peaks):
+    # get_2D_peaks returns (frequency_idx, time_idx) arrays, the loop
+    # engines walk (freq, time) pairs
+    if isinstance(peaks, tuple):
+        return list(zip(*peaks))
+    return peaks
+
+
+def _generate_hashes_loop(peaks, fan_value, first_target=0):
+    peaks = _peak_list(peaks)
     if PEAK_SORT:
         peaks = sorted(peaks, key=itemgetter(1))
 
     for i in range(len(peaks)):
         for j in range(1, fan_value):
-            if (i + j) < len(peaks):
+            if first_target <= (i + j) < len(peaks):
 
                 freq1 = peaks[i][IDX_FREQ_I]
                 freq2 = peaks[i + j][IDX_FREQ_I]
@@ -167,3 +326,106 @@ def generate_hashes(peaks, fan_value=DEFAULT_FAN_VALUE):
                     h = hashlib.sha1(
                         "|".join((str(freq1), str(freq2), str(t_delta))).encode('utf-8'))
                     yield (h.hexdigest()[0:FINGERPRINT_REDUCTION], t1)
+
+
+def _generate_packed_hashes_loop(peaks, fan_value, fingerprint_format, first_target=0):
+    f1_bits, f2_bits, dt_bits = PACKED_LAYOUTS[fingerprint_format]
+    freq_limit = 1 << min(f1_bits, f2_bits)
+    peaks = _peak_list(peaks)
+    if PEAK_SORT:
+        peaks = sorted(peaks, key=itemgetter(1))
+
+    for i in range(len(peaks)):
+        for j in range(1, fan_value):
+            if first_target <= (i + j) < len(peaks):
+
+                freq1 = int(peaks[i][IDX_FREQ_I])
+                freq2 = int(peaks[i + j][IDX_FREQ_I])
+                t1 = peaks[i][IDX_TIME_J]
+                t2 = peaks[i + j][IDX_TIME_J]
+                t_delta = int(t2 - t1)
+
+                if (t_delta >= MIN_HASH_TIME_DELTA) and (t_delta <= MAX_HASH_TIME_DELTA):
+                    if freq1 >= freq_limit or freq2 >= freq_limit or t_delta >> dt_bits:
+                        # let pack_hashes report what does not fit
+                        pack_hashes(freq1, freq2, t_delta, fingerprint_format)
+                    key = (freq1 << (f2_bits + dt_bits)) | (freq2 << dt_bits) | t_delta
+                    yield (key, t1)
+
+
+def peak_pairs(peaks, fan_value=DEFAULT_FAN_VALUE, first_target=0):
+    """
+    Builds every (freq1, freq2, t_delta, t1) pair of the fan-out at once.
+
+           peaks: (frequency_idx, time_idx) arrays from get_2D_peaks or a
+                  sequence of (freq, time) pairs
+    first_target: only keep pairs whose second peak comes at or after
+                  this position in time order, used to pair new peaks
+                  with ones that were already hashed
+
+    The pairs come out anchor-major, in the same order the per-pair loop
+    visits them, so a hash that occurs twice keeps the same last offset.
+
+    returns: (freq1, freq2, t_delta, t1) as int64 arrays
+    """
+    if isinstance(peaks, tuple):
+        freqs, times = (np.asarray(idx, dtype=np.int64) for idx in peaks)
+    else:
+        peaks = np.asarray(list(peaks), dtype=np.int64).reshape(-1, 2)
+        freqs = peaks[:, IDX_FREQ_I]
+        times = peaks[:, IDX_TIME_J]
+
+    if PEAK_SORT:
+        # mergesort is stable, like sorted() in the loop engine
+        order = np.argsort(times, kind="mergesort")
+        freqs = freqs[order]
+        times = times[order]
+
+    # anchor i is paired with i + 1 ... i + fan_value - 1
+    npeaks = len(times)
+    fan = max(fan_value - 1, 0)
+    anchor = np.repeat(np.arange(npeaks), fan)
+    target = anchor + np.tile(np.arange(1, fan + 1), npeaks)
+
+    in_range = (target < npeaks) & (target >= first_target)
+    anchor = anchor[in_range]
+    target = target[in_range]
+
+    t_delta = times[target] - times[anchor]
+    keep = (t_delta >= MIN_HASH_TIME_DELTA) & (t_delta <= MAX_HASH_TIME_DELTA)
+    anchor = anchor[keep]
+
+    return freqs[anchor], freqs[target[keep]], t_delta[keep], times[anchor]
+
+
+def _generate_hashes_numpy(peaks, fan_value, first_target=0):
+    return hash_pairs(*peak_pairs(peaks, fan_value, first_target))
+
+
+def hash_pairs(freq1, freq2, t_delta, t1, fingerprint_format=DEFAULT_FINGERPRINT_FORMAT):
+    """
+    Turns the arrays from `peak_pairs` into [(hash, t1), ...].
+    """
+    if fingerprint_format != FINGERPRINT_FORMAT_SHA1:
+        keys = pack_hashes(freq1, freq2, t_delta, fingerprint_format)
+        return list(zip(keys.tolist(), t1.tolist()))
+
+    if not len(t1):
+        return []
+
+    # the same (freq1, freq2, t_delta) triple shows up many times in a
+    # segment, so SHA1 each distinct triple once and scatter it back
+    keys = (freq1 << 42) | (freq2 << 21) | t_delta
+    unique, inverse = np.unique(keys, return_inverse=True)
+    sha1 = hashlib.sha1
+    digests = np.array([
+        sha1(b"%d|%d|%d" % (key >> 42, (key >> 21) & 0x1FFFFF, key & 0x1FFFFF))
+        .hexdigest()[0:FINGERPRINT_REDUCTION]
+        for key in unique.tolist()])
+
+    return list(zip(digests[inverse.reshape(-1)].tolist(), t1.tolist()))
+
+
+def _generate_packed_hashes_numpy(peaks, fan_value, fingerprint_format, first_target=0):
+    return hash_pairs(*peak_pairs(peaks, fan_value, first_target),
+                      fingerprint_format=fingerprint_format)
@@ -0,0 +1,121 @@
+""" On-disk cache of fingerprinted files, keyed by their content.
+
+An entry holds what fingerprinting a file produced: the distinct
+(keys, offsets) hash arrays of _fingerprint_worker and the audio length.
+Entries are named by the SHA1 of the file (decoder.unique_hash) and a digest
+of the limit, the decoder and the fingerprint parameters the index file
+header records (fingerprint_index.fingerprint_parameters), so a renamed or
+copied file hits the same entry and changing any parameter misses it. A hit skips decoding the file and
+the STFT.
+
+Entries are uncompressed .npz files, written next to their destination and
+renamed over it, so a process never reads a partial one. A hit touches the
+entry's modification time. After a store the least recently used entries
+are removed until the cache fits in `max_bytes`.
+
+Enabled with a "fingerprint_cache" section in the config:
+
+    "fingerprint_cache": {
+        "directory": "/var/cache/tramscore",
+        "max_bytes": 1073741824
+    }
+"""
+from __future__ import absolute_import
+
+import hashlib
+import json
+import os
+import tempfile
+import zipfile
+
+import numpy as np
+
+from .fingerprint_index import fingerprint_parameters
+
+# bump when the entry layout or the hashes of a file change
+CACHE_VERSION = 2
+CACHE_SUFFIX = ".npz"
+DEFAULT_MAX_BYTES = 2 ** 30
+
+
+class FingerprintCache(object):
+    """
+    Fingerprint results by file SHA1, limit and fingerprint options. Only
+    the directory and size are kept, so the cache can be handed to pool
+    workers and shared by processes.
+    """
+
+    def __init__(self, directory, max_bytes=DEFAULT_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+
+    def entry_path(self, file_hash, limit, fingerprint_options):
+        """
+        fingerprint_options: Tramscore.fingerprint_options and the
+                             "decoder" the file is read with
+        """
+        params = json.dumps([CACHE_VERSION, limit, fingerprint_options.get("decoder"),
+                             sorted(fingerprint_parameters(fingerprint_options).items())])
+        digest = hashlib.sha1(params.encode("utf-8")).hexdigest()[:16]
+        return os.path.join(self.directory, "%s-%s%s" % (file_hash, digest, CACHE_SUFFIX))
+
+    def get(self, file_hash, limit, fingerprint_options):
+        """
+        returns: ((keys, offsets), audio_length) of the file, or None if it
+                 is not cached
+        """
+        path = self.entry_path(file_hash, limit, fingerprint_options)
+        try:
+            with np.load(path, allow_pickle=False) as entry:
+                hashes = entry["keys"], entry["offsets"]
+                audio_length = float(entry["audio_length"])
+        except (IOError, KeyError, ValueError, zipfile.BadZipFile):
+            # missing, evicted by another process or unreadable
+            return None
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+        return hashes, audio_length
+
+    def put(self, file_hash, limit, fingerprint_options, hashes, audio_length):
+        path = self.entry_path(file_hash, limit, fingerprint_options)
+        keys, offsets = hashes
+        fd, temp_path = tempfile.mkstemp(prefix=".%s." % os.path.basename(path), dir=self.directory)
+        try:
+            with os.fdopen(fd, "wb") as f:
+                np.savez(f, keys=keys, offsets=offsets, audio_length=np.float64(audio_length))
+            os.replace(temp_path, path)
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+        self.evict()
+
+    def evict(self):
+        """
+        Removes the least recently used entries until the cache holds at
+        most max_bytes.
+        """
+        entries = []
+        for name in os.listdir(self.directory):
+            if not name.endswith(CACHE_SUFFIX) or name.startswith("."):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                # removed by another process
+                pass
+            total -= size
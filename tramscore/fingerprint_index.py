@@ -0,0 +1,391 @@
+""" Sorted fingerprint index, in memory or as a memory mapped file.
+
+A FingerprintIndex holds every fingerprint in three parallel arrays sorted
+by hash: the hash keys, the advert codes and the offsets. A lookup is two
+`np.searchsorted` calls over all the query hashes at once.
+
+Written to a file, every monitor process maps the same pages and the OS
+page cache holds one copy however many processes recognize against it.
+File layout:
+
+    magic    8 bytes   b"TRAMSIDX"
+    version  uint32    INDEX_VERSION
+    length   uint32    bytes of the JSON header
+    header   JSON      fingerprint parameters, advert ids, array layout
+    keys     sorted hash keys ("S10" sha1 bytes or int64 packed keys)
+    codes    int32 position of each row's advert in header["sids"]
+    offsets  int32 offset of each row's hash in the advert
+
+Files are written next to their destination and renamed over it, so a
+reader sees either the old or the new index, never a partial one. Processes
+that mapped the old file keep using it until they reopen.
+"""
+from __future__ import absolute_import
+
+import binascii
+import json
+import math
+import os
+import struct
+import tempfile
+
+import numpy as np
+
+from . import fingerprint
+from .database import Database
+
+# Bytes of a stored sha1 fingerprint
+SHA1_KEY_BYTES = int(math.ceil(fingerprint.FINGERPRINT_REDUCTION / 2.))
+
+INDEX_MAGIC = b"TRAMSIDX"
+INDEX_VERSION = 1
+# arrays start on this boundary
+INDEX_ALIGNMENT = 64
+
+_PREFIX = struct.Struct("<8sII")
+
+
+def key_dtype(fingerprint_format):
+    if fingerprint_format == fingerprint.FINGERPRINT_FORMAT_SHA1:
+        return np.dtype("S%d" % SHA1_KEY_BYTES)
+    return np.dtype(np.int64)
+
+
+def hash_key(hash, fingerprint_format):
+    """
+    The stored key of a hash: the raw bytes of a hexadecimal sha1 prefix,
+    or the packed integer itself.
+    """
+    if fingerprint_format == fingerprint.FINGERPRINT_FORMAT_SHA1:
+        return binascii.unhexlify(hash[:fingerprint.FINGERPRINT_REDUCTION])
+    return int(hash)
+
+
+def index_arrays(rows, fingerprint_format):
+    """
+    [(key, code, offset), ...] to index arrays, dropping duplicates
+    like the unique constraint of the fingerprint tables does.
+    """
+    rows = list(dict.fromkeys(rows))
+    keys = np.array([row[0] for row in rows], dtype=key_dtype(fingerprint_format))
+    codes = np.array([row[1] for row in rows], dtype=np.int32)
+    offsets = np.array([row[2] for row in rows], dtype=np.int32)
+    return keys, codes, offsets
+
+
+class FingerprintIndex(object):
+    """
+    Immutable sorted (keys, codes, offsets) arrays. Adding or removing
+    fingerprints returns a new index, so readers never see a half update.
+
+       keys: sha1 keys as raw bytes ("S10") or packed int64 keys
+      codes: int32 position of the advert in the owner's advert list
+    offsets: int32 offset of the hash in the advert
+    """
+
+    def __init__(self, keys, codes, offsets):
+        super(FingerprintIndex, self).__init__()
+        self.keys = keys
+        self.codes = codes
+        self.offsets = offsets
+
+    def __len__(self):
+        return len(self.keys)
+
+    @classmethod
+    def empty(cls, key_dtype):
+        return cls(np.zeros(0, dtype=key_dtype), np.zeros(0, dtype=np.int32),
+                   np.zeros(0, dtype=np.int32))
+
+    @classmethod
+    def build(cls, keys, codes, offsets):
+        order = np.argsort(keys, kind="mergesort")
+        return cls(keys[order], codes[order], offsets[order])
+
+    def add(self, keys, codes, offsets):
+        new = self.build(keys, codes, offsets)
+        # np.insert puts each new row in front of the first equal key
+        positions = np.searchsorted(self.keys, new.keys)
+        return FingerprintIndex(np.insert(self.keys, positions, new.keys),
+                                np.insert(self.codes, positions, new.codes),
+                                np.insert(self.offsets, positions, new.offsets))
+
+    def remove(self, codes):
+        keep = ~np.isin(self.codes, codes)
+        return FingerprintIndex(self.keys[keep], self.codes[keep], self.offsets[keep])
+
+    def lookup(self, keys):
+        """
+        Finds every stored fingerprint with one of `keys`.
+
+        returns: (query positions, codes, offsets) of the matching rows
+        """
+        lo = np.searchsorted(self.keys, keys, side="left")
+        hi = np.searchsorted(self.keys, keys, side="right")
+        counts = hi - lo
+        total = int(counts.sum())
+
+        # rows lo[i] ... hi[i] - 1 for every query key i
+        query = np.repeat(np.arange(len(keys)), counts)
+        first = np.cumsum(counts) - counts
+        rows = np.repeat(lo, counts) + (np.arange(total) - np.repeat(first, counts))
+        return query, self.codes[rows], self.offsets[rows]
+
+
+class IndexFormatError(Exception):
+    """
+    Raised when an index file is unreadable or was built with another
+    version or other fingerprint parameters.
+    """
+    pass
+
+
+def fingerprint_parameters(fingerprint_options):
+    """
+    Parameters the stored hashes depend on, recorded in the header.
+
+    fingerprint_options: the "fingerprint_format" and "peak_picker" the
+                         hashes were computed with, e.g.
+                         Tramscore.fingerprint_options
+    """
+    return {
+        "fingerprint_format": fingerprint_options.get("fingerprint_format",
+                                                      fingerprint.DEFAULT_FINGERPRINT_FORMAT),
+        "peak_picker": fingerprint_options.get("peak_picker", fingerprint.DEFAULT_PEAK_PICKER),
+        "fingerprint_reduction": fingerprint.FINGERPRINT_REDUCTION,
+        "window_size": fingerprint.DEFAULT_WINDOW_SIZE,
+        "overlap_ratio": fingerprint.DEFAULT_OVERLAP_RATIO,
+        "fan_value": fingerprint.DEFAULT_FAN_VALUE,
+        "amp_min": fingerprint.DEFAULT_AMP_MIN,
+        "peak_neighborhood_size": fingerprint.PEAK_NEIGHBORHOOD_SIZE,
+        "min_hash_time_delta": fingerprint.MIN_HASH_TIME_DELTA,
+        "max_hash_time_delta": fingerprint.MAX_HASH_TIME_DELTA,
+    }
+
+
+def _align(position):
+    return -(-position // INDEX_ALIGNMENT) * INDEX_ALIGNMENT
+
+
+def write_index(path, index, sids, fingerprint_options):
+    """
+    Atomically writes the FingerprintIndex `index` to `path`.
+
+    sids: advert identifiers, index.codes are positions in it
+    """
+    count = len(index)
+    header = {
+        "parameters": fingerprint_parameters(fingerprint_options),
+        "count": count,
+        "sids": list(sids),
+        "arrays": [],
+    }
+    arrays = (("keys", index.keys), ("codes", index.codes), ("offsets", index.offsets))
+
+    # the array positions depend on the header length and vice versa,
+    # a few passes settle it
+    start = 0
+    while True:
+        header["arrays"] = []
+        position = start
+        for name, array in arrays:
+            header["arrays"].append({"name": name, "dtype": array.dtype.str,
+                                     "offset": position})
+            position = _align(position + array.nbytes)
+        encoded = json.dumps(header).encode("utf-8")
+        if _align(_PREFIX.size + len(encoded)) == start:
+            break
+        start = _align(_PREFIX.size + len(encoded))
+
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, temp_path = tempfile.mkstemp(prefix=".%s." % os.path.basename(path), dir=directory)
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(_PREFIX.pack(INDEX_MAGIC, INDEX_VERSION, len(encoded)))
+            f.write(encoded)
+            for entry, (_, array) in zip(header["arrays"], arrays):
+                f.seek(entry["offset"])
+                f.write(np.ascontiguousarray(array).tobytes())
+            f.truncate(_align(f.tell()))
+            f.flush()
+            os.fsync(f.fileno())
+        # readable by the monitor processes of other users
+        os.chmod(temp_path, 0o644)
+        os.replace(temp_path, path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+
+def read_header(path):
+    with open(path, "rb") as f:
+        prefix = f.read(_PREFIX.size)
+        if len(prefix) != _PREFIX.size:
+            raise IndexFormatError("%s is not a fingerprint index" % path)
+        magic, version, length = _PREFIX.unpack(prefix)
+        if magic != INDEX_MAGIC:
+            raise IndexFormatError("%s is not a fingerprint index" % path)
+        if version != INDEX_VERSION:
+            raise IndexFormatError("%s is index version %s, expected %s"
+                                   % (path, version, INDEX_VERSION))
+        return json.loads(f.read(length).decode("utf-8"))
+
+
+class IndexFile(object):
+    """
+    A read-only memory mapped index file.
+
+    ```python
+    index_file = IndexFile.open(path, {"fingerprint_format": "sha1", "peak_picker": "diamond"})
+    query, codes, offsets = index_file.index.lookup(keys)
+    sids = index_file.sids[codes]
+    ```
+    """
+
+    def __init__(self, path, header, index, sids, stat, excluded=frozenset()):
+        super(IndexFile, self).__init__()
+        self.path = path
+        self.header = header
+        self.index = index
+        # advert identifier of every code
+        self.sids = sids
+        # tells a replaced file apart, see replaced()
+        self.stat = stat
+        # adverts whose rows are skipped, e.g. deleted since the last build
+        self.excluded = excluded
+        self.live = None
+        if excluded:
+            self.live = np.array([sid not in excluded for sid in sids.tolist()], dtype=bool)
+
+    @classmethod
+    def open(cls, path, fingerprint_options):
+        stat = _stat_key(path)
+        header = read_header(path)
+        if header["parameters"] != fingerprint_parameters(fingerprint_options):
+            raise IndexFormatError("%s was built with %s" % (path, header["parameters"]))
+
+        count = header["count"]
+        arrays = {}
+        for entry in header["arrays"]:
+            dtype = np.dtype(entry["dtype"])
+            if count:
+                arrays[entry["name"]] = np.memmap(path, dtype=dtype, mode="r",
+                                                  offset=entry["offset"], shape=(count,))
+            else:
+                # an empty file region can't be mapped
+                arrays[entry["name"]] = np.zeros(0, dtype=dtype)
+
+        sids = np.empty(len(header["sids"]), dtype=object)
+        sids[:] = header["sids"]
+        index = FingerprintIndex(arrays["keys"], arrays["codes"], arrays["offsets"])
+        return cls(path, header, index, sids, stat)
+
+    def replaced(self):
+        """
+        True once the file at self.path was rebuilt or removed.
+        """
+        try:
+            return _stat_key(self.path) != self.stat
+        except OSError:
+            return True
+
+    def without(self, sids):
+        """
+        This index with the rows of `sids` skipped, sharing the mapping.
+        """
+        return IndexFile(self.path, self.header, self.index, self.sids, self.stat,
+                         self.excluded.union(sids))
+
+    def live_sids(self):
+        return set(self.sids.tolist()).difference(self.excluded)
+
+    def lookup(self, keys):
+        """
+        returns: (query positions, advert identifiers, offsets) of the
+                 stored rows matching `keys`
+        """
+        query, codes, offsets = self.index.lookup(keys)
+        if self.live is not None:
+            keep = self.live[codes]
+            query, codes, offsets = query[keep], codes[keep], offsets[keep]
+        return query, self.sids[codes], offsets
+
+
+def _stat_key(path):
+    stat = os.stat(path)
+    return (stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns)
+
+
+def read_fingerprints(db):
+    """
+    Reads the fingerprints of all fully fingerprinted adverts of `db`.
+
+    returns: (FingerprintIndex, sids)
+    """
+    sids = [advert[Database.FIELD_ADVERT_ID] for advert in db.get_adverts()]
+    codes = dict((sid, code) for code, sid in enumerate(sids))
+    rows = [(hash, codes[sid], offset)
+            for hash, sid, offset in db.get_fingerprints() if sid in codes]
+    return FingerprintIndex.build(*index_arrays(rows, db.fingerprint_format)), sids
+
+
+def build_index_file(db, path, fingerprint_options):
+    """
+    Builds the index file of `db` from its fingerprint table.
+
+    returns: the number of fingerprints written
+    """
+    index, sids = read_fingerprints(db)
+    write_index(path, index, sids, fingerprint_options)
+    return len(index)
+
+
+def verify_index_file(db, path, fingerprint_options):
+    """
+    Checks the index file against `db`.
+
+    returns: a list of problems, empty if the file is sound and holds
+             exactly the fingerprints of db's fingerprinted adverts
+    """
+    try:
+        index_file = IndexFile.open(path, fingerprint_options)
+    except (IOError, OSError, ValueError, IndexFormatError) as err:
+        return [str(err)]
+
+    problems = []
+    index = index_file.index
+    if len(index) and np.any(index.keys[1:] < index.keys[:-1]):
+        problems.append("keys are not sorted")
+    if len(index) and (index.codes.min() < 0 or index.codes.max() >= len(index_file.sids)):
+        problems.append("advert codes out of range")
+    if problems:
+        return problems
+
+    expected, sids = read_fingerprints(db)
+    missing = set(sids).difference(index_file.sids.tolist())
+    extra = set(index_file.sids.tolist()).difference(sids)
+    if missing:
+        problems.append("%d adverts missing, e.g. %s" % (len(missing), sorted(missing, key=str)[:5]))
+    if extra:
+        problems.append("%d adverts no longer in the database, e.g. %s"
+                        % (len(extra), sorted(extra, key=str)[:5]))
+    if len(expected) != len(index):
+        problems.append("%d fingerprints, the database has %d" % (len(index), len(expected)))
+    elif not _same_rows(expected, np.array(sids, dtype=object), index, index_file.sids):
+        problems.append("fingerprints differ from the database")
+    return problems
+
+
+def _same_rows(a, a_sids, b, b_sids):
+    # compare (key, advert, offset) rows regardless of the order of equal keys
+    ranks = dict((sid, rank) for rank, sid in
+                 enumerate(sorted(set(a_sids.tolist()) | set(b_sids.tolist()), key=str)))
+    columns = []
+    for index, sids in ((a, a_sids), (b, b_sids)):
+        advert_ranks = np.array([ranks[sid] for sid in sids.tolist()], dtype=np.int64)
+        advert_ranks = advert_ranks[index.codes] if len(advert_ranks) else advert_ranks[:0]
+        order = np.lexsort((np.asarray(index.offsets), advert_ranks, np.asarray(index.keys)))
+        columns.append((np.asarray(index.keys)[order], advert_ranks[order],
+                        np.asarray(index.offsets)[order]))
+    return all(np.array_equal(x, y) for x, y in zip(*columns))
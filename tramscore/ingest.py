@@ -0,0 +1,316 @@
+""" Continuous PCM ingest from ffmpeg for live station monitoring.
+
+Instead of letting ffmpeg write segment files that are watched, decoded
+again and fingerprinted from scratch, ffmpeg decodes the station to raw
+s16le mono PCM on its stdout. A reader thread drains the pipe into a ring
+buffer and a `StationIngest` feeds the samples straight to an
+`IncrementalFingerprinter`, matching a sliding window every few seconds.
+"""
+from __future__ import absolute_import
+
+import logging
+import os
+import subprocess
+import threading
+import time
+
+import numpy as np
+
+from . import fingerprint
+from .decoder import FFMPEG_BIN, ffmpeg_command
+
+logger = logging.getLogger(__name__)
+
+######################################################################
+# Bytes read from the pipe at a time, a bit over 0.1 s of 44.1 kHz audio
+PIPE_READ_SIZE = 1 << 13
+
+######################################################################
+# Seconds of PCM the ring buffer holds. If the fingerprinting side falls
+# further behind than this, the oldest samples are dropped.
+DEFAULT_BUFFER_SECONDS = 30
+
+######################################################################
+# Length of audio matched at once, like the old 10 second segments, and
+# how often a new match is attempted
+DEFAULT_WINDOW_SECONDS = 10
+DEFAULT_STEP_SECONDS = 2.5
+
+
+class RingBuffer(object):
+    """
+    Fixed size int16 sample buffer with one writer and one reader thread.
+
+    Positions count samples since the start of the stream. When the writer
+    gets more than `capacity` samples ahead, the reader skips to the oldest
+    sample still held and `read` reports how many were lost. With
+    `block=True` the writer waits for room instead, which suits inputs
+    that can be paused such as local files.
+    """
+
+    def __init__(self, capacity, block=False):
+        super(RingBuffer, self).__init__()
+        self.capacity = int(capacity)
+        self.block = block
+        self._data = np.zeros(self.capacity, dtype=np.int16)
+        self._written = 0
+        self._read = 0
+        self._closed = False
+        self._cond = threading.Condition()
+
+    def write(self, samples):
+        if not self.block:
+            # samples that would be overwritten at once still count as dropped
+            skipped = max(len(samples) - self.capacity, 0)
+            self._write(samples[skipped:], skipped)
+            return
+
+        while len(samples) and not self._closed:
+            with self._cond:
+                while self._written - self._read >= self.capacity and not self._closed:
+                    self._cond.wait()
+                room = self.capacity - (self._written - self._read)
+            self._write(samples[:room])
+            samples = samples[room:]
+
+    def _write(self, samples, skipped=0):
+        with self._cond:
+            self._written += skipped
+            start = self._written % self.capacity
+            first = min(len(samples), self.capacity - start)
+            self._data[start:start + first] = samples[:first]
+            self._data[:len(samples) - first] = samples[first:]
+            self._written += len(samples)
+            self._cond.notify_all()
+
+    def close(self):
+        """
+        Marks the end of the stream, readers get what is left then nothing
+        and a blocked writer gives up.
+        """
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+    @property
+    def closed(self):
+        return self._closed
+
+    def available(self):
+        with self._cond:
+            return min(self._written - self._read, self.capacity)
+
+    def read(self, nsamples, timeout=None):
+        """
+        Waits until `nsamples` are buffered (or the stream ends, or
+        `timeout` seconds pass) and returns up to that many.
+
+        returns: (samples, dropped) where dropped is the number of samples
+                 overwritten before they could be read
+        """
+        with self._cond:
+            deadline = None if timeout is None else time.time() + timeout
+            while self._written - self._read < nsamples and not self._closed:
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+
+            dropped = max(self._written - self._read - self.capacity, 0)
+            self._read += dropped
+            count = min(nsamples, self._written - self._read)
+            start = self._read % self.capacity
+            indexes = np.arange(start, start + count) % self.capacity
+            samples = self._data[indexes]
+            self._read += count
+            self._cond.notify_all()
+            return samples, dropped
+
+
+class PCMStream(object):
+    """
+    Mono s16le PCM coming out of ffmpeg, read into a `RingBuffer` by a
+    background thread so the pipe never fills up and stalls ffmpeg.
+
+    ```python
+    stream = PCMStream("http://host/station.mp3")       # launches ffmpeg
+    stream = PCMStream(fileobj=existing_ffmpeg.stdout)  # attaches to a pipe
+    stream.start()
+    samples, dropped = stream.read(44100)
+    ```
+
+    block: make ffmpeg wait when the buffer is full instead of dropping
+           the oldest audio. Defaults to True for local files read faster
+           than real time, live streams should drop rather than lag.
+    """
+
+    def __init__(self, source=None, Fs=fingerprint.DEFAULT_FS, fileobj=None,
+                 realtime=False, loop=False, buffer_seconds=DEFAULT_BUFFER_SECONDS,
+                 block=None, ffmpeg=FFMPEG_BIN):
+        super(PCMStream, self).__init__()
+
+        if (source is None) == (fileobj is None):
+            raise ValueError("PCMStream needs exactly one of source or fileobj")
+
+        self.source = source
+        # label for logs and the reader thread
+        self.name = source if source is not None else repr(fileobj)
+        self.Fs = Fs
+        self.fileobj = fileobj
+        self.command = None
+        if source is not None:
+            self.command = ffmpeg_command(source, Fs=Fs, realtime=realtime,
+                                          loop=loop, ffmpeg=ffmpeg)
+        if block is None:
+            block = source is not None and os.path.exists(source) and not realtime
+        self.buffer = RingBuffer(buffer_seconds * Fs, block=block)
+        self.process = None
+        self._thread = None
+
+    def start(self):
+        if self.command is not None:
+            self.process = subprocess.Popen(self.command, stdout=subprocess.PIPE,
+                                            stdin=subprocess.DEVNULL)
+            self.fileobj = self.process.stdout
+
+        self._thread = threading.Thread(target=self._pump, name="pcm-%s" % self.name)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def _pump(self):
+        read = getattr(self.fileobj, "read1", self.fileobj.read)
+        pending = b""
+        try:
+            while True:
+                data = read(PIPE_READ_SIZE)
+                if not data:
+                    break
+                data = pending + data
+                usable = len(data) - len(data) % 2
+                pending = data[usable:]
+                self.buffer.write(np.frombuffer(data[:usable], dtype="<i2"))
+        except (IOError, OSError, ValueError) as err:
+            # the pipe was closed under us by close()
+            logger.debug("PCM stream %s stopped: %s" % (self.name, err))
+        finally:
+            self.buffer.close()
+
+    def read(self, nsamples, timeout=None):
+        return self.buffer.read(nsamples, timeout=timeout)
+
+    @property
+    def finished(self):
+        """
+        True once the stream ended and every buffered sample was read.
+        """
+        return self.buffer.closed and not self.buffer.available()
+
+    def close(self):
+        self.buffer.close()
+        if self.process is not None:
+            if self.process.poll() is None:
+                # nothing of ffmpeg's output is wanted any more, and a
+                # looping or -re ffmpeg can sit on a SIGTERM
+                self.process.kill()
+            self.process.wait()
+            self.process.stdout.close()
+        if self._thread is not None:
+            self._thread.join()
+
+
+class StationIngest(object):
+    """
+    Fingerprints one station's PCM continuously and matches the last
+    `window_seconds` of hashes every `step_seconds`.
+
+    Each block of new hashes is looked up in the database once. A match
+    is the usual `align_matches` dict with offsets relative to the start
+    of the window, plus `stream_time`, the seconds of stream audio when
+    the window ended.
+    """
+    STREAM_TIME = "stream_time"
+
+    def __init__(self, tramscore, stream, window_seconds=DEFAULT_WINDOW_SECONDS,
+                 step_seconds=DEFAULT_STEP_SECONDS, min_count=None):
+        super(StationIngest, self).__init__()
+        self.tramscore = tramscore
+        self.stream = stream
+        self.window_seconds = window_seconds
+        self.step_seconds = step_seconds
+        # windows with fewer aligned hashes give None without a lookup
+        self.min_count = min_count
+        self.fingerprinter = tramscore.incremental_fingerprinter(Fs=stream.Fs)
+        # (first frame of the step, matches, number of hashes) per step
+        self._steps = []
+        # stream frames before the fingerprinter was last reset
+        self._base_frames = 0
+
+    @property
+    def stream_frames(self):
+        return self._base_frames + self.fingerprinter.frames
+
+    def _frames(self, nsamples):
+        return nsamples // self.fingerprinter.plan.hop
+
+    def _add_hashes(self, hashes, step_start):
+        if hashes:
+            # diffs are database offset minus stream frame
+            matches, total_hashes = self.tramscore.find_hash_matches(hashes)
+        else:
+            matches, total_hashes = [], 0
+        self._steps.append((step_start, list(matches), total_hashes))
+
+    def _match_window(self):
+        end = self.stream_frames
+        window_start = max(end - self._frames(int(self.window_seconds * self.stream.Fs)), 0)
+        self._steps = [step for step in self._steps if step[0] >= window_start]
+
+        matches = []
+        total_hashes = 0
+        for _, step_matches, step_hashes in self._steps:
+            # shift diffs so offsets count from the start of the window
+            matches.extend((sid, diff + window_start) for sid, diff in step_matches)
+            total_hashes += step_hashes
+        if not total_hashes:
+            return None
+
+        t = time.time()
+        match = self.tramscore.align_matches(matches, total_hashes, self.min_count)
+        if match:
+            match[self.tramscore.MATCH_TIME] = time.time() - t
+            match[self.STREAM_TIME] = self.fingerprinter.offset_to_seconds(end)
+        return match
+
+    def matches(self):
+        """
+        Generator of window results (match dict or None) until the stream
+        ends.
+        """
+        step = int(self.step_seconds * self.stream.Fs)
+        finished = False
+        while not finished:
+            samples, dropped = self.stream.read(step)
+            finished = self.stream.finished
+            if dropped:
+                logger.warning("%s: fingerprinting fell behind, dropped %.1f s of audio"
+                               % (self.stream.name, dropped / float(self.stream.Fs)))
+                # offsets after the gap do not line up with the ones before
+                self._base_frames = self.stream_frames + self._frames(dropped)
+                self.fingerprinter.reset()
+                self._steps = []
+
+            # a long-lived engine picks up new adverts between steps
+            self.tramscore.refresh_adverts()
+
+            base = self._base_frames
+            step_start = self.stream_frames
+            hashes = self.fingerprinter.feed(samples)
+            if finished:
+                self._base_frames = self.stream_frames
+                hashes += self.fingerprinter.flush()
+
+            # the fingerprinter counts frames from its last reset
+            hashes = [(h, offset + base) for h, offset in hashes]
+            self._add_hashes(hashes, step_start)
+            yield self._match_window()
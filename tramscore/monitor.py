@@ -0,0 +1,343 @@
+""" Multi-station advert monitor.
+
+One process watches every station listed in the config. All stations share
+one long-lived Tramscore (database, fingerprint options and advert catalog)
+and one pool of recognition workers, so adding a station adds a watched
+directory or a stream, not another process with its own connections and
+caches. The catalog is reloaded every "advert_refresh_seconds" of the
+config, or on refresh_adverts() after invalidate_adverts() (SIGHUP in
+monitor.py).
+
+Config, next to the usual "database" settings:
+
+    "monitor": {
+        "workers": 4,
+        "settle_seconds": 8,
+        "recognition_url": "https://host/api/v1/recognitions/",
+        "client_url": "https://host/api/v1/clients/%s/",
+        "station_url": "https://host/api/v1/stations/%s/",
+        "stations": [
+            {"name": "ADOM FM", "id": 8,
+             "watch_dir": "/path/adom_fm_stream_watcher/",
+             "detected_dir": "/path/adom_fm_detected_logs/",
+             "failed_dir": "/path/adom_fm_failed_logs/"},
+            {"name": "JOY FM", "id": 7, "stream": "http://host/joyfm.mp3",
+             "min_confidence": 100, "min_relative_confidence": 3.0}
+        ]
+    }
+
+A station with "watch_dir" is fed by the segment files of its
+stream_scripts/ ffmpeg job, a station with "stream" is decoded through an
+ffmpeg pipe (see ingest.py) that is reopened whenever ffmpeg exits.
+"""
+from __future__ import absolute_import
+
+import datetime
+import logging
+import os
+import shutil
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from pytz import timezone
+from watchdog.events import PatternMatchingEventHandler
+from watchdog.observers import Observer
+
+from . import Tramscore
+from .ingest import PCMStream, StationIngest
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_WORKERS = 4
+# seconds to wait after a segment shows up, so ffmpeg is done writing it
+DEFAULT_SETTLE_SECONDS = 8
+DEFAULT_MIN_CONFIDENCE = 100
+DEFAULT_MIN_RELATIVE_CONFIDENCE = 3.0
+SEGMENT_PATTERNS = ["*.mp3", "*.mp4", "*.wav", "*.mov", "*.aac"]
+# seconds to wait before reopening a stream that ended, doubled after every
+# failed attempt up to the max. A stream that ran for the max starts over.
+RECONNECT_MIN_SECONDS = 1
+RECONNECT_MAX_SECONDS = 60
+
+
+class Station(object):
+    """
+    One monitored media station, built from an entry of "stations".
+    """
+
+    def __init__(self, name, id, watch_dir=None, detected_dir=None, failed_dir=None,
+                 stream=None, min_confidence=DEFAULT_MIN_CONFIDENCE,
+                 min_relative_confidence=DEFAULT_MIN_RELATIVE_CONFIDENCE):
+        super(Station, self).__init__()
+
+        if (watch_dir is None) == (stream is None):
+            raise ValueError("Station %s needs exactly one of watch_dir or stream" % name)
+
+        self.name = name
+        self.id = int(id)
+        self.watch_dir = watch_dir
+        self.detected_dir = detected_dir
+        self.failed_dir = failed_dir
+        self.stream = stream
+        self.min_confidence = min_confidence
+        self.min_relative_confidence = min_relative_confidence
+
+    def __repr__(self):
+        return "Station(%r, %s)" % (self.name, self.id)
+
+    def make_dirs(self):
+        for path in (self.watch_dir, self.detected_dir, self.failed_dir):
+            if path and not os.path.isdir(path):
+                os.makedirs(path)
+
+
+class SegmentHandler(PatternMatchingEventHandler):
+    """
+    Hands every new segment file of a station to the monitor.
+    """
+
+    def __init__(self, monitor, station):
+        super(SegmentHandler, self).__init__(patterns=SEGMENT_PATTERNS)
+        self.monitor = monitor
+        self.station = station
+
+    def on_created(self, event):
+        if not event.is_directory:
+            self.monitor.segment_created(self.station, event.src_path)
+
+
+class Monitor(object):
+    """
+    Recognizes adverts on every configured station.
+
+    ```python
+    monitor = Monitor(config)
+    monitor.run()  # until interrupted
+    ```
+    """
+
+    def __init__(self, config, tramscore=None):
+        super(Monitor, self).__init__()
+
+        options = config.get("monitor", {})
+        self.stations = [Station(**station) for station in options.get("stations", [])]
+        if not self.stations:
+            raise ValueError("No stations configured under monitor.stations")
+
+        self.settle_seconds = options.get("settle_seconds", DEFAULT_SETTLE_SECONDS)
+        self.recognition_url = options.get("recognition_url")
+        self.client_url = options.get("client_url")
+        self.station_url = options.get("station_url")
+
+        self.tramscore = tramscore or Tramscore(config)
+        self.executor = ThreadPoolExecutor(max_workers=options.get("workers", DEFAULT_WORKERS))
+        self.observer = None
+        self.ingest_threads = []
+        # station id: the PCMStream its ingest thread currently reads
+        self.streams = {}
+        self._streams_lock = threading.Lock()
+        self._stopped = threading.Event()
+
+    def start(self):
+        self.observer = Observer()
+        for station in self.stations:
+            station.make_dirs()
+            if station.watch_dir:
+                self.observer.schedule(SegmentHandler(self, station), path=station.watch_dir)
+                logger.info("Watching %s for %s" % (station.watch_dir, station.name))
+            else:
+                thread = threading.Thread(target=self._ingest, args=(station,),
+                                          name="ingest-%s" % station.name)
+                thread.daemon = True
+                thread.start()
+                self.ingest_threads.append(thread)
+        self.observer.start()
+
+    def run(self):
+        self.start()
+        try:
+            while not self._stopped.wait(1):
+                pass
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.stop()
+
+    def stop(self):
+        self._stopped.set()
+        if self.observer is not None:
+            self.observer.stop()
+            self.observer.join()
+        with self._streams_lock:
+            streams = list(self.streams.values())
+            self.streams.clear()
+        for stream in streams:
+            # ends the stream, the ingest thread then finishes
+            stream.close()
+        for thread in self.ingest_threads:
+            thread.join()
+        self.executor.shutdown(wait=True)
+        self.tramscore.db.close()
+
+    def segment_created(self, station, path):
+        # called on the observer thread, never block it
+        timer = threading.Timer(self.settle_seconds, self._submit_segment,
+                                args=(station, path))
+        timer.daemon = True
+        timer.start()
+
+    def _submit_segment(self, station, path):
+        if not self._stopped.is_set():
+            self.executor.submit(self.recognize_segment, station, path)
+
+    def recognize_segment(self, station, path):
+        logger.info("Trying detection on: %s" % path)
+        reported = []
+        try:
+            # every advert in the segment, e.g. two back-to-back spots
+            for advert in self.tramscore.recognize_path(path, min_count=station.min_confidence):
+                advert = self.report(station, advert)
+                if advert:
+                    reported.append(advert)
+        except Exception as err:
+            logger.error("ERROR ON RECOGNITION ATTEMPT: %s" % err)
+
+        if reported:
+            name = "%s%s%s" % (reported[0][Tramscore.ADVERT_NAME],
+                               datetime.datetime.now(timezone('UTC')).strftime("%Y%b%d-%H%M%S"),
+                               os.path.splitext(path)[1])
+            self._move(path, station.detected_dir, name)
+        else:
+            self._move(path, station.failed_dir)
+
+    def _ingest(self, station):
+        delay = RECONNECT_MIN_SECONDS
+        while not self._stopped.is_set():
+            started = time.time()
+            try:
+                self._ingest_stream(station)
+            except Exception as err:
+                logger.error("ERROR ingesting %s: %s" % (station.name, err))
+            if self._stopped.is_set():
+                break
+            if time.time() - started >= RECONNECT_MAX_SECONDS:
+                delay = RECONNECT_MIN_SECONDS
+            logger.error("Stream of %s ended, reconnecting in %s seconds" % (station.name, delay))
+            if self._stopped.wait(delay):
+                break
+            delay = min(delay * 2, RECONNECT_MAX_SECONDS)
+
+    def _open_stream(self, station):
+        # registered under the lock, so stop() closes any stream opened
+        # before it took the lock and none is opened after
+        with self._streams_lock:
+            if self._stopped.is_set():
+                return None
+            stream = PCMStream(station.stream).start()
+            self.streams[station.id] = stream
+            return stream
+
+    def _close_stream(self, station, stream):
+        with self._streams_lock:
+            if self.streams.get(station.id) is not stream:
+                # stop() took it
+                return
+            del self.streams[station.id]
+        stream.close()
+
+    def _ingest_stream(self, station):
+        stream = self._open_stream(station)
+        if stream is None:
+            return
+        # windows overlap, so one airing matches several times in a row.
+        # Report an advert again only once it could have aired again.
+        last_reported = {}
+        try:
+            ingest = StationIngest(self.tramscore, stream, min_count=station.min_confidence)
+            for advert in ingest.matches():
+                if self._stopped.is_set():
+                    break
+                if advert is None:
+                    continue
+                advert_id = advert[Tramscore.ADVERT_ID]
+                stream_time = advert[StationIngest.STREAM_TIME]
+                if stream_time - last_reported.get(advert_id, -1e9) < (advert[Tramscore.AUDIO_LENGTH] or 0):
+                    continue
+                try:
+                    if self.report(station, advert):
+                        last_reported[advert_id] = stream_time
+                except Exception as err:
+                    logger.error("ERROR ON RECOGNITION ATTEMPT: %s" % err)
+        finally:
+            self._close_stream(station, stream)
+
+    def _move(self, path, directory, name=None):
+        if not directory:
+            return
+        try:
+            shutil.move(path, os.path.join(directory, name or os.path.basename(path)))
+        except (IOError, OSError) as err:
+            logger.error("ERROR moving %s: %s" % (path, err))
+
+    def report(self, station, advert):
+        """
+        Reports a match that clears the station's thresholds and is booked
+        on the station.
+
+        returns: the reported advert, or None
+        """
+        if advert is None:
+            return None
+
+        relative_confidence = float(round(advert[Tramscore.RELATIVE_CONFIDENCE], 2))
+        if (relative_confidence <= station.min_relative_confidence
+                or advert[Tramscore.CONFIDENCE] <= station.min_confidence):
+            return None
+        if station.id not in [int(id) for id in advert[Tramscore.MEDIA_STATION_ID] if id]:
+            return None
+
+        now_utc = datetime.datetime.now(timezone('UTC'))
+        advert = dict(advert)
+        advert[Tramscore.ADVERT_NAME] = advert[Tramscore.ADVERT_NAME].decode('utf-8')
+        advert[Tramscore.MATCH_TIME] = round(advert.get(Tramscore.MATCH_TIME, 0), 2)
+        advert[Tramscore.RELATIVE_CONFIDENCE] = relative_confidence
+        advert[Tramscore.CLIENT_USER_ID] = int(advert[Tramscore.CLIENT_USER_ID])
+        advert[Tramscore.MEDIA_STATION_ID] = station.id
+        advert["format_date_detected"] = now_utc.strftime("%Y-%m-%d")
+        advert["date_detected"] = now_utc.strftime("%a, %b %d, %Y")
+        advert["time_detected"] = now_utc.strftime("%H:%M:%S")
+
+        logger.info("%s has been detected on %s today, %s at %s. Time taken to detect "
+                    "this advert was %sseconds with an accuracy of %spercent."
+                    % (advert[Tramscore.ADVERT_NAME], station.name, advert["date_detected"],
+                       advert["time_detected"], advert[Tramscore.MATCH_TIME],
+                       relative_confidence))
+        if self.recognition_url:
+            self.executor.submit(self.recognition_post, station, advert)
+        return advert
+
+    def recognition_post(self, station, advert):
+        # post request to tramsweb api to save recognition results
+        prep_data = {
+            "client_user": self.client_url % advert[Tramscore.CLIENT_USER_ID],
+            "media_station": self.station_url % station.id,
+            "advert_id": advert[Tramscore.ADVERT_ID],
+            "advert_name": advert[Tramscore.ADVERT_NAME],
+            "confidence": advert[Tramscore.CONFIDENCE],
+            "relative_confidence": advert[Tramscore.RELATIVE_CONFIDENCE],
+            "match_time": advert[Tramscore.MATCH_TIME],
+            "file_sha1": advert["file_sha1"],
+            "audio_length": advert[Tramscore.AUDIO_LENGTH],
+            "offset_seconds": advert[Tramscore.OFFSET_SECS],
+            "offset": advert[Tramscore.OFFSET],
+            "date_detected": advert["format_date_detected"],
+            "time_detected": advert["time_detected"],
+        }
+        try:
+            response = requests.post(self.recognition_url, data=prep_data, verify=False)
+            logger.info("RECOGNITION UPDATE: Response code: %s and Reason: %s."
+                        % (response.status_code, response.reason))
+        except requests.RequestException as err:
+            logger.error("ERROR posting recognition: %s" % err)
@@ -10,36 +10,49 @@ from . import decoder
 
 class BaseRecognizer(object):
 
-    def __init__(self, tramscore):
+    def __init__(self, tramscore, min_count=None):
         self.tramscore = tramscore
         self.Fs = fingerprint.DEFAULT_FS
+        # None recognizes the best matching advert, a number returns a list
+        # of every advert with at least that many aligned hashes
+        self.min_count = min_count
 
     def _recognize(self, *data):
+        if self.tramscore.aggregate_matches:
+            return self.tramscore.align_channels(data, Fs=self.Fs, min_count=self.min_count)
         matches = []
         total_hashes = 0
-        for d in data:
-            extracted_matches = self.tramscore.find_matches(d, Fs=self.Fs)
+        for hashes in self.tramscore.fingerprint_channels(data, Fs=self.Fs):
+            extracted_matches = self.tramscore.find_hash_matches(hashes)
             total_hashes += extracted_matches[1]
             matches.extend(extracted_matches[0])
+        if self.min_count is not None:
+            return self.tramscore.align_all_matches(matches, total_hashes, self.min_count)
         return self.tramscore.align_matches(matches, total_hashes)
 
+    def _set_match_time(self, match, t):
+        # a match, a list of them or None
+        for advert in (match if isinstance(match, list) else [match]):
+            if advert:
+                advert['match_time'] = t
+
     def recognize(self):
         pass  # base class does nothing
 
 
 class DirFileRecognizer(BaseRecognizer):
-    def __init__(self, tramscore):
-        super(DirFileRecognizer, self).__init__(tramscore)
+    def __init__(self, tramscore, min_count=None):
+        super(DirFileRecognizer, self).__init__(tramscore, min_count)
 
     def recognize_file(self, filename):
-        frames, self.Fs, file_hash, audio_length = decoder.read(filename, self.tramscore.limit)
+        frames, self.Fs, file_hash, audio_length = decoder.read(filename, self.tramscore.limit,
+                                                                decoder=self.tramscore.decoder)
 
         t = time.time()
         match = self._recognize(*frames)
         t = time.time() - t
 
-        if match:
-            match['match_time'] = t
+        self._set_match_time(match, t)
 
         return match
 
@@ -48,18 +61,18 @@ class DirFileRecognizer(BaseRecognizer):
 
 
 class FileRecognizer(BaseRecognizer):
-    def __init__(self, tramscore):
-        super(FileRecognizer, self).__init__(tramscore)
+    def __init__(self, tramscore, min_count=None):
+        super(FileRecognizer, self).__init__(tramscore, min_count)
 
     def recognize_file(self, filename):
-        frames, self.Fs, file_hash, audio_length = decoder.read(filename, self.tramscore.limit)
+        frames, self.Fs, file_hash, audio_length = decoder.read(filename, self.tramscore.limit,
+                                                                decoder=self.tramscore.decoder)
 
         t = time.time()
         match = self._recognize(*frames)
         t = time.time() - t
 
-        if match:
-            match['match_time'] = t
+        self._set_match_time(match, t)
 
         return match
 
@@ -73,8 +86,8 @@ class MicrophoneRecognizer(BaseRecognizer):
     default_channels    = 2
     default_samplerate  = 44100
 
-    def __init__(self, tramscore):
-        super(MicrophoneRecognizer, self).__init__(tramscore)
+    def __init__(self, tramscore, min_count=None):
+        super(MicrophoneRecognizer, self).__init__(tramscore, min_count)
         self.audio = pyaudio.PyAudio()
         self.stream = None
         self.data = []
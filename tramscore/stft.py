@@ -0,0 +1,125 @@
+""" Short-time Fourier transform used to build fingerprint spectrograms.
+
+Computes the same one-sided power spectral density as
+`matplotlib.mlab.specgram(x, NFFT, Fs, window_hanning, noverlap)` but keeps
+the window and scaling around between calls, frames the signal through a
+strided view instead of copies and writes straight into one output buffer.
+"""
+from __future__ import absolute_import
+
+import numpy as np
+from numpy.lib.stride_tricks import as_strided
+
+######################################################################
+# Number of frames transformed at a time. Bounds the temporary memory
+# of the windowed frames and their FFT to a few MB.
+FRAMES_PER_BLOCK = 256
+
+# Plans already built, keyed by (wsize, noverlap, Fs, dtype)
+_plans = {}
+
+
+class STFT(object):
+    """
+    Precomputed STFT for one (wsize, noverlap, Fs) combination.
+
+    ```python
+    plan = get_plan(4096, 2048, 44100)
+    arr2D = plan.specgram(samples)  # (frequencies, frames)
+    ```
+    """
+
+    def __init__(self, wsize, noverlap, Fs, dtype=np.float32):
+        super(STFT, self).__init__()
+
+        if not 0 <= noverlap < wsize:
+            raise ValueError("noverlap must be in [0, wsize), got %s" % noverlap)
+
+        self.wsize = wsize
+        self.noverlap = noverlap
+        self.hop = wsize - noverlap
+        self.Fs = Fs
+        self.dtype = np.dtype(dtype)
+        self.nfreqs = wsize // 2 + 1
+
+        window = np.hanning(wsize)
+        self.window = window.astype(self.dtype)
+
+        # one-sided density: double everything but DC (and the Nyquist bin
+        # for even sizes), then divide by Fs and the window energy
+        scale = np.full(self.nfreqs, 2.0)
+        scale[0] = 1.0
+        if not wsize % 2:
+            scale[-1] = 1.0
+        scale /= Fs * (window ** 2).sum()
+        self.scale = scale.astype(self.dtype)
+
+    def num_frames(self, nsamples):
+        return 1 + (max(nsamples, self.wsize) - self.wsize) // self.hop
+
+    def frames(self, samples):
+        """
+        Returns a read-only (frames, wsize) view over `samples`.
+        Signals shorter than one window are zero padded, like specgram.
+        """
+        samples = np.ascontiguousarray(samples)
+        if len(samples) < self.wsize:
+            samples = np.concatenate(
+                (samples, np.zeros(self.wsize - len(samples), samples.dtype)))
+
+        step = samples.strides[0]
+        return as_strided(samples,
+                          shape=(self.num_frames(len(samples)), self.wsize),
+                          strides=(step * self.hop, step),
+                          writeable=False)
+
+    def specgram(self, samples, out=None):
+        """
+        Power spectrogram of `samples` with shape (frequencies, frames).
+
+        out: optional (frames, frequencies) buffer of the plan's dtype to
+             write into, e.g. to reuse memory between segments. The
+             returned array is a transposed view of it.
+        """
+        frames = self.frames(samples)
+        nframes = len(frames)
+
+        if out is None:
+            out = np.empty((nframes, self.nfreqs), dtype=self.dtype)
+        elif out.shape != (nframes, self.nfreqs) or out.dtype != self.dtype:
+            raise ValueError("out must be a %s array of shape %s"
+                             % (self.dtype, (nframes, self.nfreqs)))
+
+        windowed = np.empty((min(nframes, FRAMES_PER_BLOCK), self.wsize),
+                            dtype=self.dtype)
+        for start in range(0, nframes, FRAMES_PER_BLOCK):
+            block = frames[start:start + FRAMES_PER_BLOCK]
+            buf = windowed[:len(block)]
+            np.multiply(block, self.window, out=buf, casting="unsafe")
+
+            spectrum = np.fft.rfft(buf, axis=1)
+            power = out[start:start + len(block)]
+            np.square(spectrum.real, out=power, casting="unsafe")
+            power += np.square(spectrum.imag)
+            power *= self.scale
+
+        return out.T
+
+
+def get_plan(wsize, noverlap, Fs, dtype=np.float32):
+    """
+    Returns the cached STFT plan for the given parameters, building it
+    on first use.
+    """
+    key = (wsize, noverlap, Fs, np.dtype(dtype).str)
+    plan = _plans.get(key)
+    if plan is None:
+        plan = _plans[key] = STFT(wsize, noverlap, Fs, dtype=dtype)
+    return plan
+
+
+def specgram(samples, wsize, noverlap, Fs, dtype=np.float32, out=None):
+    """
+    Shortcut for `get_plan(wsize, noverlap, Fs, dtype).specgram(samples, out)`.
+    """
+    return get_plan(wsize, noverlap, Fs, dtype=dtype).specgram(samples, out=out)
@@ -0,0 +1,162 @@
+""" Incremental fingerprinting of a continuous audio stream.
+
+`IncrementalFingerprinter` takes PCM chunks of any size and returns the
+hashes that became final with each chunk. It keeps only the spectrogram
+columns and peaks still needed for the next chunk, so every STFT frame is
+computed once and pairs that cross chunk boundaries are not lost. Fed the
+whole stream and flushed, it returns the same hashes as
+`fingerprint.fingerprint` on the concatenated samples.
+"""
+from __future__ import absolute_import
+
+import numpy as np
+
+from . import fingerprint, stft
+
+
+class IncrementalFingerprinter(object):
+    """
+    Rolling fingerprinter for one audio stream (e.g. one station).
+
+    ```python
+    fingerprinter = IncrementalFingerprinter(Fs=44100)
+    for chunk in chunks:
+        hashes = fingerprinter.feed(chunk)
+    hashes = fingerprinter.flush()
+    ```
+
+    Hash offsets count STFT frames from the start of the stream.
+    """
+
+    def __init__(self, Fs=fingerprint.DEFAULT_FS,
+                 wsize=fingerprint.DEFAULT_WINDOW_SIZE,
+                 wratio=fingerprint.DEFAULT_OVERLAP_RATIO,
+                 fan_value=fingerprint.DEFAULT_FAN_VALUE,
+                 amp_min=fingerprint.DEFAULT_AMP_MIN,
+                 fingerprint_format=fingerprint.DEFAULT_FINGERPRINT_FORMAT,
+                 peak_picker=fingerprint.DEFAULT_PEAK_PICKER,
+                 hash_engine=fingerprint.DEFAULT_HASH_ENGINE):
+        super(IncrementalFingerprinter, self).__init__()
+
+        if hash_engine not in fingerprint.HASH_ENGINES:
+            raise ValueError("Unsupported hash engine: %s" % hash_engine)
+
+        self.Fs = Fs
+        self.wsize = wsize
+        self.wratio = wratio
+        self.fan_value = fan_value
+        self.amp_min = amp_min
+        self.fingerprint_format = fingerprint_format
+        self.peak_picker = peak_picker
+        self.hash_engine = hash_engine
+
+        self.plan = stft.get_plan(wsize, int(wsize * wratio), Fs)
+        # a peak depends on the columns this far away on either side
+        self.context = fingerprint.PEAK_NEIGHBORHOOD_SIZE
+        self.reset()
+
+    def reset(self):
+        """
+        Forgets the stream, the next chunk starts again at offset 0.
+        """
+        # samples not yet covered by a complete frame
+        self._samples = np.zeros(0, dtype=np.int16)
+        # spectrogram columns from frame self._columns_start onwards
+        self._columns = np.zeros((self.plan.nfreqs, 0), dtype=self.plan.dtype)
+        self._columns_start = 0
+        # frames produced so far, and frames whose peaks are final
+        self.frames = 0
+        self._final = 0
+        # the last peaks in time order, still owed their fan-out pairs
+        self._tail_freqs = np.zeros(0, dtype=np.int64)
+        self._tail_times = np.zeros(0, dtype=np.int64)
+
+    @property
+    def seconds(self):
+        """
+        Seconds of audio turned into spectrogram frames so far.
+        """
+        return self.frames * self.plan.hop / float(self.Fs)
+
+    def offset_to_seconds(self, offset):
+        return offset * self.plan.hop / float(self.Fs)
+
+    def feed(self, samples):
+        """
+        Adds a chunk of mono PCM samples.
+
+        returns: [(hash, offset), ...] that became final with this chunk
+        """
+        self._samples = np.concatenate((self._samples, samples))
+        self._add_frames()
+        return self._emit(self.frames - self.context)
+
+    def flush(self):
+        """
+        Ends the stream and returns the remaining hashes.
+        """
+        if not self.frames and len(self._samples):
+            # shorter than one window, zero padded like fingerprint()
+            self._append_columns(self.plan.specgram(self._samples))
+            self._samples = self._samples[:0]
+        hashes = self._emit(self.frames, at_end=True)
+        self.reset()
+        return hashes
+
+    def _add_frames(self):
+        nframes = self.plan.num_frames(len(self._samples))
+        if len(self._samples) < self.plan.wsize:
+            return
+
+        used = (nframes - 1) * self.plan.hop + self.plan.wsize
+        self._append_columns(self.plan.specgram(self._samples[:used]))
+        self._samples = self._samples[nframes * self.plan.hop:]
+
+    def _append_columns(self, arr2D):
+        with np.errstate(divide="ignore"):
+            np.log10(arr2D, out=arr2D)
+        arr2D *= 10
+        arr2D[arr2D == -np.inf] = 0  # replace infs with zeros
+
+        self._columns = np.concatenate((self._columns, arr2D), axis=1)
+        self.frames += arr2D.shape[1]
+
+    def _emit(self, until, at_end=False):
+        """
+        Finds the peaks of frames [self._final, until) and hashes them
+        with the peaks before them.
+        """
+        if until <= self._final:
+            return []
+
+        # the window reaches `context` columns left of the first frame
+        # to pick, and ends `context` columns right of the last one (or
+        # at the end of the stream, where the picker mirrors the edge)
+        start = self._columns_start
+        freqs, times = fingerprint.get_2D_peaks(
+            self._columns, amp_min=self.amp_min, peak_picker=self.peak_picker)
+        times = times + start
+        keep = (times >= self._final) & (times < until)
+        freqs, times = freqs[keep], times[keep]
+
+        # get_2D_peaks orders by frequency then time, pairing needs time
+        # order with frequency order within a frame, like PEAK_SORT
+        order = np.argsort(times, kind="mergesort")
+        freqs = np.concatenate((self._tail_freqs, freqs[order]))
+        times = np.concatenate((self._tail_times, times[order]))
+
+        hashes = list(fingerprint.generate_hashes(
+            (freqs, times), self.fan_value, hash_engine=self.hash_engine,
+            fingerprint_format=self.fingerprint_format, first_target=len(self._tail_times)))
+
+        tail_start = max(len(times) - max(self.fan_value - 1, 0), 0)
+        self._tail_freqs = freqs[tail_start:]
+        self._tail_times = times[tail_start:]
+
+        self._final = until
+        if not at_end:
+            drop = max(self._final - self.context - start, 0)
+            self._columns = self._columns[:, drop:]
+            self._columns_start += drop
+
+        return hashes
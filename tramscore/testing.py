@@ -1,4 +1,6 @@
 
+import numpy as np
+import matplotlib.pyplot as plt
 from pydub import AudioSegment
 from tramscore.decoder import path_to_advertname
 from tramscore import Tramscore